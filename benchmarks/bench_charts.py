@@ -0,0 +1,56 @@
+import datetime
+import random
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import plotly.graph_objects as go
+
+from bot import config
+from bot.charts import ChartManager
+from bot.charts import ImageRenderer
+
+FIGURE_COUNTS = [4, 16, 64]
+POINTS = 300
+
+
+def create_chart_manager(count):
+    start = datetime.date(2020, 2, 24)
+    dates = [start + datetime.timedelta(days=i) for i in range(POINTS)]
+    chart_mgr = ChartManager()
+    for i in range(count):
+        values = [random.randint(0, 100000) for _ in range(POINTS)]
+        chart_mgr.add(go.Figure(data=[go.Scatter(x=dates, y=values, mode="lines+markers")],
+                                layout=dict(title="Chart " + str(i))))
+    return chart_mgr
+
+
+def main():
+    workers = int(sys.argv[1]) if len(sys.argv) > 1 else config.CHART_RENDER_WORKERS
+    print("{0:>8}{1:>14}{2:>14}{3:>10}".format(
+        "figures", "sequential s", "parallel s", "speedup"))
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = Path(tmp_dir)
+        sequential_renderer = ImageRenderer(scale=config.CHART_RENDER_SCALE)
+        parallel_renderer = ImageRenderer(
+            workers=workers, scale=config.CHART_RENDER_SCALE)
+        # Cold starts are not part of the comparison
+        sequential_renderer.warm_up()
+        parallel_renderer.warm_up()
+        for count in FIGURE_COUNTS:
+            chart_mgr = create_chart_manager(count)
+            start = time.perf_counter()
+            chart_mgr.generate_images(path, sequential_renderer)
+            sequential = time.perf_counter() - start
+            start = time.perf_counter()
+            chart_mgr.generate_images(path, parallel_renderer)
+            parallel = time.perf_counter() - start
+            print("{0:>8}{1:>14.2f}{2:>14.2f}{3:>9.1f}x".format(
+                count, sequential, parallel, sequential / parallel))
+        sequential_renderer.shutdown()
+        parallel_renderer.shutdown()
+
+
+if __name__ == "__main__":
+    main()
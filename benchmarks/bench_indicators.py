@@ -0,0 +1,39 @@
+import random
+import timeit
+
+from bot.indicators import (DeltaIndicator, DeltaPercentageIndicator, Indicator,
+                            MovingAverageIndicator)
+
+SIZES = [1000, 100000, 1000000]
+MOVING_AVG_DAYS = 5
+
+
+def per_index(indicator):
+    # The generic get_all(), one calculate() call per index
+    return Indicator.get_all(indicator)
+
+
+def best_of(func, repeat):
+    return min(timeit.repeat(func, number=1, repeat=repeat))
+
+
+def main():
+    print("{0:<26}{1:>10}{2:>14}{3:>14}{4:>10}".format(
+        "indicator", "points", "per-index s", "batch s", "speedup"))
+    for size in SIZES:
+        data = [random.randint(1, 100000) for _ in range(size)]
+        indicators = [
+            ("MovingAverageIndicator", MovingAverageIndicator(data, MOVING_AVG_DAYS)),
+            ("DeltaIndicator", DeltaIndicator(data)),
+            ("DeltaPercentageIndicator", DeltaPercentageIndicator(data))
+        ]
+        repeat = 5 if size < 1000000 else 1
+        for name, indicator in indicators:
+            old = best_of(lambda: per_index(indicator), repeat)
+            new = best_of(indicator.get_all, repeat)
+            print("{0:<26}{1:>10}{2:>14.4f}{3:>14.4f}{4:>9.1f}x".format(
+                name, size, old, new, old / new))
+
+
+if __name__ == "__main__":
+    main()
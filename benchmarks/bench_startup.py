@@ -0,0 +1,144 @@
+import argparse
+import datetime
+import json
+import platform
+import subprocess
+import sys
+from pathlib import Path
+
+PROJECT_PATH = Path(__file__).resolve().parent.parent
+DEFAULT_REPEAT = 5
+# Only needed to render charts and to tweet, never by an idle poller
+HEAVY_MODULES = ["plotly", "twitter"]
+IMPORT_THRESHOLD = 1.2
+# Differences below these are noise rather than regressions
+IMPORT_MIN_SECONDS = 0.005
+RSS_THRESHOLD = 1.1
+RSS_MIN_BYTES = 2 ** 20
+
+# Imports the poller and polls once, the data being not modified
+IDLE_POLL_SCRIPT = """
+import json
+import logging
+import sys
+
+import bot.__main__ as bot_main
+from bot import memory
+from bot.fetch import FetchResult
+
+
+class NotModifiedFetcher:
+
+    def fetch(self, require_content=False):
+        return FetchResult(304, None, False)
+
+    def stats(self):
+        return {"requests": 1, "not_modified": 1, "bytes_saved": 0, "time_saved": 0.0}
+
+
+logging.getLogger("bot").disabled = True
+bot_main.log.disabled = True
+bot_main.config.METRICS = False
+bot_main.data_fetcher = NotModifiedFetcher()
+bot_main.poll_for_new_data()
+print(json.dumps({"rss": memory.rss(), "heavy_modules": [name for name in %r if name in sys.modules]}))
+""" % (HEAVY_MODULES,)
+
+
+def import_times(module="bot.__main__"):
+    # Cumulative import time of every module loaded by a fresh interpreter
+    # importing module, in seconds
+    process = subprocess.run([sys.executable, "-X", "importtime", "-c", "import " + module],
+                             cwd=str(PROJECT_PATH), stdout=subprocess.DEVNULL,
+                             stderr=subprocess.PIPE, universal_newlines=True, check=True)
+    times = {}
+    for line in process.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        times[name.strip()] = int(cumulative) / 1e6
+    return times
+
+
+def idle_poll():
+    process = subprocess.run([sys.executable, "-c", IDLE_POLL_SCRIPT], cwd=str(PROJECT_PATH),
+                             stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                             universal_newlines=True, check=True)
+    return json.loads(process.stdout.splitlines()[-1])
+
+
+def run(repeat):
+    import_seconds = []
+    slowest = {}
+    for _ in range(repeat):
+        times = import_times()
+        import_seconds.append(times["bot.__main__"])
+        for name, seconds in times.items():
+            slowest[name] = min(seconds, slowest.get(name, seconds))
+    polls = [idle_poll() for _ in range(repeat)]
+    return {
+        "import_seconds": min(import_seconds),
+        "idle_rss_bytes": min(poll["rss"] for poll in polls),
+        "heavy_modules": sorted(set(name for poll in polls for name in poll["heavy_modules"])),
+        "slowest_imports": sorted(slowest.items(), key=lambda item: item[1], reverse=True)[:10]
+    }
+
+
+def compare(results, baseline, import_threshold=IMPORT_THRESHOLD, rss_threshold=RSS_THRESHOLD):
+    regressions = []
+    for name, threshold, min_delta in [("import_seconds", import_threshold, IMPORT_MIN_SECONDS),
+                                       ("idle_rss_bytes", rss_threshold, RSS_MIN_BYTES)]:
+        previous = baseline.get(name)
+        if previous is None or previous <= 0:
+            continue
+        ratio = results[name] / previous
+        if ratio > threshold and results[name] - previous > min_delta:
+            regressions.append((name, previous, results[name], ratio))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Cold start time and idle memory of the poller")
+    parser.add_argument("--repeat", type=int, default=DEFAULT_REPEAT)
+    parser.add_argument("--output", help="JSON file the results are saved to")
+    parser.add_argument("--baseline", help="JSON results of a previous run to compare with")
+    parser.add_argument("--import-threshold", type=float, default=IMPORT_THRESHOLD)
+    parser.add_argument("--rss-threshold", type=float, default=RSS_THRESHOLD)
+    args = parser.parse_args()
+
+    results = run(args.repeat)
+    print("Import of bot.__main__: {0:.1f} ms".format(results["import_seconds"] * 1000))
+    print("RSS after an idle poll: {0:.1f} MiB".format(results["idle_rss_bytes"] / 2 ** 20))
+    for name, seconds in results["slowest_imports"]:
+        print("  {0:>8.1f} ms  {1}".format(seconds * 1000, name))
+    report = {
+        "meta": {
+            "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "platform": platform.platform()
+        },
+        "results": results
+    }
+    if args.output is not None:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2)
+
+    failed = False
+    if len(results["heavy_modules"]) > 0:
+        print("HEAVY MODULES loaded by an idle poller: " + ", ".join(results["heavy_modules"]))
+        failed = True
+    if args.baseline is not None:
+        with open(args.baseline, "r") as file:
+            baseline = json.load(file)["results"]
+        regressions = compare(results, baseline, args.import_threshold, args.rss_threshold)
+        for name, previous, current, ratio in regressions:
+            print("REGRESSION {0}: {1} -> {2} ({3:.2f}x)".format(name, previous, current, ratio))
+        failed = failed or len(regressions) > 0
+        if len(regressions) == 0:
+            print("No regressions against " + args.baseline)
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+import os
+import tempfile
+import time
+from pathlib import Path
+
+from twitter.error import TwitterError
+
+from bot.fake_twitter import FakeTwitterServer
+from bot.twitter import MediaType
+from bot.twitter import PythonTwitterBackend
+from bot.twitter import ThreadTwitter
+
+LATENCIES = [0.05, 0.2]
+UPLOAD_WORKERS = [1, 4]
+# (rate_limit_every, fail_every), deterministic so that every run injects
+# the same faults
+FAULTS = [(0, 0), (10, 0), (0, 5)]
+RETRIES = 3
+RETRY_DELAY = 0.1
+IMAGES = 4
+IMAGE_SIZE = 200 * 1024
+LINES = 12
+
+
+def create_images(path: Path):
+    images = []
+    for i in range(IMAGES):
+        fpath = path / ("chart_" + str(i) + ".png")
+        with open(fpath, "wb") as file:
+            file.write(b"\x89PNG\r\n\x1a\n" + os.urandom(IMAGE_SIZE))
+        images.append(str(fpath))
+    return images
+
+
+def post_thread(server, images, workers):
+    # The backend does not sleep on rate limits, the retries and their backoff
+    # are what is measured
+    backend = PythonTwitterBackend("consumer", "consumer_secret", "token", "token_secret",
+                                   base_url=server.base_url, upload_url=server.base_url,
+                                   sleep_on_rate_limit=False)
+    tt = ThreadTwitter(backend=backend, upload_workers=workers, upload_retries=RETRIES,
+                       retry_delay=RETRY_DELAY, post_retries=RETRIES)
+    for i in range(LINES):
+        tt.add_line("Line " + str(i) + " " + "x" * 40)
+    for image in images:
+        tt.add_media(image, MediaType.PHOTO)
+    start = time.perf_counter()
+    try:
+        tt.tweet()
+        outcome = "ok"
+    except TwitterError:
+        outcome = "failed"
+    return time.perf_counter() - start, outcome
+
+
+def main():
+    print("{0:>9}{1:>9}{2:>12}{3:>12}{4:>10}{5:>10}{6:>10}{7:>8}".format(
+        "latency", "workers", "rate limit", "fail every", "time s", "requests", "refused", "result"))
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        images = create_images(Path(tmp_dir))
+        for latency in LATENCIES:
+            for workers in UPLOAD_WORKERS:
+                for rate_limit_every, fail_every in FAULTS:
+                    server = FakeTwitterServer(latency=latency, rate_limit_every=rate_limit_every,
+                                               fail_every=fail_every).start()
+                    elapsed, outcome = post_thread(server, images, workers)
+                    stats = server.stats()
+                    server.stop()
+                    print("{0:>9.2f}{1:>9}{2:>12}{3:>12}{4:>10.2f}{5:>10}{6:>10}{7:>8}".format(
+                        latency, workers, rate_limit_every, fail_every, elapsed, stats["requests"],
+                        stats["rate_limited"] + stats["failures"], outcome))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,261 @@
+import argparse
+import datetime
+import json
+import logging
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import bot.__main__ as bot_main
+from bot import config
+from bot.charts import ImageRenderer
+from bot.indicators import (DeltaIndicator, DeltaPercentageIndicator,
+                            IndicatorCache, MovingAverageIndicator)
+from bot.processing import DataProcessor
+from bot.twitter import ThreadTwitter
+from bot.twitter import TwitterBackend
+
+DEFAULT_SIZES = [100, 1000, 10000, 100000]
+THREAD_MAX_LINES = 10000
+CHARTS_MAX_ROWS = 10000
+REGRESSION_THRESHOLD = 1.2
+# Slowdowns below this are timer noise rather than regressions
+REGRESSION_MIN_SECONDS = 0.001
+MOVING_AVG_DAYS = 5
+START_DATE = datetime.datetime(2020, 2, 24, 18)
+
+
+def synthetic_records(rows, seed=0):
+    # Entries shaped as the dpc national dataset, one per day
+    rnd = random.Random(seed)
+    records = []
+    totals = {"casi": 0, "guariti": 0, "deceduti": 0, "tamponi": 0}
+    for i in range(rows):
+        new_cases = rnd.randint(1, 5000)
+        recovered = rnd.randint(0, new_cases)
+        deaths = rnd.randint(0, new_cases - recovered)
+        totals["casi"] = totals["casi"] + new_cases
+        totals["guariti"] = totals["guariti"] + recovered
+        totals["deceduti"] = totals["deceduti"] + deaths
+        totals["tamponi"] = totals["tamponi"] + rnd.randint(new_cases, 10 * new_cases)
+        active = totals["casi"] - totals["guariti"] - totals["deceduti"]
+        intensive_care = active // 50
+        hospitalized = active // 10
+        records.append({
+            "data": (START_DATE + datetime.timedelta(days=i)).strftime(config.DATE_FORMAT),
+            "stato": "ITA",
+            "ricoverati_con_sintomi": hospitalized,
+            "terapia_intensiva": intensive_care,
+            "totale_ospedalizzati": hospitalized + intensive_care,
+            "isolamento_domiciliare": active - hospitalized - intensive_care,
+            "totale_positivi": active,
+            "variazione_totale_positivi": new_cases - recovered - deaths,
+            "nuovi_positivi": new_cases,
+            "dimessi_guariti": totals["guariti"],
+            "deceduti": totals["deceduti"],
+            "totale_casi": totals["casi"],
+            "tamponi": totals["tamponi"],
+            "note": None
+        })
+    return records
+
+
+class NullTwitterBackend(TwitterBackend):
+
+    def __init__(self):
+        self.posts = 0
+
+    def post_update(self, text, media=None, in_reply_to_status_id=None):
+        self.posts = self.posts + 1
+        return self.posts
+
+    def upload_media(self, media, media_category):
+        return 0
+
+
+class NullRenderBackend:
+
+    # Stands in for orca: the figure still travels to the render workers
+    # and is serialized, only the rasterization is skipped
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def is_running(self):
+        return True
+
+    def render(self, figure, fpath, scale):
+        if not isinstance(figure, dict):
+            figure = figure.to_dict()
+        with open(fpath, "w") as file:
+            json.dump(figure, file, default=str)
+
+
+def measure(func, repeat):
+    # func() prepares its input and returns the callable to time, so that
+    # every run starts from the same state
+    timings = []
+    for _ in range(repeat):
+        run = func()
+        start = time.perf_counter()
+        run()
+        timings.append(time.perf_counter() - start)
+    return {
+        "min": min(timings),
+        "median": statistics.median(timings),
+        "repeat": repeat
+    }
+
+
+def repeat_for(size):
+    if size >= 1000000:
+        return 1
+    if size >= 100000:
+        return 3
+    return 5
+
+
+def localize_case(dp):
+    def prepare():
+        # Localization changes the data, each run gets a fresh copy
+        copy = dp.copy()
+        return lambda: copy.localize_dates("UTC", "Europe/Rome")
+    return prepare
+
+
+def data_cases(payload, dp):
+    keys = [key for key in DataProcessor.LOOKUP_TABLE
+            if DataProcessor.LOOKUP_TABLE[key] not in DataProcessor.REGIONAL_FIELDS]
+    values = dp.get("total_active_positives")
+    return [
+        ("initialize", lambda: lambda: DataProcessor.initialize(payload, config.DATE_FORMAT)),
+        ("get", lambda: lambda: [dp.get(key) for key in keys]),
+        ("localize_dates", localize_case(dp)),
+        ("MovingAverageIndicator.get_all",
+         lambda: MovingAverageIndicator(values, MOVING_AVG_DAYS).get_all),
+        ("DeltaIndicator.get_all", lambda: DeltaIndicator(values).get_all),
+        ("DeltaPercentageIndicator.get_all", lambda: DeltaPercentageIndicator(values).get_all)
+    ]
+
+
+def thread_case(lines):
+    def prepare():
+        tt = ThreadTwitter(backend=NullTwitterBackend())
+        tt.set_header("🦠🇮🇹 Aggiornamento Giornaliero #COVID2019", repeat=False)
+        tt.set_footer("Generato da: http://tiny.cc/covid-bot", repeat=False)
+        for i in range(lines):
+            tt.add_line("📈 Nuovi positivi: {0} ({1:+d}) ({2:+.2f}%)".format(
+                i * 1000, i, i / 7))
+        return tt.tweet
+    return prepare
+
+
+def chart_cases(dp, renderer, path):
+    def build():
+        return lambda: bot_main.build_charts(dp, IndicatorCache())
+
+    def render():
+        chart_mgr = bot_main.build_charts(dp, IndicatorCache())
+        return lambda: chart_mgr.generate_images(path, renderer)
+
+    return [("build_charts", build), ("generate_images", render)]
+
+
+def run(sizes, render_backend):
+    results = {}
+
+    def record(name, size, func, repeat):
+        result = measure(func, repeat)
+        result["size"] = size
+        results["{0}[{1}]".format(name, size)] = result
+        print("{0:<36}{1:>10}{2:>12.5f}{3:>12.5f}".format(
+            name, size, result["min"], result["median"]), flush=True)
+
+    print("{0:<36}{1:>10}{2:>12}{3:>12}".format("benchmark", "size", "min s", "median s"))
+    backend = NullRenderBackend() if render_backend == "null" else None
+    renderer = ImageRenderer(backend, workers=config.CHART_RENDER_WORKERS,
+                             scale=config.CHART_RENDER_SCALE)
+    try:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for size in sizes:
+                payload = json.dumps(synthetic_records(size)).encode("utf-8")
+                dp = DataProcessor.initialize(payload, config.DATE_FORMAT)
+                repeat = repeat_for(size)
+                for name, func in data_cases(payload, dp):
+                    record(name, size, func, repeat)
+                lines = min(size, THREAD_MAX_LINES)
+                record("ThreadTwitter.tweet", lines, thread_case(lines), repeat)
+                if size <= CHARTS_MAX_ROWS:
+                    localized = dp.copy()
+                    localized.localize_dates("UTC", "Europe/Rome")
+                    for name, func in chart_cases(localized, renderer, Path(tmp_dir)):
+                        record(name, size, func, repeat)
+                del payload
+                del dp
+    finally:
+        renderer.shutdown()
+    return results
+
+
+def compare(results, baseline, threshold=REGRESSION_THRESHOLD, min_seconds=REGRESSION_MIN_SECONDS):
+    # Returns the benchmarks whose best run got slower by more than threshold
+    # times, the minimum being the timing least affected by other load
+    regressions = []
+    for name, result in results.items():
+        previous = baseline.get(name)
+        if previous is None or previous["min"] <= 0:
+            continue
+        ratio = result["min"] / previous["min"]
+        if ratio > threshold and result["min"] - previous["min"] > min_seconds:
+            regressions.append((name, previous["min"], result["min"], ratio))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks of the daily cycle hot paths")
+    parser.add_argument("--sizes", default=",".join(str(size) for size in DEFAULT_SIZES),
+                        help="comma separated dataset sizes, up to 1000000")
+    parser.add_argument("--render-backend", choices=["null", "orca"], default="null")
+    parser.add_argument("--output", help="JSON file the results are saved to")
+    parser.add_argument("--baseline", help="JSON results of a previous run to compare with")
+    parser.add_argument("--threshold", type=float, default=REGRESSION_THRESHOLD)
+    args = parser.parse_args()
+
+    # Importing bot.__main__ turns on the debug logs of the bot
+    logging.getLogger("bot").setLevel(logging.WARNING)
+    sizes = [int(size) for size in args.sizes.split(",")]
+    results = run(sizes, args.render_backend)
+    report = {
+        "meta": {
+            "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "render_backend": args.render_backend
+        },
+        "results": results
+    }
+    if args.output is not None:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2)
+
+    if args.baseline is not None:
+        with open(args.baseline, "r") as file:
+            baseline = json.load(file)["results"]
+        regressions = compare(results, baseline, args.threshold)
+        for name, previous, current, ratio in regressions:
+            print("REGRESSION {0}: {1:.5f}s -> {2:.5f}s ({3:.2f}x)".format(
+                name, previous, current, ratio))
+        if len(regressions) > 0:
+            sys.exit(1)
+        print("No regressions against " + args.baseline)
+
+
+if __name__ == "__main__":
+    main()
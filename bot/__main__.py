@@ -1,65 +1,117 @@
 import datetime
+import gc
+import io
 import logging
 import os
+import re
 import time
-from pathlib import Path
-
-import plotly.graph_objects as go
-import plotly.io
-import pytz
-import requests
-import schedule
-import twitter
+
 from dotenv import load_dotenv
-from plotly.subplots import make_subplots
-from requests.exceptions import RequestException
 
 from bot import config
+from bot import memory
+from bot import metrics
+from bot import worker
+from bot.charts import ChartBuilder
+from bot.charts import ChartManager
+from bot.charts import ChartSpec
+from bot.charts import ImageRenderer
+from bot.charts import RenderCache
+from bot.charts import TraceSpec
+from bot.fetch import ConditionalFetcher
+from bot.twitter import ThreadCheckpoint
 from bot.twitter import ThreadTwitter
+from bot.twitter import PythonTwitterBackend
 from bot.twitter import MediaType
-from bot.indicators import (DeltaIndicator, DeltaPercentageIndicator,
-                            MovingAverageIndicator)
+from bot.memory import MemoryProfiler
+from bot.indicators import (DeltaIndicator, DeltaPercentageIndicator, IndicatorCache,
+                            MovingAverageIndicator, StreamingIndicatorStore)
 from bot.processing import DataProcessor
 from bot.processing import InvalidDataFormatException
+from bot.pipeline import StageTimer
+from bot.pipeline import run_overlapped
+from bot.scheduling import AdaptiveScheduler
 
 # Global variables / constants
 
 DEBUG_MODE = False
+# Publishing runs in a short-lived worker process, see run_task
+SUPERVISOR_MODE = False
+WORKER_MODULE = "bot.__main__"
+
+data_fetcher = None
+data_processor = None
+regional_data_fetcher = None
+regional_data_processor = None
+memory_profiler = None
+indicator_cache = IndicatorCache()
+image_renderer = ImageRenderer(workers=config.CHART_RENDER_WORKERS,
+                               scale=config.CHART_RENDER_SCALE,
+                               max_renders=config.CHART_RENDERER_MAX_RENDERS,
+                               cache=RenderCache(config.RENDER_CACHE_PATH,
+                                                 max_bytes=config.RENDER_CACHE_MAX_BYTES,
+                                                 max_age=config.RENDER_CACHE_MAX_AGE_SECONDS))
 
 CHART_BLUE = "#636EFA"
 CHART_BLUE_TRANSPARENT = "rgba(97, 107, 250, 0.4)"
 CHART_RED = "#EF553B"
 CHART_GREEN = "#00CC96"
 
+MOVING_AVG_DAYS = 5
+
+CHART_SPECS = [
+    ChartSpec("COVID2019 {area} - contagiati attivi, deceduti e guariti", [
+        TraceSpec(TraceSpec.SCATTER, "Contagiati Attivi",
+                  "dates", "positives_active", CHART_BLUE),
+        TraceSpec(TraceSpec.SCATTER, "Deceduti", "dates", "deaths", CHART_RED),
+        TraceSpec(TraceSpec.SCATTER, "Guariti", "dates", "healed", CHART_GREEN)
+    ], xaxes=dict(nticks=60)),
+    ChartSpec("COVID2019 {area} - ospedalizzati e isolamento domiciliare dei positivi", [
+        TraceSpec(TraceSpec.BAR, "Ospedalizzati TI",
+                  "dates", "icu", CHART_RED, subplot=1),
+        TraceSpec(TraceSpec.BAR, "Ospedalizzati Non TI",
+                  "dates", "non_icu", CHART_BLUE, subplot=2),
+        TraceSpec(TraceSpec.BAR, "Isolamento Domiciliare",
+                  "dates", "home_isolated", CHART_GREEN, subplot=3)
+    ], subplots=3, layout=dict(bargap=0), xaxes=dict(nticks=10)),
+    ChartSpec("COVID2019 {area} - tamponi effettuati giornalmente e nuovi infetti", [
+        TraceSpec(TraceSpec.BAR, "Tamponi Effettuati",
+                  "dates", "tests", CHART_BLUE),
+        TraceSpec(TraceSpec.BAR, "Nuovi Infetti",
+                  "dates", "new_positives", CHART_RED)
+    ], layout=dict(barmode="group", bargap=0), xaxes=dict(rangemode="normal", nticks=60)),
+    ChartSpec("COVID2019 {{area}} - nuovi guariti, morti, infetti [media mobile {0}gg]".format(MOVING_AVG_DAYS), [
+        TraceSpec(TraceSpec.SCATTER, "Infetti", "dates_moving_avg",
+                  "new_positives_moving_avg", CHART_BLUE),
+        TraceSpec(TraceSpec.SCATTER, "Guariti", "dates_moving_avg",
+                  "new_healed_moving_avg", CHART_GREEN),
+        TraceSpec(TraceSpec.SCATTER, "Morti", "dates_moving_avg",
+                  "new_deaths_moving_avg", CHART_RED)
+    ], xaxes=dict(nticks=60))
+]
+
+TWEET_DATA_LINES = [
+    ("Casi attivi", "total_active_positives"),
+    ("Nuovi positivi", "new_infected"),
+    ("Guariti/dimessi", "total_recovered"),
+    ("Isolamento domiciliare", "total_home_confinement"),
+    ("Ospedalizzati", "total_hospitalized"),
+    ("Terapie intensive", "total_intensive_care"),
+    ("Morti", "total_deaths"),
+    ("Tamponi", "total_tests"),
+    ("Casi totali", "total_cases")
+]
+
 # Logger setup
 
 log = logging.getLogger(__name__)
 handler = logging.StreamHandler()
 handler.setFormatter(logging.Formatter(
     "%(asctime)s - %(levelname)s - %(module)s - %(message)s"))
-log.setLevel(logging.DEBUG)
-log.addHandler(handler)
-
-# Classes
-
-
-class ChartManager:
-
-    def __init__(self):
-        self.charts = []
-
-    def add(self, chart: go.Figure):
-        self.charts.append(chart)
-
-    def generate_images(self, path: Path):
-        images_paths = []
-        for i in range(0, len(self.charts)):
-            fname = "chart_" + str(i) + ".png"
-            fpath = str(path / fname)
-            self.charts[i].write_image(fpath)
-            log.debug("Done creating " + fpath)
-            images_paths.append(fpath)
-        return images_paths
+for logger in [log, logging.getLogger("bot")]:
+    logger.setLevel(logging.DEBUG)
+    logger.addHandler(handler)
+log.propagate = False
 
 # Functions
 
@@ -73,96 +125,70 @@ def get_trend_icon(value):
         return "📉"
 
 
-def tweet_updates(dp: DataProcessor, chart_paths):
-    active_total_cases = dp.get("total_active_positives", start=dp.size() - 2)
-    active_total_cases_delta = DeltaIndicator(active_total_cases).get_last()
-    active_total_cases_delta_percentage = DeltaPercentageIndicator(
-        active_total_cases).get_last()
-    new_positives = dp.get("new_infected", start=dp.size() - 2)
-    new_positives_delta = DeltaIndicator(new_positives).get_last()
-    new_positives_delta_percentage = DeltaPercentageIndicator(
-        new_positives).get_last()
-    healed = dp.get("total_recovered", start=dp.size() - 2)
-    healed_delta = DeltaIndicator(healed).get_last()
-    healed_delta_percentage = DeltaPercentageIndicator(healed).get_last()
-    home_confinement = dp.get("total_home_confinement", start=dp.size() - 2)
-    home_confinement_delta = DeltaIndicator(home_confinement).get_last()
-    home_confinement_delta_percentage = DeltaPercentageIndicator(
-        home_confinement).get_last()
-    total_hospitalized = dp.get("total_hospitalized", start=dp.size() - 2)
-    total_hospitalized_delta = DeltaIndicator(total_hospitalized).get_last()
-    total_hospitalized_delta_percentage = DeltaPercentageIndicator(
-        total_hospitalized).get_last()
-    total_ic = dp.get("total_intensive_care", start=dp.size() - 2)
-    total_ic_delta = DeltaIndicator(total_ic).get_last()
-    total_ic_delta_percentage = DeltaPercentageIndicator(total_ic).get_last()
-    total_deaths = dp.get("total_deaths", start=dp.size() - 2)
-    total_deaths_delta = DeltaIndicator(total_deaths).get_last()
-    total_deaths_delta_percentage = DeltaPercentageIndicator(
-        total_deaths).get_last()
-    tests = dp.get("total_tests", start=dp.size() - 2)
-    tests_delta = DeltaIndicator(tests).get_last()
-    test_delta_percentage = DeltaPercentageIndicator(tests).get_last()
-    total_cases = dp.get("total_cases", start=dp.size() - 2)
-    total_cases_delta = DeltaIndicator(total_cases).get_last()
-    total_cases_percentage = DeltaPercentageIndicator(total_cases).get_last()
-
-    tt = ThreadTwitter(os.getenv("TWITTER_CONSUMER_API_KEY"),
-                       os.getenv("TWITTER_CONSUMER_SECRET_KEY"),
-                       os.getenv("TWITTER_ACCESS_TOKEN_KEY"),
-                       os.getenv("TWITTER_ACCESS_TOKEN_SECRET_KEY"))
-
+def create_thread_twitter():
+    # TWITTER_API_URL points the bot to a stand-in server (see bot.fake_twitter)
+    api_url = os.getenv("TWITTER_API_URL")
+    backend = PythonTwitterBackend(os.getenv("TWITTER_CONSUMER_API_KEY"),
+                                   os.getenv("TWITTER_CONSUMER_SECRET_KEY"),
+                                   os.getenv("TWITTER_ACCESS_TOKEN_KEY"),
+                                   os.getenv("TWITTER_ACCESS_TOKEN_SECRET_KEY"),
+                                   base_url=api_url, upload_url=api_url)
+    tt = ThreadTwitter(backend=backend,
+                       upload_workers=config.UPLOAD_WORKERS,
+                       upload_retries=config.UPLOAD_RETRIES,
+                       post_retries=config.POST_RETRIES)
     tt.set_header("🦠🇮🇹 Aggiornamento Giornaliero #COVID2019", repeat=False)
     tt.set_footer("Generato da: http://tiny.cc/covid-bot", repeat=False)
+    return tt
+
+
+def create_tweet_lines(dp: DataProcessor, cache: IndicatorCache):
+    # Values and deltas are shared with the charts through the cache, the
+    # deltas it has not computed yet come from the streaming indicators
+    # saved between cycles (only the rows added since the previous update
+    # are pushed to them)
+    store = StreamingIndicatorStore(config.INDICATOR_STATE_PATH)
     data_lines = []
-    data_lines.append("{0} Casi attivi: {1} ({2:+d}) ({3:+.2f}%)".format(get_trend_icon(active_total_cases_delta),
-                                                                         active_total_cases[1],
-                                                                         active_total_cases_delta,
-                                                                         active_total_cases_delta_percentage))
-    data_lines.append("{0} Nuovi positivi: {1} ({2:+d}) ({3:+.2f}%)".format(get_trend_icon(new_positives_delta),
-                                                                            new_positives[1],
-                                                                            new_positives_delta,
-                                                                            new_positives_delta_percentage))
-    data_lines.append("{0} Guariti/dimessi: {1} ({2:+d}) ({3:+.2f}%)".format(get_trend_icon(healed_delta),
-                                                                             healed[1],
-                                                                             healed_delta,
-                                                                             healed_delta_percentage))
-    data_lines.append("{0} Isolamento domiciliare: {1} ({2:+d}) ({3:+.2f}%)".format(get_trend_icon(home_confinement_delta),
-                                                                                    home_confinement[1],
-                                                                                    home_confinement_delta,
-                                                                                    home_confinement_delta_percentage))
-    data_lines.append("{0} Ospedalizzati: {1} ({2:+d}) ({3:+.2f}%)".format(get_trend_icon(total_hospitalized_delta),
-                                                                           total_hospitalized[1], total_hospitalized_delta,
-                                                                           total_hospitalized_delta_percentage))
-    data_lines.append("{0} Terapie intensive: {1} ({2:+d}) ({3:+.2f}%)".format(get_trend_icon(total_ic_delta),
-                                                                               total_ic[1],
-                                                                               total_ic_delta,
-                                                                               total_ic_delta_percentage))
-    data_lines.append("{0} Morti: {1} ({2:+d}) ({3:+.2f}%)".format(get_trend_icon(total_deaths_delta),
-                                                                   total_deaths[1],
-                                                                   total_deaths_delta,
-                                                                   total_deaths_delta_percentage))
-    data_lines.append("{0} Tamponi: {1} ({2:+d}) ({3:+.2f}%)".format(get_trend_icon(tests_delta),
-                                                                     tests[1],
-                                                                     tests_delta,
-                                                                     test_delta_percentage))
-    data_lines.append("{0} Casi totali: {1} ({2:+d}) ({3:+.2f}%)".format(get_trend_icon(total_cases_delta),
-                                                                         total_cases[1],
-                                                                         total_cases_delta,
-                                                                         total_cases_percentage))
+    for label, key in TWEET_DATA_LINES:
+        value = cache.get_series(dp, key)[-1]
+        delta = cache.get_last(dp, key, DeltaIndicator, store=store)
+        delta_percentage = cache.get_last(dp, key, DeltaPercentageIndicator, store=store)
+        data_lines.append("{0} {1}: {2} ({3:+d}) ({4:+.2f}%)".format(get_trend_icon(delta),
+                                                                     label,
+                                                                     value,
+                                                                     delta,
+                                                                     delta_percentage))
+    try:
+        store.save()
+    except IOError as e:
+        log.warning("Could not save the indicator state: " + str(e))
+    return data_lines
 
+
+def post_thread(tt: ThreadTwitter, data_lines, media, timer: StageTimer, checkpoint: ThreadCheckpoint):
     for line in data_lines:
         tt.add_line(line)
-    for chart_p in chart_paths:
-        tt.add_media(chart_p, MediaType.PHOTO)
+    for m in media:
+        tt.add_media(m, MediaType.PHOTO)
 
     if not DEBUG_MODE:
-        tt.tweet()
+        tt.tweet(on_posted=lambda i, status_id: timer.mark("first_tweet"),
+                 checkpoint=checkpoint)
     else:
-        lines_concat = ""
-        for line in data_lines:
-            lines_concat = lines_concat + "\n" + line
-        log.debug(lines_concat)
+        for i, planned in enumerate(tt.plan()):
+            log.debug("Tweet {0} ({1} chars, media {2}):\n{3}".format(
+                i, planned.length, planned.media, planned.text))
+
+
+def tweet_updates(dp: DataProcessor, chart_paths, cache: IndicatorCache, timer: StageTimer,
+                  checkpoint: ThreadCheckpoint):
+    with timer.stage("compose"):
+        data_lines = create_tweet_lines(dp, cache)
+    tt = create_thread_twitter()
+    try:
+        timer.timed("post", post_thread, tt, data_lines, chart_paths, timer, checkpoint)
+    finally:
+        tt.close()
 
 
 def read_last_date_updated(fpath):
@@ -182,216 +208,344 @@ def write_last_date_updated(fpath, date):
         log.error(e)
 
 
-def generate_graphs(dp: DataProcessor):
+def build_charts(dp: DataProcessor, cache: IndicatorCache, area="Italia"):
     # Prepares data to generate charts
-    dates = list(map(lambda x: x.date(), dp.get("date")))
-    positives_active = dp.get("total_active_positives")
-    deaths = dp.get("total_deaths")
-    healed = dp.get("total_recovered")
-    icu = dp.get("total_intensive_care")
-    non_icu = dp.get("total_hospitalized_non_ic")
-    home_isolated = dp.get("total_home_confinement")
-    new_positives = dp.get("new_infected")
-    tests = DeltaIndicator(dp.get("total_tests")).get_all()
-    new_healed = DeltaIndicator(dp.get("total_recovered")).get_all()
-    new_deaths = DeltaIndicator(dp.get("total_deaths")).get_all()
-
-    MOVING_AVG_DAYS = 5
-
-    new_healed_moving_avg = MovingAverageIndicator(
-        new_healed, MOVING_AVG_DAYS).get_all()[MOVING_AVG_DAYS - 1:]
-    new_deaths_moving_avg = MovingAverageIndicator(
-        new_deaths, MOVING_AVG_DAYS).get_all()[MOVING_AVG_DAYS - 1:]
-    new_positives_moving_avg = MovingAverageIndicator(
-        new_positives, MOVING_AVG_DAYS).get_all()[MOVING_AVG_DAYS - 1:]
-    dates_moving_avg = dates[MOVING_AVG_DAYS - 1:]
-
-    # Prepare to make charts
-
-    plotly.io.orca.config.default_scale = 2.0
-    config.TEMP_FILES_PATH.mkdir(parents=True, exist_ok=True)
-    chart_mgr = ChartManager()
+    dates = list(map(lambda x: x.date(), cache.get_series(dp, "date")))
+    positives_active = cache.get_series(dp, "total_active_positives")
+    deaths = cache.get_series(dp, "total_deaths")
+    healed = cache.get_series(dp, "total_recovered")
+    icu = cache.get_series(dp, "total_intensive_care")
+    non_icu = cache.get_series(dp, "total_hospitalized_non_ic")
+    home_isolated = cache.get_series(dp, "total_home_confinement")
+    new_positives = cache.get_series(dp, "new_infected")
+    tests = cache.get_all(dp, "total_tests", DeltaIndicator)
+    new_healed = ("total_recovered", DeltaIndicator)
+    new_deaths = ("total_deaths", DeltaIndicator)
+
+    new_healed_moving_avg = cache.get_all(
+        dp, new_healed, MovingAverageIndicator, MOVING_AVG_DAYS)[MOVING_AVG_DAYS - 1:]
+    new_deaths_moving_avg = cache.get_all(
+        dp, new_deaths, MovingAverageIndicator, MOVING_AVG_DAYS)[MOVING_AVG_DAYS - 1:]
+    new_positives_moving_avg = cache.get_all(
+        dp, "new_infected", MovingAverageIndicator, MOVING_AVG_DAYS)[MOVING_AVG_DAYS - 1:]
+
+    series = {
+        "dates": dates,
+        "dates_moving_avg": dates[MOVING_AVG_DAYS - 1:],
+        "positives_active": positives_active,
+        "deaths": deaths,
+        "healed": healed,
+        "icu": icu,
+        "non_icu": non_icu,
+        "home_isolated": home_isolated,
+        "new_positives": new_positives,
+        "tests": tests,
+        "new_positives_moving_avg": new_positives_moving_avg,
+        "new_healed_moving_avg": new_healed_moving_avg,
+        "new_deaths_moving_avg": new_deaths_moving_avg
+    }
+
+    # Make charts
+
     data_time_str = dates[len(dates) - 1].strftime("%d/%m/%Y")
     charts_footer = ("<br>Fonte dati: Protezione Civile Italiana + elaborazioni ({0})"
                      "<br>Generato da: github.com/berna1995/CovidDailyUpdateBot").format(data_time_str)
 
-    # Make charts
-    # Chart 1
-    graph = go.Figure()
-    graph.add_trace(go.Scatter(x=dates, y=positives_active, mode="lines+markers",
-                               name="Contagiati Attivi", line=dict(color=CHART_BLUE)))
-    graph.add_trace(go.Scatter(x=dates, y=deaths, mode="lines+markers",
-                               name="Deceduti", line=dict(color=CHART_RED)))
-    graph.add_trace(go.Scatter(x=dates, y=healed, mode="lines+markers",
-                               name="Guariti", line=dict(color=CHART_GREEN)))
-    graph.update_layout(
-        title="COVID2019 Italia - contagiati attivi, deceduti e guariti",
-        title_x=0.5,
-        showlegend=True,
-        autosize=True,
-        legend=dict(orientation="h", xanchor="center",
-                    yanchor="top", x=0.5, y=-0.25),
-        margin=dict(l=30, r=30, t=60, b=150)
-    )
-    graph.update_yaxes(rangemode="normal", automargin=True, ticks="outside")
-    graph.update_xaxes(tickangle=90, type="date", tickformat='%d-%m-%y',
-                       ticks="outside", tickmode="auto", nticks=60, automargin=True)
-    graph.add_annotation(
-        xref="paper",
-        yref="paper",
-        x=0,
-        yanchor="top",
-        xanchor="left",
-        align="left",
-        y=-0.36,
-        showarrow=False,
-        font=dict(size=10),
-        text=charts_footer
-    )
-    chart_mgr.add(graph)
-
-    # Chart 2
-    graph = make_subplots(rows=1, cols=3)
-    graph.add_trace(go.Bar(x=dates, y=icu, name="Ospedalizzati TI",
-                           marker=dict(color=CHART_RED)), row=1, col=1)
-    graph.add_trace(go.Bar(x=dates, y=non_icu, name="Ospedalizzati Non TI",
-                           marker=dict(color=CHART_BLUE)), row=1, col=2)
-    graph.add_trace(go.Bar(x=dates, y=home_isolated,
-                           name="Isolamento Domiciliare", marker=dict(color=CHART_GREEN)), row=1, col=3)
-    graph.update_layout(
-        title="COVID2019 Italia - ospedalizzati e isolamento domiciliare dei positivi",
-        title_x=0.5,
-        showlegend=True,
-        autosize=True,
-        legend=dict(orientation="h", xanchor="center",
-                    yanchor="top", x=0.5, y=-0.25),
-        margin=dict(l=30, r=30, t=60, b=150),
-        bargap=0
-    )
-    graph.update_yaxes(rangemode="normal", automargin=True, ticks="outside")
-    graph.update_xaxes(tickangle=90, type="date", tickformat='%d-%m-%y', ticks="outside",
-                       nticks=10, tickmode="auto", automargin=True)
-    graph.add_annotation(
-        xref="paper",
-        yref="paper",
-        x=0,
-        yanchor="top",
-        xanchor="left",
-        align="left",
-        y=-0.36,
-        showarrow=False,
-        font=dict(size=10),
-        text=charts_footer
-    )
-    chart_mgr.add(graph)
-
-    # Chart 3
-    graph = go.Figure()
-    graph.add_trace(go.Bar(x=dates, y=tests, name="Tamponi Effettuati",
-                           marker=dict(color=CHART_BLUE)))
-    graph.add_trace(go.Bar(x=dates, y=new_positives,
-                           name="Nuovi Infetti", marker=dict(color=CHART_RED)))
-    graph.update_layout(
-        title="COVID2019 Italia - tamponi effettuati giornalmente e nuovi infetti",
-        title_x=0.5,
-        showlegend=True,
-        autosize=True,
-        legend=dict(orientation="h", xanchor="center",
-                    yanchor="top", x=0.5, y=-0.25),
-        margin=dict(l=30, r=30, t=60, b=150),
-        barmode="group",
-        bargap=0
-    )
-    graph.update_yaxes(rangemode="normal", automargin=True, ticks="outside")
-    graph.update_xaxes(tickangle=90, type="date", tickformat='%d-%m-%y', ticks="outside",
-                       rangemode="normal", tickmode="auto", nticks=60, automargin=True)
-    graph.add_annotation(
-        xref="paper",
-        yref="paper",
-        x=0,
-        yanchor="top",
-        xanchor="left",
-        align="left",
-        y=-0.36,
-        showarrow=False,
-        font=dict(size=10),
-        text=charts_footer
-    )
-    chart_mgr.add(graph)
-
-    # Chart 4
-    graph = go.Figure()
-    graph.add_trace(go.Scatter(x=dates_moving_avg, y=new_positives_moving_avg, mode="lines+markers",
-                               name="Infetti", line=dict(color=CHART_BLUE)))
-    graph.add_trace(go.Scatter(x=dates_moving_avg, y=new_healed_moving_avg, mode="lines+markers",
-                               name="Guariti", line=dict(color=CHART_GREEN)))
-    graph.add_trace(go.Scatter(x=dates_moving_avg, y=new_deaths_moving_avg, mode="lines+markers",
-                               name="Morti", line=dict(color=CHART_RED)))
-    graph.update_layout(
-        title="COVID2019 Italia - nuovi guariti, morti, infetti [media mobile {0}gg]".format(
-            MOVING_AVG_DAYS),
-        title_x=0.5,
-        showlegend=True,
-        autosize=True,
-        legend=dict(orientation="h", xanchor="center",
-                    yanchor="top", x=0.5, y=-0.25),
-        margin=dict(l=30, r=30, t=60, b=150)
-    )
-    graph.update_yaxes(rangemode="normal", automargin=True, ticks="outside")
-    graph.update_xaxes(tickangle=90, type="date", tickformat='%d-%m-%y',
-                       ticks="outside", tickmode="auto", nticks=60, automargin=True)
-    graph.add_annotation(
-        xref="paper",
-        yref="paper",
-        x=0,
-        yanchor="top",
-        xanchor="left",
-        align="left",
-        y=-0.36,
-        showarrow=False,
-        font=dict(size=10),
-        text=charts_footer
-    )
-    chart_mgr.add(graph)
-
-    gen_paths = chart_mgr.generate_images(config.TEMP_FILES_PATH)
-    plotly.io.orca.shutdown_server()
-    return gen_paths
+    chart_builder = ChartBuilder(charts_footer)
+    chart_mgr = ChartManager()
+    for spec in CHART_SPECS:
+        chart_mgr.add(chart_builder.build(spec, series, title=spec.title.format(area=area)))
+    return chart_mgr
+
+
+def generate_graphs(dp: DataProcessor, cache: IndicatorCache, timer: StageTimer):
+    chart_mgr = timer.timed("build", build_charts, dp, cache)
+    config.TEMP_FILES_PATH.mkdir(parents=True, exist_ok=True)
+    paths = timer.timed("render", chart_mgr.generate_images, config.TEMP_FILES_PATH,
+                        image_renderer)
+    chart_mgr.clear()
+    return paths
+
+
+def publish_overlapped(dp: DataProcessor, cache: IndicatorCache, timer: StageTimer,
+                       checkpoint: ThreadCheckpoint):
+    tt = create_thread_twitter()
+    chart_mgr = timer.timed("build", build_charts, dp, cache)
+    config.TEMP_FILES_PATH.mkdir(parents=True, exist_ok=True)
+
+    def render(on_rendered):
+        return chart_mgr.generate_images(config.TEMP_FILES_PATH, image_renderer, on_rendered)
+
+    def upload(path):
+        return path if DEBUG_MODE else tt.upload_media(path)
+
+    try:
+        run_overlapped(render, upload, lambda: create_tweet_lines(dp, cache),
+                       lambda data_lines, media: post_thread(
+                           tt, data_lines, media, timer, checkpoint),
+                       timer, upload_workers=config.UPLOAD_WORKERS)
+    finally:
+        chart_mgr.clear()
+        tt.close()
+
+
+def area_directory(name):
+    return re.sub(r"[^a-z0-9]+", "_", name.lower()).strip("_")
+
+
+def generate_regional_charts(timer: StageTimer):
+    # Same charts as the national ones, for every region. They all go to the
+    # renderer at once so that its process pool is kept busy.
+    global regional_data_fetcher
+    global regional_data_processor
+    if regional_data_fetcher is None:
+        regional_data_fetcher = ConditionalFetcher(config.REGIONAL_DATA_JSON_URL,
+                                                   config.FETCH_CACHE_PATH,
+                                                   timeout=config.FETCH_TIMEOUT_SECONDS)
+    req = timer.timed("fetch_regions", regional_data_fetcher.fetch,
+                      require_content=regional_data_processor is None)
+    if req.status_code != 200 and req.status_code != 304:
+        log.warning("Got {0} status code for regional data.".format(req.status_code))
+        return
+    if req.status_code == 304 and not req.content:
+        # The charts of this data may still have to be rendered, e.g. if
+        # the previous attempt failed after the fetcher saved its validators
+        log.info("Regional data not modified.")
+    elif regional_data_processor is None:
+        # The regional history is about 20 times the national one: its
+        # entries are decoded one at a time instead of all at once
+        regional_data_processor = timer.timed("parse_regions", DataProcessor.initialize_stream,
+                                              io.BytesIO(req.content), config.DATE_FORMAT,
+                                              regional=True)
+    else:
+        timer.timed("parse_regions", regional_data_processor.merge,
+                    req.content, config.DATE_FORMAT)
+
+    last_data_date = regional_data_processor.last_date()
+    last_exec_date = read_last_date_updated(
+        config.REGIONAL_LATEST_EXECUTION_DATE_FILE_PATH)
+    if last_exec_date is not None and last_data_date <= last_exec_date and not DEBUG_MODE:
+        log.info("Regional charts are up to date.")
+        return
+    run_task(render_regional_charts, (regional_data_processor,), timer)
+    if not DEBUG_MODE:
+        write_last_date_updated(
+            config.REGIONAL_LATEST_EXECUTION_DATE_FILE_PATH, last_data_date)
+
+
+def update_regional_charts(timer: StageTimer, national_date):
+    # Also called by the polls with no national update, until the charts
+    # catch up with the national data
+    if not config.REGIONAL_CHARTS:
+        return
+    last_exec_date = read_last_date_updated(
+        config.REGIONAL_LATEST_EXECUTION_DATE_FILE_PATH)
+    if last_exec_date is not None and national_date <= last_exec_date and not DEBUG_MODE:
+        return
+    try:
+        generate_regional_charts(timer)
+    except Exception as err:
+        # National updates do not depend on them
+        metrics.inc("regional_chart_errors")
+        log.error("Could not generate regional charts: " + str(err))
+
+
+def render_regional_charts(dp: DataProcessor, timer: StageTimer):
+    dp = dp.copy()
+    timer.timed("localize_regions", dp.localize_dates, "UTC", "Europe/Rome",
+                config.TIMEZONE_BACKEND)
+    figures = []
+    paths = []
+    with timer.stage("build_regions"):
+        for name, region_dp in dp.group_by("region_name").items():
+            chart_mgr = build_charts(region_dp, IndicatorCache(), area=name)
+            path = config.REGIONAL_CHARTS_PATH / area_directory(name)
+            path.mkdir(parents=True, exist_ok=True)
+            figures.extend(chart_mgr.charts)
+            paths.extend(chart_mgr.image_paths(path))
+    timer.timed("render_regions", image_renderer.render_all, figures, paths)
+    figures.clear()
+    log.info("Generated {0} regional charts.".format(len(paths)))
 
 
 def check_for_new_data():
     log.info("Checking for new data...")
 
+    global data_fetcher
+    global data_processor
+    timer = StageTimer(metrics.registry)
+    if data_fetcher is None:
+        data_fetcher = ConditionalFetcher(config.NATIONAL_DATA_JSON_URL,
+                                          config.FETCH_CACHE_PATH,
+                                          timeout=config.FETCH_TIMEOUT_SECONDS)
+
+    # Imported along with the fetcher, plotly and python-twitter wait for
+    # new data to publish
+    from requests.exceptions import RequestException
     try:
-        req = requests.get(config.NATIONAL_DATA_JSON_URL)
+        req = timer.timed("fetch", data_fetcher.fetch,
+                          require_content=data_processor is None)
     except RequestException as req:
+        metrics.inc("fetch_errors")
         log.error("Error occurred while requesting data: " + str(req))
-        return
+        return False
+    metrics.inc("fetch_responses", status=req.status_code)
 
-    if req.status_code == 200:
+    if req.status_code != 200 and req.status_code != 304:
+        log.warning("Got {0} status code.".format(req.status_code))
+        return False
+    if req.status_code == 304 and not req.content:
+        stats = data_fetcher.stats()
+        log.info("Data not modified ({0} bytes and {1:.2f}s saved so far).".format(
+            stats["bytes_saved"], stats["time_saved"]))
+        if data_processor is None:
+            return False
+        # The data may still be waiting to be published, e.g. if the
+        # previous attempt failed after the fetcher saved its validators
+    else:
         try:
-            dp = DataProcessor.initialize(req.content, config.DATE_FORMAT)
+            if data_processor is None:
+                data_processor = timer.timed("parse", DataProcessor.initialize,
+                                             req.content, config.DATE_FORMAT)
+            else:
+                new_entries = timer.timed("parse", data_processor.merge,
+                                          req.content, config.DATE_FORMAT)
+                log.debug("Merged {0} new entries.".format(new_entries))
         except InvalidDataFormatException as err:
+            metrics.inc("invalid_data")
             log.error("Received invalid data: " + str(err))
-            return
-
-        last_data_date = dp.get("date", start=dp.size() - 1)[0]
-        last_exec_date = read_last_date_updated(
-            config.LATEST_EXECUTION_DATE_FILE_PATH)
-
-        if last_exec_date is None or last_data_date > last_exec_date or DEBUG_MODE:
-            log.info("New data found, processing and tweeting...")
-            dp.localize_dates("UTC", "Europe/Rome")
-            charts_paths = generate_graphs(dp)
-            tweet_updates(dp, charts_paths)
-            if not DEBUG_MODE:
-                write_last_date_updated(
-                    config.LATEST_EXECUTION_DATE_FILE_PATH, last_data_date)
-            log.info("New data tweeted successfully.")
-        else:
-            log.info("No updates found.")
+            return False
+        metrics.set_gauge("dataset_rows", data_processor.size())
+
+    last_data_date = data_processor.last_date()
+    last_exec_date = read_last_date_updated(
+        config.LATEST_EXECUTION_DATE_FILE_PATH)
+
+    if last_exec_date is not None and last_data_date <= last_exec_date and not DEBUG_MODE:
+        log.info("No updates found.")
+        update_regional_charts(timer, last_data_date)
+        return False
+
+    checkpoint = ThreadCheckpoint(config.THREAD_CHECKPOINT_PATH,
+                                  last_data_date.strftime(config.DATE_FORMAT),
+                                  max_age=config.THREAD_CHECKPOINT_MAX_AGE_SECONDS,
+                                  max_failures=config.THREAD_CHECKPOINT_MAX_FAILURES)
+    # Raises if the update could not be published, the date is then left as
+    # it is and the next poll tries again
+    run_task(publish_update, (data_processor, checkpoint), timer)
+    log.debug("Stage timings: " + timer.report())
+    if not DEBUG_MODE:
+        write_last_date_updated(
+            config.LATEST_EXECUTION_DATE_FILE_PATH, last_data_date)
+    metrics.inc("updates_published")
+    log.info("New data tweeted successfully.")
+    update_regional_charts(timer, last_data_date)
+    return last_data_date
+
+
+def publish_update(dp: DataProcessor, checkpoint: ThreadCheckpoint, timer: StageTimer):
+    if not DEBUG_MODE and checkpoint.expired():
+        # Its media expired or it keeps being rejected: planned again below,
+        # after the tweets already posted
+        metrics.inc("thread_replans")
+        log.warning("Planning again the thread left incomplete by a previous attempt...")
+    elif not DEBUG_MODE and checkpoint.load() is not None:
+        # A previous attempt planned the thread and uploaded its media
+        log.info("Resuming the thread left incomplete by a previous attempt...")
+        tt = create_thread_twitter()
+        try:
+            timer.timed("post", tt.resume, checkpoint)
+        finally:
+            tt.close()
+        return
+    log.info("New data found, processing and tweeting...")
+    dp = dp.copy()
+    timer.timed("localize", dp.localize_dates, "UTC", "Europe/Rome",
+                config.TIMEZONE_BACKEND)
+    if config.OVERLAPPED_PIPELINE:
+        publish_overlapped(dp, indicator_cache, timer, checkpoint)
     else:
-        log.warning("Got {0} status code.".format(req.status_code))
+        charts_paths = generate_graphs(dp, indicator_cache, timer)
+        tweet_updates(dp, charts_paths, indicator_cache, timer, checkpoint)
+    log.debug("Indicator cache stats: {0}".format(
+        indicator_cache.stats()))
+
+
+def run_task(task, args, timer: StageTimer):
+    # In supervisor mode the poller hands the parsed data over to a worker
+    # process that builds, renders and tweets, then exits: plotly, the
+    # renderer and python-twitter never stay resident in the poller, and a
+    # crash of any of them fails the task instead of killing the poller
+    if not SUPERVISOR_MODE:
+        task(*args, timer)
+        return
+    timer.timed(task.__name__ + "_worker", worker.run, WORKER_MODULE, "worker_task",
+                (task.__name__, timer.elapsed()) + tuple(args), timeout=config.WORKER_TIMEOUT_SECONDS,
+                start_method=config.WORKER_START_METHOD)
+
+
+def worker_task(name, elapsed, *args):
+    # Runs in the worker process started by run_task, its marks count from
+    # the start of the poll like the in-process ones
+    timer = StageTimer(metrics.registry, elapsed=elapsed)
+    try:
+        globals()[name](*args, timer)
+    finally:
+        log.debug("Stage timings: " + timer.report())
+        image_renderer.shutdown()
+
+
+def poll_for_new_data():
+    # Errors are logged and the poll retried at the next deadline, a thread
+    # left incomplete is resumed from its checkpoint
+    metrics.inc("polls")
+    published = None
+    try:
+        with metrics.span("poll"):
+            published = check_for_new_data()
+    except Exception as e:
+        metrics.inc("poll_errors")
+        log.exception("Error occurred while checking for new data: " + str(e))
+        return False
+    finally:
+        # A poll that found nothing new left no figures behind
+        release_cycle(collect=published is not False)
+        write_metrics()
+    if published:
+        # Nothing to render until the next publish window
+        image_renderer.shutdown()
+    return published
+
+
+def release_cycle(collect=True):
+    # Only the data processors outlive a cycle. Figures are reference cycles
+    # (every plotly object points back to its parent) that would otherwise
+    # wait for a full collection, which an idle poller rarely triggers.
+    indicator_cache.clear()
+    if collect:
+        gc.collect()
+    metrics.set_gauge("rss_bytes", memory.rss())
+    if memory_profiler is not None:
+        log.info(MemoryProfiler.format_report(memory_profiler.snapshot()))
+
+
+def write_metrics():
+    # Rewritten after every poll, so that a textfile collector (or anything
+    # reading the JSON) sees fetch, parse, render and post times over time
+    if not config.METRICS:
+        return
+    metrics.set_gauge("last_poll_timestamp_seconds", time.time())
+    try:
+        metrics.registry.write(config.METRICS_PATH, config.METRICS_FORMAT)
+    except IOError as e:
+        log.warning("Could not write metrics: " + str(e))
+
+
+def warm_up_renderer():
+    try:
+        image_renderer.warm_up()
+    except Exception as e:
+        log.warning("Could not warm up the image renderer: " + str(e))
 
 # Main Loop
 
@@ -399,24 +553,54 @@ def check_for_new_data():
 def main():
     load_dotenv(verbose=False, override=False)
 
+    if os.getenv("MEMORY_PROFILE") is not None:
+        log.info("Memory profiling enabled")
+        global memory_profiler
+        memory_profiler = MemoryProfiler(top=config.MEMORY_PROFILE_TOP_SITES,
+                                         frames=config.MEMORY_PROFILE_FRAMES)
+        memory_profiler.start()
+
     if os.getenv("DEBUG") is not None:
         log.debug("Debug mode")
         global DEBUG_MODE
         DEBUG_MODE = True
         check_for_new_data()
+        release_cycle()
+        write_metrics()
+        image_renderer.shutdown()
         exit(0)
 
-    job = schedule.every(config.UPDATE_CHECK_INTERVAL_MINUTES).minutes.do(
-        check_for_new_data)
-    job.run()
+    global SUPERVISOR_MODE
+    SUPERVISOR_MODE = config.SUPERVISOR_MODE
+    if SUPERVISOR_MODE:
+        log.info("Supervisor mode, updates are published by worker processes")
+
+    scheduler = AdaptiveScheduler(config.UPDATE_HISTORY_PATH,
+                                  timezone=config.PUBLISH_TIMEZONE,
+                                  default_window=config.PUBLISH_WINDOW_DEFAULT,
+                                  margin_minutes=config.PUBLISH_WINDOW_MARGIN_MINUTES,
+                                  history_days=config.PUBLISH_HISTORY_DAYS,
+                                  window_interval=config.WINDOW_POLL_INTERVAL_SECONDS,
+                                  max_interval=config.MAX_POLL_INTERVAL_SECONDS,
+                                  warm_up_lead=config.RENDERER_WARM_UP_LEAD_SECONDS)
+    window = scheduler.window()
+    log.info("Publish window {0}-{1} {2}".format(window.start.strftime("%H:%M"),
+                                                 window.end.strftime("%H:%M"),
+                                                 config.PUBLISH_TIMEZONE))
+    # The first check happens right away, as it used to
+    published = poll_for_new_data()
+    if published:
+        scheduler.record_update(data_date=published)
 
-    while True:
-        schedule.run_pending()
-        try:
-            time.sleep(1)
-        except KeyboardInterrupt:
-            log.info("Received SIGINT, closing...")
-            return
+    try:
+        # The renderer of a worker only lives as long as the worker, so in
+        # supervisor mode every publish starts it cold: the warm-up before
+        # the window only applies to the in-process mode, the default
+        scheduler.run(poll_for_new_data, warm_up=None if SUPERVISOR_MODE else warm_up_renderer)
+    except KeyboardInterrupt:
+        log.info("Received SIGINT, closing...")
+        image_renderer.shutdown()
+        return
 
 
 if __name__ == "__main__":
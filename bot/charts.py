@@ -0,0 +1,355 @@
+import hashlib
+import logging
+import multiprocessing
+import os
+import shutil
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from pathlib import Path
+
+log = logging.getLogger(__name__)
+
+
+class TraceSpec:
+
+    SCATTER = "scatter"
+    BAR = "bar"
+
+    def __init__(self, trace_type, name, x, y, color, subplot=1):
+        self.trace_type = trace_type
+        self.name = name
+        self.x = x
+        self.y = y
+        self.color = color
+        self.subplot = subplot
+
+
+class ChartSpec:
+
+    def __init__(self, title, traces, subplots=1, layout=None, xaxes=None):
+        self.title = title
+        self.traces = traces
+        self.subplots = subplots
+        self.layout = layout if layout is not None else {}
+        self.xaxes = xaxes if xaxes is not None else {}
+
+
+class ChartBuilder:
+
+    BASE_LAYOUT = dict(
+        title_x=0.5,
+        showlegend=True,
+        autosize=True,
+        legend=dict(orientation="h", xanchor="center",
+                    yanchor="top", x=0.5, y=-0.25),
+        margin=dict(l=30, r=30, t=60, b=150)
+    )
+    BASE_XAXIS = dict(tickangle=90, type="date", tickformat="%d-%m-%y",
+                      ticks="outside", tickmode="auto", automargin=True)
+    BASE_YAXIS = dict(rangemode="normal", automargin=True, ticks="outside")
+    FOOTER_ANNOTATION = dict(xref="paper", yref="paper", x=0, yanchor="top", xanchor="left",
+                             align="left", y=-0.36, showarrow=False, font=dict(size=10))
+    # Same spacing used by plotly.subplots.make_subplots
+    SUBPLOTS_SPACING = 0.2
+
+    def __init__(self, footer):
+        # Built once and shared by every figure, plotly copies it on use
+        self.__layout = dict(ChartBuilder.BASE_LAYOUT,
+                             annotations=[dict(ChartBuilder.FOOTER_ANNOTATION, text=footer)])
+
+    def build(self, spec: ChartSpec, series: dict, title=None):
+        # plotly takes longer to import than everything else the poller needs
+        import plotly.graph_objects as go
+        data = [self.__build_trace(trace, series, spec.subplots > 1)
+                for trace in spec.traces]
+        layout = dict(self.__layout, title=title if title is not None else spec.title,
+                      **spec.layout)
+        if spec.subplots == 1:
+            layout["xaxis"] = dict(ChartBuilder.BASE_XAXIS, **spec.xaxes)
+            layout["yaxis"] = ChartBuilder.BASE_YAXIS
+            return go.Figure(data=data, layout=layout)
+
+        spacing = ChartBuilder.SUBPLOTS_SPACING / spec.subplots
+        width = (1 - spacing * (spec.subplots - 1)) / spec.subplots
+        for i in range(1, spec.subplots + 1):
+            suffix = str(i) if i > 1 else ""
+            layout["xaxis" + suffix] = dict(ChartBuilder.BASE_XAXIS, anchor="y" + suffix,
+                                            domain=[(i - 1) * (width + spacing),
+                                                    (i - 1) * (width + spacing) + width],
+                                            **spec.xaxes)
+            layout["yaxis" + suffix] = dict(ChartBuilder.BASE_YAXIS, anchor="x" + suffix,
+                                            domain=[0.0, 1.0])
+        return go.Figure(data=data, layout=layout)
+
+    def __build_trace(self, trace: TraceSpec, series: dict, subplots: bool):
+        import plotly.graph_objects as go
+        axes = {}
+        if subplots:
+            suffix = str(trace.subplot) if trace.subplot > 1 else ""
+            axes = dict(xaxis="x" + suffix, yaxis="y" + suffix)
+        if trace.trace_type == TraceSpec.SCATTER:
+            return go.Scatter(x=series[trace.x], y=series[trace.y], mode="lines+markers",
+                              name=trace.name, line=dict(color=trace.color), **axes)
+        if trace.trace_type == TraceSpec.BAR:
+            return go.Bar(x=series[trace.x], y=series[trace.y], name=trace.name,
+                          marker=dict(color=trace.color), **axes)
+        raise ValueError("unknown trace type " + str(trace.trace_type))
+
+
+class OrcaBackend:
+
+    def start(self):
+        import plotly.io
+        plotly.io.orca.ensure_server()
+
+    def stop(self):
+        import plotly.io
+        plotly.io.orca.shutdown_server()
+
+    def is_running(self):
+        import plotly.io
+        return plotly.io.orca.status.state == "running"
+
+    def render(self, figure, fpath, scale):
+        import plotly.io
+        plotly.io.write_image(figure, fpath, scale=scale)
+
+
+# State of a render worker process, see ImageRenderer
+
+_worker_backend = None
+_worker_renders = 0
+
+
+def _init_worker(backend):
+    global _worker_backend
+    _worker_backend = backend
+    _worker_backend.start()
+
+
+def _ping_worker():
+    return _worker_backend.is_running()
+
+
+def _render_in_worker(figure, fpath, scale, max_renders):
+    global _worker_renders
+    if max_renders is not None and _worker_renders >= max_renders:
+        _worker_backend.stop()
+        _worker_backend.start()
+        _worker_renders = 0
+    _worker_backend.render(figure, fpath, scale)
+    _worker_renders = _worker_renders + 1
+
+
+class RenderCache:
+
+    IMAGE_FORMAT = "png"
+
+    def __init__(self, path: Path, max_bytes=None, max_age=None):
+        self.__path = path
+        self.__max_bytes = max_bytes
+        self.__max_age = max_age
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, figure, scale):
+        import plotly.io
+        figure_json = plotly.io.to_json(figure, validate=False)
+        content = "{0}|{1}|{2}".format(
+            figure_json, scale, RenderCache.IMAGE_FORMAT)
+        return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+    def fetch(self, key, fpath):
+        cached_path = self.__entry_path(key)
+        try:
+            shutil.copyfile(cached_path, fpath)
+            os.utime(cached_path)
+        except IOError:
+            self.misses = self.misses + 1
+            log.debug("Render cache miss for " + fpath)
+            return False
+        self.hits = self.hits + 1
+        log.debug("Render cache hit for " + fpath)
+        return True
+
+    def store(self, key, fpath):
+        try:
+            self.__path.mkdir(parents=True, exist_ok=True)
+            shutil.copyfile(fpath, self.__entry_path(key))
+        except IOError as e:
+            log.warning("Could not store rendered image in cache: " + str(e))
+
+    def evict(self):
+        try:
+            entries = [(entry.stat(), entry)
+                       for entry in self.__path.glob("*." + RenderCache.IMAGE_FORMAT)]
+        except IOError:
+            return
+        # Least recently used first
+        entries.sort(key=lambda x: x[0].st_mtime)
+        now = time.time()
+        total_bytes = sum(stat.st_size for stat, _ in entries)
+        for stat, entry in entries:
+            expired = self.__max_age is not None and now - stat.st_mtime > self.__max_age
+            too_big = self.__max_bytes is not None and total_bytes > self.__max_bytes
+            if not expired and not too_big:
+                continue
+            try:
+                entry.unlink()
+                total_bytes = total_bytes - stat.st_size
+            except IOError:
+                pass
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses
+        }
+
+    def __entry_path(self, key):
+        return self.__path / (key + "." + RenderCache.IMAGE_FORMAT)
+
+
+class ImageRenderer:
+
+    def __init__(self, backend=None, workers=1, scale=2.0, max_renders=None, cache=None):
+        self.__backend = backend if backend is not None else OrcaBackend()
+        self.__cache = cache
+        self.__workers = workers
+        self.__scale = scale
+        self.__max_renders = max_renders
+        self.__executor = None
+        self.__started = False
+        self.renders = 0
+        self.restarts = 0
+
+    def warm_up(self):
+        if self.__workers <= 1:
+            if not self.__started:
+                self.__backend.start()
+                self.__started = True
+            return
+        if self.__executor is None:
+            # Renders may start from a thread of the overlapped pipeline while
+            # other threads hold locks (logging, metrics, HTTP pools) that a
+            # forked child would inherit locked
+            self.__executor = ProcessPoolExecutor(max_workers=self.__workers,
+                                                  mp_context=multiprocessing.get_context("spawn"),
+                                                  initializer=_init_worker,
+                                                  initargs=(self.__backend,))
+            for future in [self.__executor.submit(_ping_worker) for _ in range(self.__workers)]:
+                future.result()
+        self.__started = True
+
+    def is_healthy(self):
+        if not self.__started:
+            return False
+        if self.__workers <= 1:
+            return self.__backend.is_running()
+        try:
+            return self.__executor.submit(_ping_worker).result()
+        except BrokenProcessPool:
+            return False
+
+    def restart(self):
+        log.info("Restarting image renderer")
+        self.shutdown()
+        self.restarts = self.restarts + 1
+        self.warm_up()
+
+    def shutdown(self):
+        if self.__executor is not None:
+            self.__executor.shutdown()
+            self.__executor = None
+        elif self.__started:
+            self.__backend.stop()
+        self.__started = False
+
+    def render_all(self, figures, paths, on_rendered=None):
+        # Pending jobs are keyed by index and removed as soon as their image
+        # is available, so a retry never renders or reports an image twice
+        pending = {}
+        for i in range(len(figures)):
+            key = None
+            if self.__cache is not None:
+                key = self.__cache.key(figures[i], self.__scale)
+                if self.__cache.fetch(key, paths[i]):
+                    self.__rendered(i, paths[i], on_rendered)
+                    continue
+            pending[i] = (figures[i], paths[i], key)
+
+        if len(pending) > 0:
+            if not self.__started:
+                self.warm_up()
+            elif not self.is_healthy():
+                self.restart()
+            try:
+                self.__render_pending(pending, on_rendered)
+            except Exception as e:
+                # A crashed backend gets a single second chance
+                log.warning("Image rendering failed ({0}), retrying".format(e))
+                self.restart()
+                self.__render_pending(pending, on_rendered)
+
+        if self.__cache is not None:
+            self.__cache.evict()
+
+    def __render_pending(self, pending, on_rendered):
+        if self.__workers <= 1:
+            for i in list(pending):
+                figure, fpath, key = pending[i]
+                if self.__max_renders is not None and self.renders > 0 and \
+                        self.renders % self.__max_renders == 0:
+                    self.restart()
+                self.__backend.render(figure, fpath, self.__scale)
+                self.__completed(pending, i, on_rendered)
+            return
+
+        # Figures travel to the workers as plain dicts, each image is reported
+        # as soon as it is ready
+        futures = {}
+        for i in pending:
+            figure, fpath, key = pending[i]
+            future = self.__executor.submit(_render_in_worker, figure.to_dict(), fpath,
+                                            self.__scale, self.__max_renders)
+            futures[future] = i
+        for future in as_completed(futures):
+            future.result()
+            self.__completed(pending, futures[future], on_rendered)
+
+    def __completed(self, pending, i, on_rendered):
+        figure, fpath, key = pending.pop(i)
+        self.renders = self.renders + 1
+        if self.__cache is not None:
+            self.__cache.store(key, fpath)
+        self.__rendered(i, fpath, on_rendered)
+
+    def __rendered(self, i, fpath, on_rendered):
+        log.debug("Done creating " + fpath)
+        if on_rendered is not None:
+            on_rendered(i, fpath)
+
+
+class ChartManager:
+
+    def __init__(self):
+        self.charts = []
+
+    def add(self, chart):
+        self.charts.append(chart)
+
+    def clear(self):
+        self.charts.clear()
+
+    def image_paths(self, path: Path):
+        images_paths = []
+        for i in range(0, len(self.charts)):
+            fname = "chart_" + str(i) + ".png"
+            images_paths.append(str(path / fname))
+        return images_paths
+
+    def generate_images(self, path: Path, renderer: ImageRenderer, on_rendered=None):
+        images_paths = self.image_paths(path)
+        renderer.render_all(self.charts, images_paths, on_rendered)
+        return images_paths
@@ -1,8 +1,44 @@
 from pathlib import Path
 
 NATIONAL_DATA_JSON_URL = "https://raw.githubusercontent.com/pcm-dpc/COVID-19/master/dati-json/dpc-covid19-ita-andamento-nazionale.json"
+REGIONAL_DATA_JSON_URL = "https://raw.githubusercontent.com/pcm-dpc/COVID-19/master/dati-json/dpc-covid19-ita-regioni.json"
 DATE_FORMAT = "%Y-%m-%dT%H:%M:%S"
 PROJECT_BASE_PATH = Path(__file__).parent.parent
 LATEST_EXECUTION_DATE_FILE_PATH = PROJECT_BASE_PATH / ".last_exec"
 TEMP_FILES_PATH = PROJECT_BASE_PATH / "tmp"
-UPDATE_CHECK_INTERVAL_MINUTES = 2
+REGIONAL_CHARTS = True
+REGIONAL_CHARTS_PATH = TEMP_FILES_PATH / "regions"
+REGIONAL_LATEST_EXECUTION_DATE_FILE_PATH = PROJECT_BASE_PATH / ".last_regional"
+FETCH_CACHE_PATH = PROJECT_BASE_PATH / ".fetch_cache"
+FETCH_TIMEOUT_SECONDS = 30
+UPDATE_HISTORY_PATH = PROJECT_BASE_PATH / ".update_history"
+PUBLISH_TIMEZONE = "Europe/Rome"
+PUBLISH_WINDOW_DEFAULT = ("17:00", "18:00")
+PUBLISH_WINDOW_MARGIN_MINUTES = 15
+PUBLISH_HISTORY_DAYS = 30
+WINDOW_POLL_INTERVAL_SECONDS = 60
+MAX_POLL_INTERVAL_SECONDS = 30 * 60
+RENDERER_WARM_UP_LEAD_SECONDS = 5 * 60
+CHART_RENDER_WORKERS = 4
+CHART_RENDER_SCALE = 2.0
+CHART_RENDERER_MAX_RENDERS = 200
+RENDER_CACHE_PATH = TEMP_FILES_PATH / "render_cache"
+RENDER_CACHE_MAX_BYTES = 50 * 1024 * 1024
+RENDER_CACHE_MAX_AGE_SECONDS = 7 * 24 * 60 * 60
+OVERLAPPED_PIPELINE = True
+UPLOAD_WORKERS = 4
+UPLOAD_RETRIES = 3
+POST_RETRIES = 0
+THREAD_CHECKPOINT_PATH = PROJECT_BASE_PATH / ".thread_checkpoint"
+THREAD_CHECKPOINT_MAX_AGE_SECONDS = 23 * 60 * 60
+THREAD_CHECKPOINT_MAX_FAILURES = 3
+INDICATOR_STATE_PATH = PROJECT_BASE_PATH / ".indicator_state"
+METRICS = True
+METRICS_PATH = PROJECT_BASE_PATH / "metrics.prom"
+METRICS_FORMAT = "prometheus"
+MEMORY_PROFILE_TOP_SITES = 10
+MEMORY_PROFILE_FRAMES = 1
+TIMEZONE_BACKEND = "pytz"
+SUPERVISOR_MODE = False
+WORKER_START_METHOD = "spawn"
+WORKER_TIMEOUT_SECONDS = 30 * 60
@@ -0,0 +1,178 @@
+import itertools
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+class FakeTwitterServer:
+
+    # Stand-in for the subset of the Twitter API used by the bot, talking the
+    # same protocol so that PythonTwitterBackend can be pointed at it. Every
+    # request waits `latency` seconds, every `rate_limit_every`-th request is
+    # answered with a rate limit error, and every `fail_every`-th one of the
+    # others, plus a random `failure_rate` fraction of them, fails with a
+    # server error.
+
+    API_PREFIX = "/1.1"
+    RATE_LIMIT_ERROR = {"errors": [{"code": 88, "message": "Rate limit exceeded"}]}
+    SERVER_ERROR = {"errors": [{"code": 131, "message": "Internal error"}]}
+
+    def __init__(self, host="127.0.0.1", port=0, latency=0.0, rate_limit_every=0, rate_limit_reset=1,
+                 failure_rate=0.0, seed=None, fail_every=0):
+        self.latency = latency
+        self.rate_limit_every = rate_limit_every
+        self.rate_limit_reset = rate_limit_reset
+        self.failure_rate = failure_rate
+        self.fail_every = fail_every
+        self.statuses = []
+        self.media = {}
+        self.__random = random.Random(seed)
+        self.__ids = itertools.count(1)
+        self.__lock = threading.Lock()
+        self.__counters = {
+            "requests": 0,
+            "rate_limited": 0,
+            "failures": 0,
+            "bytes_uploaded": 0
+        }
+        self.__server = ThreadingHTTPServer((host, port), _FakeTwitterHandler)
+        self.__server.daemon_threads = True
+        self.__server.fake = self
+        self.__thread = None
+
+    @property
+    def base_url(self):
+        host, port = self.__server.server_address[:2]
+        return "http://{0}:{1}{2}".format(host, port, FakeTwitterServer.API_PREFIX)
+
+    def start(self):
+        self.__thread = threading.Thread(target=self.__server.serve_forever, daemon=True)
+        self.__thread.start()
+        return self
+
+    def stop(self):
+        self.__server.shutdown()
+        self.__server.server_close()
+        if self.__thread is not None:
+            self.__thread.join()
+            self.__thread = None
+
+    def stats(self):
+        with self.__lock:
+            stats = dict(self.__counters)
+            stats["statuses"] = len(self.statuses)
+            stats["media"] = len(self.media)
+        return stats
+
+    def _admit(self):
+        # Decides the fate of a request: None if it can be served, otherwise
+        # the (status code, body) of the error to answer with
+        time.sleep(self.latency)
+        with self.__lock:
+            self.__counters["requests"] = self.__counters["requests"] + 1
+            if self.rate_limit_every > 0 and self.__counters["requests"] % self.rate_limit_every == 0:
+                self.__counters["rate_limited"] = self.__counters["rate_limited"] + 1
+                return 429, FakeTwitterServer.RATE_LIMIT_ERROR
+            if (self.fail_every > 0 and self.__counters["requests"] % self.fail_every == 0) or \
+                    (self.failure_rate > 0 and self.__random.random() < self.failure_rate):
+                self.__counters["failures"] = self.__counters["failures"] + 1
+                return 503, FakeTwitterServer.SERVER_ERROR
+        return None
+
+    def _post_status(self, text, in_reply_to_status_id, media_ids):
+        with self.__lock:
+            status = {
+                "id": next(self.__ids),
+                "full_text": text,
+                "in_reply_to_status_id": in_reply_to_status_id,
+                "media_ids": media_ids
+            }
+            self.statuses.append(status)
+        return status
+
+    def _init_media(self, total_bytes):
+        with self.__lock:
+            media_id = next(self.__ids)
+            self.media[media_id] = total_bytes
+        return media_id
+
+    def _append_media(self, size):
+        with self.__lock:
+            self.__counters["bytes_uploaded"] = self.__counters["bytes_uploaded"] + size
+
+
+class _FakeTwitterHandler(BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        if path == FakeTwitterServer.API_PREFIX + "/application/rate_limit_status.json":
+            # Queried once by python-twitter when sleeping on rate limits
+            self.__reply(200, {"resources": {"statuses": {}, "media": {}}})
+            return
+        self.__reply(404, {"errors": [{"code": 34, "message": "Not found"}]})
+
+    def do_POST(self):
+        fake = self.server.fake
+        url = urlparse(self.path)
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        error = fake._admit()
+        if error is not None:
+            self.__reply(*error)
+            return
+
+        if url.path == FakeTwitterServer.API_PREFIX + "/statuses/update.json":
+            params = self.__params(url.query, body)
+            reply_to = params.get("in_reply_to_status_id")
+            media_ids = params.get("media_ids")
+            status = fake._post_status(params.get("status", ""),
+                                       int(reply_to) if reply_to else None,
+                                       [int(i) for i in media_ids.split(",")] if media_ids else [])
+            self.__reply(200, status)
+        elif url.path == FakeTwitterServer.API_PREFIX + "/media/upload.json":
+            self.__upload(fake, url.query, body)
+        else:
+            self.__reply(404, {"errors": [{"code": 34, "message": "Not found"}]})
+
+    def log_message(self, format, *args):
+        pass
+
+    def __upload(self, fake, query, body):
+        if self.headers.get("Content-Type", "").startswith("multipart/form-data"):
+            # APPEND, the chunk is not kept and the reply has no body
+            fake._append_media(len(body))
+            self.__reply(200, None)
+            return
+        params = self.__params(query, body)
+        command = params.get("command")
+        if command == "INIT":
+            media_id = fake._init_media(int(params.get("total_bytes", 0)))
+            self.__reply(202, {"media_id": media_id, "media_id_string": str(media_id)})
+        elif command == "FINALIZE":
+            media_id = int(params.get("media_id", 0))
+            self.__reply(200, {"media_id": media_id, "media_id_string": str(media_id)})
+        else:
+            self.__reply(400, {"errors": [{"code": 38, "message": "Bad command"}]})
+
+    def __params(self, query, body):
+        params = parse_qs(query)
+        params.update(parse_qs(body.decode("utf-8")))
+        return {key: values[0] for key, values in params.items()}
+
+    def __reply(self, status_code, payload):
+        content = json.dumps(payload).encode("utf-8") if payload is not None else b""
+        self.send_response(status_code)
+        fake = self.server.fake
+        limited = status_code == 429
+        self.send_header("x-rate-limit-limit", "15")
+        self.send_header("x-rate-limit-remaining", "0" if limited else "15")
+        self.send_header("x-rate-limit-reset",
+                         str(int(time.time()) + (fake.rate_limit_reset if limited else 900)))
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
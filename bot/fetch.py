@@ -0,0 +1,129 @@
+import hashlib
+import json
+import time
+from pathlib import Path
+
+
+class FetchResult:
+
+    def __init__(self, status_code, content, modified):
+        self.status_code = status_code
+        self.content = content
+        self.modified = modified
+
+
+class ConditionalFetcher:
+
+    def __init__(self, url: str, cache_path: Path, timeout=None, session=None):
+        self.__url = url
+        self.__timeout = timeout
+        if session is None:
+            import requests
+            session = requests.Session()
+        self.__session = session
+        url_hash = hashlib.sha1(url.encode("utf-8")).hexdigest()
+        self.__meta_path = cache_path / (url_hash + ".json")
+        self.__body_path = cache_path / (url_hash + ".body")
+        self.__etag = None
+        self.__last_modified = None
+        self.__content_length = 0
+        self.__download_time = 0.0
+        self.requests_count = 0
+        self.not_modified_count = 0
+        self.bytes_saved = 0
+        self.time_saved = 0.0
+        self.__load_cache()
+
+    def fetch(self, require_content=False):
+        headers = {}
+        if self.__etag is not None:
+            headers["If-None-Match"] = self.__etag
+        if self.__last_modified is not None:
+            headers["If-Modified-Since"] = self.__last_modified
+
+        start = time.perf_counter()
+        response = self.__session.get(
+            self.__url, headers=headers, timeout=self.__timeout)
+        content = response.content
+        elapsed = time.perf_counter() - start
+        self.requests_count = self.requests_count + 1
+
+        if response.status_code == 304:
+            self.not_modified_count = self.not_modified_count + 1
+            self.bytes_saved = self.bytes_saved + self.__content_length
+            self.time_saved = self.time_saved + \
+                max(0.0, self.__download_time - elapsed)
+            if not require_content:
+                return FetchResult(304, None, False)
+            cached_content = self.__read_body()
+            if cached_content is not None:
+                return FetchResult(304, cached_content, False)
+            # Validators without a body are useless, start over
+            self.clear()
+            return self.fetch(require_content)
+
+        if response.status_code == 200:
+            self.__etag = response.headers.get("ETag")
+            self.__last_modified = response.headers.get("Last-Modified")
+            self.__content_length = len(content)
+            self.__download_time = elapsed
+            self.__save_cache(content)
+        return FetchResult(response.status_code, content, True)
+
+    def clear(self):
+        self.__etag = None
+        self.__last_modified = None
+        self.__content_length = 0
+        self.__download_time = 0.0
+        for path in [self.__meta_path, self.__body_path]:
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+
+    def stats(self):
+        return {
+            "requests": self.requests_count,
+            "not_modified": self.not_modified_count,
+            "bytes_saved": self.bytes_saved,
+            "time_saved": self.time_saved
+        }
+
+    def close(self):
+        self.__session.close()
+
+    def __load_cache(self):
+        try:
+            with open(self.__meta_path, "r") as file:
+                meta = json.load(file)
+        except (IOError, ValueError):
+            return
+        self.__etag = meta.get("etag")
+        self.__last_modified = meta.get("last_modified")
+        self.__content_length = meta.get("content_length", 0)
+        self.__download_time = meta.get("download_time", 0.0)
+
+    def __save_cache(self, content):
+        meta = {
+            "url": self.__url,
+            "etag": self.__etag,
+            "last_modified": self.__last_modified,
+            "content_length": self.__content_length,
+            "download_time": self.__download_time
+        }
+        try:
+            self.__meta_path.parent.mkdir(parents=True, exist_ok=True)
+            with open(self.__body_path, "wb") as file:
+                file.write(content)
+            with open(self.__meta_path, "w") as file:
+                json.dump(meta, file)
+        except IOError:
+            # The in-memory validators are still good for this process
+            pass
+
+    def __read_body(self):
+        try:
+            with open(self.__body_path, "rb") as file:
+                return file.read()
+        except IOError:
+            return None
@@ -1,4 +1,9 @@
+import json
 from abc import ABC, abstractmethod
+from collections import deque
+from itertools import accumulate, islice
+
+from bot import metrics
 
 
 class Indicator(ABC):
@@ -38,6 +43,16 @@ class MovingAverageIndicator(Indicator):
         data_sum = sum(self._data[start:i + 1])
         return data_sum / self.__period
 
+    def get_all(self):
+        # Every window sum is the difference of two prefix sums
+        period = self.__period
+        values = [float("NaN")] * min(period - 1, len(self._data))
+        prefix_sums = [0]
+        prefix_sums.extend(accumulate(self._data))
+        values.extend([(prefix_sums[i] - prefix_sums[i - period]) / period
+                       for i in range(period, len(prefix_sums))])
+        return values
+
 
 class DeltaIndicator(Indicator):
 
@@ -51,6 +66,14 @@ class DeltaIndicator(Indicator):
         else:
             return self._data[i] - self._data[i - 1]
 
+    def get_all(self):
+        if len(self._data) == 0:
+            return []
+        values = [self._data[0]]
+        values.extend([current - previous for previous, current
+                       in zip(self._data, islice(self._data, 1, None))])
+        return values
+
 
 class DeltaPercentageIndicator(Indicator):
 
@@ -65,3 +88,250 @@ class DeltaPercentageIndicator(Indicator):
             delta = self._data[i] - self._data[i - 1]
             delta_perc = 100 * delta / self._data[i - 1]
             return delta_perc
+
+    def get_all(self):
+        if len(self._data) == 0:
+            return []
+        values = [0]
+        values.extend([100 * (current - previous) / previous for previous, current
+                       in zip(self._data, islice(self._data, 1, None))])
+        return values
+
+
+class StreamingIndicator(ABC):
+
+    @abstractmethod
+    def push(self, value):
+        pass
+
+    @abstractmethod
+    def value(self):
+        pass
+
+    @abstractmethod
+    def get_state(self) -> dict:
+        pass
+
+    @classmethod
+    @abstractmethod
+    def from_state(cls, state: dict):
+        pass
+
+    def push_all(self, values):
+        for value in values:
+            self.push(value)
+        return self
+
+    @staticmethod
+    def restore(state: dict):
+        for cls in [StreamingMovingAverageIndicator, StreamingDeltaIndicator,
+                    StreamingDeltaPercentageIndicator]:
+            if cls.__name__ == state["type"]:
+                return cls.from_state(state)
+        raise ValueError("unknown streaming indicator " + str(state["type"]))
+
+
+class StreamingMovingAverageIndicator(StreamingIndicator):
+
+    def __init__(self, period: int):
+        if period <= 0:
+            raise ValueError
+        self.__period = period
+        self.__window = deque(maxlen=period)
+        self.__sum = 0
+
+    def push(self, value):
+        if len(self.__window) == self.__period:
+            self.__sum = self.__sum - self.__window[0]
+        self.__window.append(value)
+        self.__sum = self.__sum + value
+
+    def value(self):
+        if len(self.__window) == 0:
+            raise IndexError
+        if len(self.__window) < self.__period:
+            return float("NaN")
+        return self.__sum / self.__period
+
+    def get_state(self):
+        return {
+            "type": type(self).__name__,
+            "period": self.__period,
+            "window": list(self.__window)
+        }
+
+    @classmethod
+    def from_state(cls, state):
+        return cls(state["period"]).push_all(state["window"])
+
+
+class StreamingDeltaIndicator(StreamingIndicator):
+
+    def __init__(self):
+        self._previous = None
+        self._current = None
+
+    def push(self, value):
+        self._previous = self._current
+        self._current = value
+
+    def value(self):
+        if self._current is None:
+            raise IndexError
+        if self._previous is None:
+            return self._current
+        return self._current - self._previous
+
+    def get_state(self):
+        return {
+            "type": type(self).__name__,
+            "previous": self._previous,
+            "current": self._current
+        }
+
+    @classmethod
+    def from_state(cls, state):
+        indicator = cls()
+        indicator._previous = state["previous"]
+        indicator._current = state["current"]
+        return indicator
+
+
+class StreamingDeltaPercentageIndicator(StreamingDeltaIndicator):
+
+    def value(self):
+        if self._current is None:
+            raise IndexError
+        if self._previous is None:
+            return 0
+        return 100 * (self._current - self._previous) / self._previous
+
+
+# Streaming counterpart of every batch indicator, whose value() is the
+# get_last() of the batch indicator over the same data
+STREAMING_INDICATORS = {
+    MovingAverageIndicator: StreamingMovingAverageIndicator,
+    DeltaIndicator: StreamingDeltaIndicator,
+    DeltaPercentageIndicator: StreamingDeltaPercentageIndicator
+}
+
+
+class StreamingIndicatorStore:
+
+    # Streaming indicators fed with the columns of a DataProcessor and saved
+    # to path, so that every cycle (and every process) only pushes the rows
+    # added since the previous one. An indicator whose last pushed row no
+    # longer matches the data (e.g. a revised or shorter history) is rebuilt
+    # from the whole column.
+
+    def __init__(self, path):
+        self.__path = path
+        self.__entries = self.__load()
+        self.pushed = 0
+
+    def get_last(self, dp, source, indicator_type, *args):
+        size = dp.size()
+        if size == 0:
+            raise IndexError
+        key = "|".join([source, indicator_type.__name__] + [str(arg) for arg in args])
+        entry = self.__entries.get(key)
+        if entry is not None and StreamingIndicatorStore.__matches(dp, source, entry):
+            indicator = StreamingIndicator.restore(entry["state"])
+            start = entry["rows"]
+        else:
+            indicator = indicator_type(*args)
+            start = 0
+        values = dp.get(source, start)
+        indicator.push_all(values)
+        self.pushed = self.pushed + len(values)
+        self.__entries[key] = {
+            "rows": size,
+            "date": str(dp.get("date", size - 1)[0]),
+            "value": dp.get(source, size - 1)[0],
+            "state": indicator.get_state()
+        }
+        return indicator.value()
+
+    def save(self):
+        with open(self.__path, "w") as file:
+            json.dump(self.__entries, file)
+
+    def __load(self):
+        try:
+            with open(self.__path, "r") as file:
+                return json.load(file)
+        except (IOError, ValueError):
+            return {}
+
+    @staticmethod
+    def __matches(dp, source, entry):
+        rows = entry["rows"]
+        return 0 < rows <= dp.size() and \
+            str(dp.get("date", rows - 1, rows)[0]) == entry["date"] and \
+            dp.get(source, rows - 1, rows)[0] == entry["value"]
+
+
+class IndicatorCache:
+
+    def __init__(self):
+        self.__series = {}
+        self.__version = None
+        self.hits = 0
+        self.misses = 0
+
+    def get_series(self, dp, source):
+        # A source is either a column key or a (source, indicator_type,
+        # *args) tuple describing a derived series.
+        if isinstance(source, str):
+            return self.__lookup(dp, (source,), "series", lambda: dp.get(source))
+        return self.get_all(dp, *source)
+
+    def get_all(self, dp, source, indicator_type, *args):
+        return self.__lookup(dp, (source, indicator_type) + args, indicator_type.__name__,
+                             lambda: indicator_type(self.get_series(dp, source), *args).get_all())
+
+    def get_last(self, dp, source, indicator_type, *args, store=None):
+        # The last value of a series already computed (e.g. for a chart) is
+        # reused. Otherwise, given a StreamingIndicatorStore, the value comes
+        # from its saved streaming state: only the rows added since the
+        # previous cycle are pushed, instead of going over the whole column.
+        series = self.__series.get((source, indicator_type) + args)
+        if series is not None and self.__version == dp.version():
+            self.hits = self.hits + 1
+            metrics.inc("indicator_cache_hits")
+            return series[-1]
+        if store is not None and isinstance(source, str) and indicator_type in STREAMING_INDICATORS:
+            def compute():
+                return store.get_last(dp, source, STREAMING_INDICATORS[indicator_type], *args)
+        else:
+            def compute():
+                return indicator_type(self.get_series(dp, source), *args).get_last()
+        return self.__lookup(dp, ("last", source, indicator_type) + args, indicator_type.__name__,
+                             compute)
+
+    def clear(self):
+        self.__series.clear()
+        self.__version = None
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "size": len(self.__series)
+        }
+
+    def __lookup(self, dp, key, name, compute):
+        if self.__version != dp.version():
+            self.__series.clear()
+            self.__version = dp.version()
+        if key in self.__series:
+            self.hits = self.hits + 1
+            metrics.inc("indicator_cache_hits")
+            return self.__series[key]
+        self.misses = self.misses + 1
+        metrics.inc("indicator_cache_misses")
+        # Derived series include the time spent computing their sources
+        with metrics.span("indicator_compute", indicator=name):
+            value = compute()
+        self.__series[key] = value
+        return value
@@ -0,0 +1,79 @@
+import gc
+import logging
+import os
+import tracemalloc
+
+import psutil
+
+log = logging.getLogger(__name__)
+
+TRACE_FILTERS = [
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+    tracemalloc.Filter(False, "<unknown>")
+]
+
+
+def rss():
+    return psutil.Process(os.getpid()).memory_info().rss
+
+
+class MemoryProfiler:
+
+    # Takes a snapshot of the Python heap at the end of every cycle and
+    # reports the allocation sites that grew the most since the previous
+    # one, along with the resident set size. tracemalloc slows every
+    # allocation down, with trace=False only the RSS is followed.
+
+    def __init__(self, top=10, frames=1, trace=True):
+        self.__top = top
+        self.__frames = frames
+        self.__trace = trace
+        self.__previous = None
+        self.__start_rss = None
+        self.cycles = 0
+
+    def start(self):
+        if self.__trace and not tracemalloc.is_tracing():
+            tracemalloc.start(self.__frames)
+        self.__start_rss = rss()
+
+    def stop(self):
+        if self.__trace and tracemalloc.is_tracing():
+            tracemalloc.stop()
+        self.__previous = None
+
+    def snapshot(self):
+        # Unreachable cycles would otherwise show up as growth
+        gc.collect()
+        self.cycles = self.cycles + 1
+        current_rss = rss()
+        if self.__start_rss is None:
+            self.__start_rss = current_rss
+        report = {
+            "cycle": self.cycles,
+            "rss": current_rss,
+            "rss_growth": current_rss - self.__start_rss,
+            "traced": None,
+            "top_growth": []
+        }
+        if self.__trace and tracemalloc.is_tracing():
+            snapshot = tracemalloc.take_snapshot().filter_traces(TRACE_FILTERS)
+            report["traced"] = tracemalloc.get_traced_memory()[0]
+            if self.__previous is not None:
+                report["top_growth"] = [(str(stat.traceback), stat.size_diff, stat.count_diff)
+                                        for stat in snapshot.compare_to(self.__previous, "lineno")
+                                        if stat.size_diff > 0][:self.__top]
+            self.__previous = snapshot
+        return report
+
+    @staticmethod
+    def format_report(report):
+        lines = ["Memory after cycle {0}: RSS {1:.1f} MiB ({2:+.1f} MiB since start)".format(
+            report["cycle"], report["rss"] / 2 ** 20, report["rss_growth"] / 2 ** 20)]
+        if report["traced"] is not None:
+            lines[0] = lines[0] + ", traced {0:.1f} MiB".format(report["traced"] / 2 ** 20)
+        for site, size_diff, count_diff in report["top_growth"]:
+            lines.append("  {0}: {1:+.1f} KiB ({2:+d} blocks)".format(site, size_diff / 1024, count_diff))
+        return "\n".join(lines)
@@ -0,0 +1,192 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+PREFIX = "covid_bot"
+PROMETHEUS = "prometheus"
+JSON = "json"
+
+
+class Metrics:
+
+    # Counters, gauges and timings kept for the life of the process and
+    # written out as a whole, either in the Prometheus text format (for the
+    # node exporter textfile collector) or as JSON. A sample is identified by
+    # its metric name and labels. Timings are in seconds: their count, sum,
+    # max and last value are kept.
+
+    COUNTER = "counter"
+    GAUGE = "gauge"
+    TIMING = "timing"
+
+    def __init__(self, prefix=PREFIX):
+        self.__prefix = prefix
+        self.__lock = threading.Lock()
+        self.__types = {}
+        self.__samples = {}
+
+    def inc(self, name, value=1, **labels):
+        with self.__lock:
+            key = self.__key(name, Metrics.COUNTER, labels)
+            self.__samples[key] = self.__samples.get(key, 0) + value
+
+    def set_gauge(self, name, value, **labels):
+        with self.__lock:
+            self.__samples[self.__key(name, Metrics.GAUGE, labels)] = value
+
+    def observe(self, name, seconds, **labels):
+        with self.__lock:
+            key = self.__key(name, Metrics.TIMING, labels)
+            timing = self.__samples.get(key)
+            if timing is None:
+                self.__samples[key] = {"count": 1, "sum": seconds, "max": seconds, "last": seconds}
+                return
+            timing["count"] = timing["count"] + 1
+            timing["sum"] = timing["sum"] + seconds
+            timing["max"] = max(timing["max"], seconds)
+            timing["last"] = seconds
+
+    @contextmanager
+    def span(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def get(self, name, **labels):
+        with self.__lock:
+            value = self.__samples.get((name, Metrics.__labels_key(labels)))
+            return dict(value) if isinstance(value, dict) else value
+
+    def snapshot(self):
+        with self.__lock:
+            metrics = {}
+            for (name, labels), value in sorted(self.__samples.items(), key=lambda item: item[0]):
+                metric = metrics.setdefault(name, {"type": self.__types[name], "samples": []})
+                sample = {"labels": dict(labels)}
+                if isinstance(value, dict):
+                    sample.update(value)
+                else:
+                    sample["value"] = value
+                metric["samples"].append(sample)
+            return metrics
+
+    def merge(self, snapshot):
+        # Adds up the snapshot of another registry (e.g. of a worker process):
+        # counters and timings are summed, gauges take the snapshot's value
+        with self.__lock:
+            for name, metric in snapshot.items():
+                for sample in metric["samples"]:
+                    key = self.__key(name, metric["type"], sample["labels"])
+                    if metric["type"] == Metrics.COUNTER:
+                        self.__samples[key] = self.__samples.get(key, 0) + sample["value"]
+                    elif metric["type"] == Metrics.GAUGE:
+                        self.__samples[key] = sample["value"]
+                    else:
+                        timing = self.__samples.get(key)
+                        if timing is None:
+                            self.__samples[key] = {field: sample[field]
+                                                   for field in ["count", "sum", "max", "last"]}
+                            continue
+                        timing["count"] = timing["count"] + sample["count"]
+                        timing["sum"] = timing["sum"] + sample["sum"]
+                        timing["max"] = max(timing["max"], sample["max"])
+                        timing["last"] = sample["last"]
+
+    def reset(self):
+        with self.__lock:
+            self.__types.clear()
+            self.__samples.clear()
+
+    def to_json(self):
+        return json.dumps({
+            "prefix": self.__prefix,
+            "timestamp": time.time(),
+            "metrics": self.snapshot()
+        }, indent=2)
+
+    def to_prometheus(self):
+        lines = []
+        for name, metric in self.snapshot().items():
+            full_name = self.__prefix + "_" + name
+            samples = metric["samples"]
+            if metric["type"] == Metrics.COUNTER:
+                Metrics.__family(lines, full_name + "_total", "counter", samples, "value")
+            elif metric["type"] == Metrics.GAUGE:
+                Metrics.__family(lines, full_name, "gauge", samples, "value")
+            else:
+                full_name = full_name + "_seconds"
+                lines.append("# TYPE {0} summary".format(full_name))
+                for sample in samples:
+                    labels = Metrics.__format_labels(sample["labels"])
+                    lines.append("{0}_count{1} {2}".format(full_name, labels, sample["count"]))
+                    lines.append("{0}_sum{1} {2}".format(full_name, labels, repr(float(sample["sum"]))))
+                Metrics.__family(lines, full_name + "_max", "gauge", samples, "max")
+                Metrics.__family(lines, full_name + "_last", "gauge", samples, "last")
+        return "\n".join(lines) + "\n"
+
+    def write(self, path, fmt=PROMETHEUS):
+        # Written atomically, a collector never reads half a file
+        if fmt == PROMETHEUS:
+            content = self.to_prometheus()
+        elif fmt == JSON:
+            content = self.to_json()
+        else:
+            raise ValueError("unknown metrics format " + str(fmt))
+        tmp_path = str(path) + ".tmp"
+        with open(tmp_path, "w") as file:
+            file.write(content)
+        os.replace(tmp_path, path)
+
+    def __key(self, name, metric_type, labels):
+        known_type = self.__types.setdefault(name, metric_type)
+        if known_type != metric_type:
+            raise ValueError("metric {0} is a {1}, not a {2}".format(name, known_type, metric_type))
+        return name, Metrics.__labels_key(labels)
+
+    @staticmethod
+    def __labels_key(labels):
+        return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+    @staticmethod
+    def __family(lines, name, metric_type, samples, field):
+        lines.append("# TYPE {0} {1}".format(name, metric_type))
+        for sample in samples:
+            value = sample[field]
+            value = repr(float(value)) if isinstance(value, float) else str(value)
+            lines.append("{0}{1} {2}".format(name, Metrics.__format_labels(sample["labels"]), value))
+
+    @staticmethod
+    def __format_labels(labels):
+        if len(labels) == 0:
+            return ""
+        return "{" + ",".join('{0}="{1}"'.format(key, Metrics.__escape(value))
+                              for key, value in labels.items()) + "}"
+
+    @staticmethod
+    def __escape(value):
+        return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+# Registry shared by the modules of the bot
+
+registry = Metrics()
+
+
+def inc(name, value=1, **labels):
+    registry.inc(name, value, **labels)
+
+
+def set_gauge(name, value, **labels):
+    registry.set_gauge(name, value, **labels)
+
+
+def observe(name, seconds, **labels):
+    registry.observe(name, seconds, **labels)
+
+
+def span(name, **labels):
+    return registry.span(name, **labels)
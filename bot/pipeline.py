@@ -0,0 +1,96 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+
+class StageTimer:
+
+    def __init__(self, metrics=None, elapsed=0.0):
+        # Every stage is also observed by metrics, as a "stage" timing
+        # labelled with the stage name, and marks are set as gauges. elapsed
+        # are the seconds already spent by the caller (e.g. the poll that
+        # handed the work over to another process), offsets count from there
+        self.__origin = time.perf_counter() - elapsed
+        self.__lock = threading.Lock()
+        self.__stages = {}
+        self.__marks = {}
+        self.__metrics = metrics
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.__record(name, start, time.perf_counter())
+
+    def timed(self, name, func, *args, **kwargs):
+        with self.stage(name):
+            return func(*args, **kwargs)
+
+    def mark(self, name):
+        # Only the first occurrence of a mark is kept
+        with self.__lock:
+            if name in self.__marks:
+                return
+            offset = time.perf_counter() - self.__origin
+            self.__marks[name] = offset
+        if self.__metrics is not None:
+            self.__metrics.set_gauge("mark_seconds", offset, mark=name)
+
+    def elapsed(self):
+        return time.perf_counter() - self.__origin
+
+    def stages(self):
+        with self.__lock:
+            return {name: dict(stage) for name, stage in self.__stages.items()}
+
+    def marks(self):
+        with self.__lock:
+            return dict(self.__marks)
+
+    def report(self):
+        # Stages run more than once (e.g. one upload per chart) are merged,
+        # "busy" is the sum of their durations
+        parts = []
+        for name, stage in self.stages().items():
+            parts.append("{0} {1:.3f}s-{2:.3f}s (busy {3:.3f}s, x{4})".format(
+                name, stage["start"], stage["end"], stage["busy"], stage["count"]))
+        for name, offset in self.marks().items():
+            parts.append("{0} at {1:.3f}s".format(name, offset))
+        return ", ".join(parts)
+
+    def __record(self, name, start, end):
+        if self.__metrics is not None:
+            self.__metrics.observe("stage", end - start, stage=name)
+        start = start - self.__origin
+        end = end - self.__origin
+        with self.__lock:
+            stage = self.__stages.get(name)
+            if stage is None:
+                self.__stages[name] = {"start": start, "end": end,
+                                       "busy": end - start, "count": 1}
+                return
+            stage["start"] = min(stage["start"], start)
+            stage["end"] = max(stage["end"], end)
+            stage["busy"] = stage["busy"] + end - start
+            stage["count"] = stage["count"] + 1
+
+
+def run_overlapped(render, upload, compose, post, timer: StageTimer, upload_workers=4):
+    # render(on_rendered) produces the images, calling on_rendered(index, path)
+    # for each one as soon as it is ready: the upload of an image starts
+    # right away while the tweet text is composed in the meantime. post(text,
+    # media) runs once every upload is done, media being sorted by index.
+    with ThreadPoolExecutor(max_workers=upload_workers + 1) as executor:
+        uploads = {}
+
+        def on_rendered(index, path):
+            uploads[index] = executor.submit(timer.timed, "upload", upload, path)
+
+        render_future = executor.submit(timer.timed, "render", render, on_rendered)
+        text = timer.timed("compose", compose)
+        render_future.result()
+        media = [uploads[i].result() for i in sorted(uploads)]
+    return timer.timed("post", post, text, media)
@@ -1,8 +1,19 @@
+import codecs
+import itertools
 import json
+import re
 
+from array import array
 from json import JSONDecodeError
 from datetime import datetime
-import pytz
+
+from bot import metrics
+from bot import timezones
+from bot.timezones import DateLocalizer
+
+ISO_DATE_FORMAT = "%Y-%m-%dT%H:%M:%S"
+ISO_DATE_REGEX = re.compile(
+    r"[0-9]{4}-[0-9]{2}-[0-9]{2}T[0-9]{2}:[0-9]{2}:[0-9]{2}")
 
 
 class DataProcessor:
@@ -19,7 +30,9 @@ class DataProcessor:
         "dimessi_guariti": int,
         "deceduti": int,
         "totale_casi": int,
-        "tamponi": int
+        "tamponi": int,
+        "codice_regione": int,
+        "denominazione_regione": str
     }
 
     LOOKUP_TABLE = {
@@ -34,72 +47,410 @@ class DataProcessor:
         "total_recovered": "dimessi_guariti",
         "total_deaths": "deceduti",
         "total_cases": "totale_casi",
-        "total_tests": "tamponi"
+        "total_tests": "tamponi",
+        "region_code": "codice_regione",
+        "region_name": "denominazione_regione"
     }
 
-    def __init__(self, data):
-        self.__data = data
+    # Only found in the regional dataset, where they make region a dimension
+    REGIONAL_FIELDS = ("codice_regione", "denominazione_regione")
+    REGIONAL_GROUP_FIELD = "denominazione_regione"
+
+    INT_ARRAY_TYPECODE = "q"
+    STREAM_CHUNK_SIZE = 64 * 1024
+
+    __versions = itertools.count()
+
+    def __init__(self, columns, size, regional=False, index=None):
+        self.__columns = columns
+        self.__size = size
+        self.__regional = regional
+        self.__index = index
+        self.__version = next(DataProcessor.__versions)
 
     @staticmethod
-    def initialize(data, parse_date_format):
-        final_data = data
-        if not DataProcessor.__verify_data_structure(data, parse_date_format):
-            if isinstance(data, str) or isinstance(data, bytes) or isinstance(data, bytearray):
-                try:
-                    final_data = json.loads(data)
-                except JSONDecodeError:
-                    raise InvalidDataFormatException(
-                        "could not decode data (wrong format)")
-                if not DataProcessor.__verify_data_structure(final_data, parse_date_format):
-                    raise InvalidDataFormatException("invalid data structure")
+    def initialize(data, parse_date_format, regional=False):
+        with metrics.span("data_initialize"):
+            records, error_message = DataProcessor.__decode(data)
+            return DataProcessor.__from_records(records, parse_date_format, error_message, regional)
+
+    @staticmethod
+    def initialize_stream(stream, parse_date_format, chunk_size=STREAM_CHUNK_SIZE, regional=False):
+        with metrics.span("data_initialize"):
+            records = DataProcessor.__iter_stream_records(stream, chunk_size)
+            return DataProcessor.__from_records(records, parse_date_format, "invalid data structure", regional)
+
+    def merge(self, data, parse_date_format):
+        with metrics.span("data_merge"):
+            return self.__merge(data, parse_date_format)
+
+    def __merge(self, data, parse_date_format):
+        records, error_message = DataProcessor.__decode(data)
+        last_date = self.last_date()
+        first_new = len(records)
+        if last_date is None:
+            first_new = 0
+        # Entries are sorted by date, so only the tail newer than the last
+        # known date gets parsed and validated.
+        while first_new > 0 and DataProcessor.__entry_date(records[first_new - 1], parse_date_format) > last_date:
+            first_new = first_new - 1
+        for i in range(first_new, len(records)):
+            values = DataProcessor.__append_entry(self.__columns, records[i], parse_date_format)
+            if values is None:
+                raise InvalidDataFormatException(error_message)
+            if self.__index is not None:
+                self.__index.add(self.__size, values)
+            self.__size = self.__size + 1
+            self.__version = next(DataProcessor.__versions)
+        metrics.inc("rows_parsed", len(records) - first_new)
+        return len(records) - first_new
+
+    def copy(self):
+        columns = {}
+        for key in self.__columns:
+            columns[key] = self.__columns[key][:]
+        index = self.__index.copy() if self.__index is not None else None
+        return DataProcessor(columns, self.__size, self.__regional, index)
+
+    def group_by(self, key):
+        # Splits the rows by the values of a column (e.g. "region_name"),
+        # groups are in order of first appearance
+        field = DataProcessor.LOOKUP_TABLE[key]
+        if self.__index is not None and self.__index.group_field() == field:
+            groups = {}
+            for group in self.__index.groups():
+                columns = {name: values[:]
+                           for name, values in self.__index.group_columns(group).items()}
+                groups[group] = DataProcessor(columns, self.__index.group_size(group), self.__regional)
+            return groups
+        column = self.__columns[field]
+        rows = {}
+        for i in range(self.__size):
+            rows.setdefault(column[i], []).append(i)
+        groups = {}
+        for value, indexes in rows.items():
+            columns = {}
+            for name, values in self.__columns.items():
+                if isinstance(values, array):
+                    columns[name] = array(values.typecode, [values[i] for i in indexes])
+                else:
+                    columns[name] = [values[i] for i in indexes]
+            groups[value] = DataProcessor(columns, len(indexes), self.__regional)
+        return groups
+
+    @staticmethod
+    def __decode(data):
+        if isinstance(data, str) or isinstance(data, bytes) or isinstance(data, bytearray):
+            try:
+                data = json.loads(data)
+            except JSONDecodeError:
+                raise InvalidDataFormatException(
+                    "could not decode data (wrong format)")
+            if not isinstance(data, list):
+                raise InvalidDataFormatException("invalid data structure")
+            return data, "invalid data structure"
+        if isinstance(data, list):
+            return data, "invalid data format"
+        raise InvalidDataFormatException("invalid data format")
+
+    @staticmethod
+    def __entry_date(entry, parse_date_format):
+        date_key = DataProcessor.LOOKUP_TABLE["date"]
+        if not isinstance(entry, dict) or not isinstance(entry.get(date_key), str):
+            raise InvalidDataFormatException("invalid data structure")
+        return DataProcessor.__parse_date(entry[date_key], parse_date_format)
+
+    def groups(self):
+        return self.__require_index().groups()
+
+    def get_group(self, group, key, start=None, end=None):
+        column = self.__require_index().group_columns(group)[DataProcessor.LOOKUP_TABLE[key]]
+        values = column[start:end]
+        if isinstance(values, array):
+            return values.tolist()
+        return values
+
+    def lookup(self, group, date, key):
+        row = self.__require_index().row(group, date)
+        return self.__columns[DataProcessor.LOOKUP_TABLE[key]][row]
+
+    def aggregate(self):
+        # Sums every group day by day, e.g. all the regions into national data
+        index = self.__require_index()
+        dates = index.dates()
+        row_days = index.row_days()
+        columns = {}
+        for field, column in self.__columns.items():
+            if field in DataProcessor.REGIONAL_FIELDS:
+                continue
+            if DataProcessor.TYPE_TABLE[field] is int:
+                totals = [0] * len(dates)
+                for day, value in zip(row_days, column):
+                    totals[day] = totals[day] + value
+                columns[field] = array(DataProcessor.INT_ARRAY_TYPECODE, totals)
+            else:
+                columns[field] = list(dates)
+        return DataProcessor(columns, len(dates))
+
+    def __require_index(self):
+        if self.__index is None:
+            raise ValueError("data is not grouped")
+        return self.__index
+
+    @staticmethod
+    def __build_index(columns, size):
+        index = GroupIndex(columns, DataProcessor.REGIONAL_GROUP_FIELD,
+                           DataProcessor.LOOKUP_TABLE["date"])
+        for row in range(size):
+            index.add(row, [columns[field][row] for field in columns])
+        return index
+
+    @staticmethod
+    def __from_records(records, parse_date_format, error_message, regional):
+        columns = DataProcessor.__empty_columns(regional)
+        index = None
+        if regional:
+            index = GroupIndex(columns, DataProcessor.REGIONAL_GROUP_FIELD,
+                               DataProcessor.LOOKUP_TABLE["date"])
+        size = 0
+        for entry in records:
+            values = DataProcessor.__append_entry(columns, entry, parse_date_format)
+            if values is None:
+                raise InvalidDataFormatException(error_message)
+            if index is not None:
+                index.add(size, values)
+            size = size + 1
+        metrics.inc("rows_parsed", size)
+        return DataProcessor(columns, size, regional, index)
+
+    @staticmethod
+    def __empty_columns(regional):
+        columns = {}
+        for key in DataProcessor.TYPE_TABLE:
+            if not regional and key in DataProcessor.REGIONAL_FIELDS:
+                continue
+            if DataProcessor.TYPE_TABLE[key] is int:
+                columns[key] = array(DataProcessor.INT_ARRAY_TYPECODE)
             else:
-                raise InvalidDataFormatException("invalid data format")
-        return DataProcessor(final_data)
+                columns[key] = []
+        return columns
 
     @staticmethod
-    def __verify_data_structure(data, parse_date_format):
-        if not isinstance(data, list):
-            return False
-        for entry in data:
-            if not isinstance(entry, dict):
-                return False
-            for key in DataProcessor.TYPE_TABLE.keys():
-                if key not in entry:
-                    return False
-                if not isinstance(entry[key], DataProcessor.TYPE_TABLE[key]):
-                    if DataProcessor.TYPE_TABLE[key] is datetime:
-                        date_parsed = DataProcessor.__parse_date(
-                            entry[key], parse_date_format)
-                        entry[key] = date_parsed
-                    else:
-                        return False
-        return True
+    def __append_entry(columns, entry, parse_date_format):
+        # Validates and converts the whole entry first, so that a bad entry
+        # never leaves the columns with different lengths. Returns the values
+        # appended, None if the entry is not valid.
+        if not isinstance(entry, dict):
+            return None
+        values = []
+        for key in columns:
+            if key not in entry:
+                return None
+            value = entry[key]
+            if not isinstance(value, DataProcessor.TYPE_TABLE[key]):
+                if DataProcessor.TYPE_TABLE[key] is datetime and isinstance(value, str):
+                    value = DataProcessor.__parse_date(value, parse_date_format)
+                else:
+                    return None
+            values.append(value)
+        for key, value in zip(columns, values):
+            columns[key].append(value)
+        return values
+
+    @staticmethod
+    def __iter_stream_records(stream, chunk_size):
+        # Yields the entries of a top level JSON array one at a time, keeping
+        # in memory only the unparsed tail of the last chunk read. Only
+        # whitespace may follow the array, as with json.loads.
+        decoder = json.JSONDecoder()
+        utf8_decoder = codecs.getincrementaldecoder("utf-8")()
+        buffer = ""
+        pos = 0
+        state = "start"
+        eof = False
+        while True:
+            while pos < len(buffer) and buffer[pos] in " \t\r\n":
+                pos = pos + 1
+            if pos == len(buffer) or state == "incomplete":
+                if eof and state == "end":
+                    return
+                if eof:
+                    raise InvalidDataFormatException(
+                        "could not decode data (unexpected end of data)")
+                buffer = buffer[pos:]
+                pos = 0
+                chunk = stream.read(chunk_size)
+                if isinstance(chunk, str):
+                    buffer = buffer + chunk
+                else:
+                    buffer = buffer + utf8_decoder.decode(chunk, final=not chunk)
+                eof = not chunk
+                if state == "incomplete":
+                    state = "value"
+                continue
+            char = buffer[pos]
+            if state == "start":
+                if char != "[":
+                    raise InvalidDataFormatException("invalid data structure")
+                pos = pos + 1
+                state = "first"
+            elif state == "end":
+                raise InvalidDataFormatException(
+                    "could not decode data (wrong format)")
+            elif state == "separator":
+                if char == "]":
+                    state = "end"
+                elif char != ",":
+                    raise InvalidDataFormatException(
+                        "could not decode data (wrong format)")
+                else:
+                    state = "value"
+                pos = pos + 1
+            elif state == "first" and char == "]":
+                pos = pos + 1
+                state = "end"
+            else:
+                try:
+                    record, pos = decoder.raw_decode(buffer, pos)
+                except JSONDecodeError:
+                    if eof:
+                        raise InvalidDataFormatException(
+                            "could not decode data (wrong format)")
+                    state = "incomplete"
+                    continue
+                yield record
+                state = "separator"
 
     @staticmethod
     def __parse_date(str, date_format):
+        if date_format == ISO_DATE_FORMAT and ISO_DATE_REGEX.fullmatch(str):
+            try:
+                return datetime.fromisoformat(str)
+            except ValueError:
+                raise InvalidDataFormatException("could not cast date")
         try:
             return datetime.strptime(str, date_format)
         except ValueError:
             raise InvalidDataFormatException("could not cast date")
 
-    def localize_dates(self, tz_src: str, tz_dst: str):
-        src = pytz.timezone(tz_src)
-        dst = pytz.timezone(tz_dst)
+    def localize_dates(self, tz_src: str, tz_dst: str, backend=timezones.PYTZ):
+        with metrics.span("localize_dates"):
+            self.__localize_dates(tz_src, tz_dst, backend)
 
-        for key in DataProcessor.TYPE_TABLE:
+    def __localize_dates(self, tz_src, tz_dst, backend):
+        localizer = DateLocalizer(tz_src, tz_dst, backend)
+        for key in self.__columns:
             if DataProcessor.TYPE_TABLE[key] is datetime:
-                for entry in self.__data:
-                    entry[key] = src.localize(entry[key]).astimezone(dst)
+                self.__columns[key] = localizer.localize_all(self.__columns[key])
+        if self.__index is not None:
+            # Dates are part of the index keys
+            self.__index = DataProcessor.__build_index(self.__columns, self.__size)
+        self.__version = next(DataProcessor.__versions)
 
     def get(self, key, start=None, end=None):
         start_from = start if start is not None else 0
         end_at = end if end is not None else self.size()
-        actual_key = DataProcessor.LOOKUP_TABLE[key]
-        values = list(map(lambda x: x[actual_key], self.__data))
-        return values[start_from:end_at]
+        column = self.__columns[DataProcessor.LOOKUP_TABLE[key]]
+        values = column[start_from:end_at]
+        if isinstance(values, array):
+            return values.tolist()
+        return values
+
+    def get_view(self, key, start=None, end=None):
+        column = self.__columns[DataProcessor.LOOKUP_TABLE[key]]
+        if isinstance(column, array):
+            return memoryview(column)[start:end]
+        return column[start:end]
+
+    def last_date(self):
+        if self.__size == 0:
+            return None
+        return self.__columns[DataProcessor.LOOKUP_TABLE["date"]][-1]
 
     def size(self):
-        return len(self.__data)
+        return self.__size
+
+    def is_regional(self):
+        return self.__regional
+
+    def version(self):
+        # Unique across instances, changes whenever the data changes
+        return self.__version
+
+
+class GroupIndex:
+
+    # Maintained row by row while data is ingested: the columns of every
+    # group stored contiguously, the row of each (group, date) pair and the
+    # day each row belongs to, so that per-group queries never scan the
+    # whole dataset.
+
+    def __init__(self, columns, group_field, date_field):
+        self.__fields = list(columns)
+        self.__group_field = group_field
+        self.__group_position = self.__fields.index(group_field)
+        self.__date_position = self.__fields.index(date_field)
+        self.__typecodes = {field: column.typecode if isinstance(column, array) else None
+                            for field, column in columns.items()}
+        self.__groups = {}
+        self.__rows = {}
+        self.__days = {}
+        self.__dates = []
+        self.__row_days = array(DataProcessor.INT_ARRAY_TYPECODE)
+
+    def add(self, row, values):
+        group = values[self.__group_position]
+        date = values[self.__date_position]
+        columns = self.__groups.get(group)
+        if columns is None:
+            columns = {field: array(typecode) if typecode is not None else []
+                       for field, typecode in self.__typecodes.items()}
+            self.__groups[group] = columns
+        for field, value in zip(self.__fields, values):
+            columns[field].append(value)
+        self.__rows[(group, date)] = row
+        day = self.__days.get(date)
+        if day is None:
+            day = len(self.__dates)
+            self.__days[date] = day
+            self.__dates.append(date)
+        self.__row_days.append(day)
+
+    def copy(self):
+        index = GroupIndex.__new__(GroupIndex)
+        index.__fields = self.__fields
+        index.__group_field = self.__group_field
+        index.__group_position = self.__group_position
+        index.__date_position = self.__date_position
+        index.__typecodes = self.__typecodes
+        index.__groups = {group: {field: column[:] for field, column in columns.items()}
+                          for group, columns in self.__groups.items()}
+        index.__rows = dict(self.__rows)
+        index.__days = dict(self.__days)
+        index.__dates = self.__dates[:]
+        index.__row_days = self.__row_days[:]
+        return index
+
+    def group_field(self):
+        return self.__group_field
+
+    def groups(self):
+        return list(self.__groups)
+
+    def group_columns(self, group):
+        return self.__groups[group]
+
+    def group_size(self, group):
+        return len(self.__groups[group][self.__group_field])
+
+    def row(self, group, date):
+        return self.__rows[(group, date)]
+
+    def dates(self):
+        return self.__dates
+
+    def row_days(self):
+        return self.__row_days
 
 
 class InvalidDataFormatException(Exception):
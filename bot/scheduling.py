@@ -0,0 +1,166 @@
+import datetime
+import json
+import logging
+import time
+
+import pytz
+
+log = logging.getLogger(__name__)
+
+
+class PublishWindow:
+
+    def __init__(self, start: datetime.time, end: datetime.time):
+        self.start = start
+        self.end = end
+
+    def bounds(self, day: datetime.date, tz):
+        start = tz.localize(datetime.datetime.combine(day, self.start))
+        end = tz.localize(datetime.datetime.combine(day, self.end))
+        return start, end
+
+    @staticmethod
+    def learn(timestamps, tz, default, margin: datetime.timedelta, min_samples=3):
+        # The window spans the 10th to the 90th percentile of the local times
+        # updates were seen at, so that a single late day does not stretch it
+        minutes = sorted(PublishWindow.__minute_of_day(datetime.datetime.fromtimestamp(t, tz))
+                         for t in timestamps)
+        if len(minutes) < min_samples:
+            first = default.start.hour * 60 + default.start.minute
+            last = default.end.hour * 60 + default.end.minute
+        else:
+            first = minutes[int(0.1 * (len(minutes) - 1))]
+            last = minutes[int(round(0.9 * (len(minutes) - 1)))]
+        margin_minutes = int(margin.total_seconds() // 60)
+        first = max(0, first - margin_minutes)
+        last = min(24 * 60 - 1, last + margin_minutes)
+        return PublishWindow(datetime.time(first // 60, first % 60),
+                             datetime.time(last // 60, last % 60))
+
+    @staticmethod
+    def __minute_of_day(dt):
+        return dt.hour * 60 + dt.minute
+
+
+class AdaptiveScheduler:
+
+    # Polls every `window_interval` seconds inside the window the data is
+    # usually published in and backs off exponentially, up to
+    # `max_interval`, outside of it, without ever sleeping past the start of
+    # the window. Once the update of the day is seen, it sleeps until the
+    # window of the next day.
+
+    def __init__(self, history_path, timezone="Europe/Rome", default_window=("17:00", "18:00"),
+                 margin_minutes=15, history_days=30, window_interval=60, max_interval=1800,
+                 warm_up_lead=300, clock=None, sleep=time.sleep):
+        self.__history_path = history_path
+        self.__tz = pytz.timezone(timezone)
+        self.__default_window = PublishWindow(
+            datetime.datetime.strptime(default_window[0], "%H:%M").time(),
+            datetime.datetime.strptime(default_window[1], "%H:%M").time())
+        self.__margin = datetime.timedelta(minutes=margin_minutes)
+        self.__history_days = history_days
+        self.__window_interval = window_interval
+        self.__max_interval = max_interval
+        self.__warm_up_lead = datetime.timedelta(seconds=warm_up_lead)
+        self.__clock = clock if clock is not None else lambda: datetime.datetime.now(pytz.utc)
+        self.__sleep = sleep
+        self.__misses = 0
+        self.__history = self.__load_history()
+        self.__window = self.__learn_window()
+        self.polls = 0
+
+    def window(self):
+        return self.__window
+
+    def now(self):
+        return self.__clock().astimezone(self.__tz)
+
+    def record_update(self, when: datetime.datetime = None, data_date=None):
+        # Only an update of the data of the day tells when it is published, a
+        # leftover one (e.g. yesterday's, published at startup) is ignored
+        when = when if when is not None else self.now()
+        if data_date is not None and AdaptiveScheduler.__day(data_date) != \
+                when.astimezone(self.__tz).date():
+            log.debug("Update of {0} is not today's, the window is unchanged".format(
+                AdaptiveScheduler.__day(data_date)))
+            return
+        self.__history.append(when.timestamp())
+        self.__history = self.__history[-self.__history_days:]
+        self.__save_history()
+        self.__window = self.__learn_window()
+        log.debug("Publish window is now {0}-{1}".format(
+            self.__window.start.strftime("%H:%M"), self.__window.end.strftime("%H:%M")))
+
+    def next_poll(self, now: datetime.datetime):
+        now = now.astimezone(self.__tz)
+        today = now.date()
+        if self.__updated_on(today):
+            return self.__window.bounds(today + datetime.timedelta(days=1), self.__tz)[0]
+        start, end = self.__window.bounds(today, self.__tz)
+        if start <= now <= end:
+            return now + datetime.timedelta(seconds=self.__window_interval)
+        backoff = min(self.__window_interval * (2 ** self.__misses), self.__max_interval)
+        deadline = now + datetime.timedelta(seconds=backoff)
+        next_start = start if now < start else \
+            self.__window.bounds(today + datetime.timedelta(days=1), self.__tz)[0]
+        return min(deadline, next_start)
+
+    def polled(self, updated, now: datetime.datetime = None):
+        # updated is the date of the published data, or True when unknown
+        now = now if now is not None else self.now()
+        if updated:
+            self.__misses = 0
+            self.record_update(now, None if updated is True else updated)
+            return
+        start, end = self.__window.bounds(now.astimezone(self.__tz).date(), self.__tz)
+        if start <= now <= end:
+            self.__misses = 0
+        else:
+            self.__misses = self.__misses + 1
+
+    def run(self, poll, warm_up=None, cycles=None):
+        # poll() returns the date of the data it published (or True), a
+        # false value when there was nothing to publish
+        while cycles is None or self.polls < cycles:
+            now = self.now()
+            deadline = self.next_poll(now)
+            if warm_up is not None:
+                warm_up_at = self.__window.bounds(deadline.date(), self.__tz)[0] - self.__warm_up_lead
+                if now < warm_up_at <= deadline:
+                    self.__sleep_until(warm_up_at)
+                    warm_up()
+            self.__sleep_until(deadline)
+            updated = poll()
+            self.polls = self.polls + 1
+            self.polled(updated)
+
+    def __sleep_until(self, deadline):
+        delay = (deadline - self.now()).total_seconds()
+        if delay > 0:
+            self.__sleep(delay)
+
+    @staticmethod
+    def __day(value):
+        return value.date() if isinstance(value, datetime.datetime) else value
+
+    def __updated_on(self, day):
+        return len(self.__history) > 0 and \
+            datetime.datetime.fromtimestamp(self.__history[-1], self.__tz).date() == day
+
+    def __learn_window(self):
+        return PublishWindow.learn(self.__history, self.__tz, self.__default_window, self.__margin)
+
+    def __load_history(self):
+        try:
+            with open(self.__history_path, "r") as file:
+                return [float(t) for t in json.load(file)][-self.__history_days:]
+        except (IOError, ValueError, TypeError):
+            return []
+
+    def __save_history(self):
+        try:
+            with open(self.__history_path, "w") as file:
+                json.dump(self.__history, file)
+        except IOError as e:
+            log.warning("Could not save the update history: " + str(e))
@@ -0,0 +1,112 @@
+from bisect import bisect_right
+from datetime import datetime, timedelta
+
+import pytz
+
+PYTZ = "pytz"
+ZONEINFO = "zoneinfo"
+BACKENDS = [PYTZ, ZONEINFO]
+
+ZERO = timedelta(0)
+
+
+class DateLocalizer:
+
+    # Turns naive datetimes of tz_src into aware datetimes of tz_dst, giving
+    # the same result as pytz's tz_src.localize(value).astimezone(tz_dst).
+    #
+    # With pytz, offsets only change at the transitions listed in the table
+    # pytz itself bisects on every conversion, so they are looked up once per
+    # stretch of time between two transitions (twice a year for Europe/Rome)
+    # and reused while the values stay in it. On the source side, wall times
+    # less than SOURCE_MARGIN away from a transition may be ambiguous or
+    # skipped: they are localized one by one. The zoneinfo backend converts
+    # every value with the standard library, ambiguous and skipped times
+    # being resolved as pytz does by default (is_dst=False).
+
+    # Larger than any difference between two offsets of a timezone
+    SOURCE_MARGIN = timedelta(days=2)
+
+    def __init__(self, tz_src: str, tz_dst: str, backend=PYTZ):
+        if backend not in BACKENDS:
+            raise ValueError("unknown timezone backend " + str(backend))
+        self.__backend = backend
+        if backend == ZONEINFO:
+            self.__src = DateLocalizer.__zoneinfo(tz_src)
+            self.__dst = DateLocalizer.__zoneinfo(tz_dst)
+            return
+        self.__src = pytz.timezone(tz_src)
+        self.__dst = pytz.timezone(tz_dst)
+        self.__src_transitions = getattr(self.__src, "_utc_transition_times", None)
+        self.__dst_transitions = getattr(self.__dst, "_utc_transition_times", None)
+        # [start, end) of the current source (wall time) and destination (UTC)
+        # stretches, empty until the first value
+        self.__src_start = datetime.max
+        self.__src_end = datetime.min
+        self.__src_offset = None
+        self.__dst_start = datetime.max
+        self.__dst_end = datetime.min
+        self.__dst_offset = None
+        self.__dst_tzinfo = None
+
+    def localize(self, value: datetime):
+        if self.__backend == ZONEINFO:
+            return self.__zoneinfo_localize(value).astimezone(self.__dst)
+        if not self.__src_start <= value < self.__src_end:
+            if not self.__enter_src_stretch(value):
+                return self.__src.localize(value).astimezone(self.__dst)
+        utc = value - self.__src_offset
+        if not self.__dst_start <= utc < self.__dst_end:
+            self.__enter_dst_stretch(utc)
+        return (utc + self.__dst_offset).replace(tzinfo=self.__dst_tzinfo)
+
+    def localize_all(self, values):
+        return [self.localize(value) for value in values]
+
+    def __enter_src_stretch(self, value):
+        # False if value is too close to a transition
+        offset = self.__src.localize(value).utcoffset()
+        transitions = self.__src_transitions
+        if not transitions:
+            start, end = datetime.min, datetime.max
+        else:
+            i = max(0, bisect_right(transitions, value - offset) - 1)
+            start = transitions[i] + offset + DateLocalizer.SOURCE_MARGIN if i > 0 else datetime.min
+            end = transitions[i + 1] + offset - DateLocalizer.SOURCE_MARGIN \
+                if i + 1 < len(transitions) else datetime.max
+            if not start <= value < end:
+                return False
+        self.__src_start = start
+        self.__src_end = end
+        self.__src_offset = offset
+        return True
+
+    def __enter_dst_stretch(self, utc):
+        converted = self.__dst.fromutc(utc.replace(tzinfo=self.__dst))
+        self.__dst_offset = converted.utcoffset()
+        self.__dst_tzinfo = converted.tzinfo
+        transitions = self.__dst_transitions
+        if not transitions:
+            self.__dst_start = datetime.min
+            self.__dst_end = datetime.max
+            return
+        # Same lookup as DstTzInfo.fromutc
+        i = max(0, bisect_right(transitions, utc) - 1)
+        self.__dst_start = transitions[i] if i > 0 else datetime.min
+        self.__dst_end = transitions[i + 1] if i + 1 < len(transitions) else datetime.max
+
+    def __zoneinfo_localize(self, value):
+        first = value.replace(tzinfo=self.__src)
+        second = value.replace(tzinfo=self.__src, fold=1)
+        if first.utcoffset() == second.utcoffset():
+            return first
+        # Ambiguous or skipped wall time: pytz picks the standard time
+        return second if second.dst() == ZERO and first.dst() != ZERO else first
+
+    @staticmethod
+    def __zoneinfo(name):
+        try:
+            import zoneinfo
+        except ImportError:
+            raise ValueError("the zoneinfo backend needs Python 3.9 or later")
+        return zoneinfo.ZoneInfo(name)
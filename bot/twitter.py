@@ -1,7 +1,107 @@
-import twitter
-from twitter.api import CHARACTER_LIMIT
+import json
+import os
+import re
+import sys
+import time
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum
 
+from bot import metrics
+
+# Same as twitter.api.CHARACTER_LIMIT. python-twitter (and requests with it)
+# is only imported by PythonTwitterBackend, so that a poller that has nothing
+# to tweet never loads it
+CHARACTER_LIMIT = 280
+
+# Twitter weighs characters instead of counting them, see the v3
+# configuration of twitter-text: most characters weigh 200, the ones in the
+# ranges below weigh 100, every URL counts as 23 characters and an emoji
+# sequence as 2 however many code points it is made of
+
+WEIGHT_SCALE = 100
+DEFAULT_WEIGHT = 200
+LIGHT_WEIGHT = 100
+LIGHT_WEIGHT_RANGES = [(0, 4351), (8192, 8205), (8208, 8223), (8242, 8247)]
+URL_WEIGHT = 23 * WEIGHT_SCALE
+EMOJI_WEIGHT = 2 * WEIGHT_SCALE
+URL_REGEX = re.compile(r"https?://\S+")
+
+# Error codes of the Twitter API that the same request always gets again:
+# status too long, duplicate status, invalid media ID, reply to a deleted
+# status
+PERMANENT_ERROR_CODES = {186, 187, 324, 385}
+
+
+def weighted_length(text: str):
+    weight = 0
+    position = 0
+    for match in URL_REGEX.finditer(text):
+        weight = weight + _text_weight(text, position, match.start()) + URL_WEIGHT
+        position = match.end()
+    weight = weight + _text_weight(text, position, len(text))
+    return weight // WEIGHT_SCALE
+
+
+def _text_weight(text, start, end):
+    weight = 0
+    i = start
+    while i < end:
+        emoji_end = _emoji_end(text, i, end)
+        if emoji_end > i:
+            weight = weight + EMOJI_WEIGHT
+            i = emoji_end
+            continue
+        weight = weight + _char_weight(ord(text[i]))
+        i = i + 1
+    return weight
+
+
+def _char_weight(code_point):
+    for first, last in LIGHT_WEIGHT_RANGES:
+        if first <= code_point <= last:
+            return LIGHT_WEIGHT
+    return DEFAULT_WEIGHT
+
+
+def _is_pictographic(code_point):
+    return 0x1F000 <= code_point <= 0x1FAFF or 0x2600 <= code_point <= 0x27BF or \
+        0x2300 <= code_point <= 0x23FF or 0x2B00 <= code_point <= 0x2BFF
+
+
+def _is_emoji_modifier(code_point):
+    # Variation selector, keycap, skin tones and tags
+    return code_point == 0xFE0F or code_point == 0x20E3 or \
+        0x1F3FB <= code_point <= 0x1F3FF or 0xE0020 <= code_point <= 0xE007F
+
+
+def _is_regional_indicator(code_point):
+    return 0x1F1E6 <= code_point <= 0x1F1FF
+
+
+def _emoji_end(text, i, end):
+    # Index right after the emoji sequence starting at i, i if there is none
+    code_point = ord(text[i])
+    if _is_regional_indicator(code_point):
+        # Flags are pairs of regional indicators
+        if i + 1 < end and _is_regional_indicator(ord(text[i + 1])):
+            return i + 2
+        return i + 1
+    j = i + 1
+    if not _is_pictographic(code_point):
+        # Digits and symbols become emoji when followed by a selector or a keycap
+        if j >= end or not (ord(text[j]) == 0xFE0F or ord(text[j]) == 0x20E3):
+            return i
+    while j < end:
+        code_point = ord(text[j])
+        if _is_emoji_modifier(code_point):
+            j = j + 1
+        elif code_point == 0x200D and j + 1 < end and _is_pictographic(ord(text[j + 1])):
+            j = j + 2
+        else:
+            break
+    return j
+
 
 class MediaType(Enum):
     PHOTO = 1,
@@ -9,30 +109,191 @@ class MediaType(Enum):
     VIDEO = 3
 
 
+class PlannedTweet:
+
+    def __init__(self, text, media, length):
+        self.text = text
+        self.media = media
+        self.length = length
+
+
+class ThreadCheckpoint:
+
+    # Persists a planned thread and the IDs of the tweets already posted, so
+    # that a failed thread can be completed later instead of being posted
+    # again. The key (e.g. the date of the data) tells threads apart.
+    #
+    # A checkpoint also records when its thread was planned and how many
+    # attempts to post it failed with a permanent error. It expires once it
+    # is older than max_age seconds (the media it refers to expire on
+    # Twitter's side) or after max_failures such attempts, the thread then
+    # has to be planned again with fresh uploads.
+
+    def __init__(self, path, key, max_age=None, max_failures=None):
+        self.__path = path
+        self.__key = key
+        self.__max_age = max_age
+        self.__max_failures = max_failures
+
+    def load(self):
+        state = self.__load_state()
+        if state is None:
+            return None
+        tweets = [PlannedTweet(tweet["text"], tweet["media"], tweet["length"])
+                  for tweet in state["tweets"]]
+        return tweets, state["status_ids"]
+
+    def save(self, tweets, status_ids):
+        # The creation time and failures of the thread are kept, a thread
+        # that is not checkpointed yet starts from scratch
+        state = self.__load_state() or {}
+        self.__write({
+            "key": self.__key,
+            "created": state.get("created", time.time()),
+            "failures": state.get("failures", 0),
+            "tweets": [{"text": tweet.text, "media": tweet.media, "length": tweet.length}
+                       for tweet in tweets],
+            "status_ids": status_ids
+        })
+
+    def record_failure(self):
+        state = self.__load_state()
+        if state is None:
+            return
+        state["failures"] = state.get("failures", 0) + 1
+        self.__write(state)
+
+    def expired(self):
+        state = self.__load_state()
+        if state is None:
+            return False
+        if self.__max_age is not None and time.time() - state.get("created", 0) > self.__max_age:
+            return True
+        return self.__max_failures is not None and state.get("failures", 0) >= self.__max_failures
+
+    def clear(self):
+        try:
+            os.remove(self.__path)
+        except FileNotFoundError:
+            pass
+
+    def __load_state(self):
+        try:
+            with open(self.__path, "r") as file:
+                state = json.load(file)
+        except (IOError, ValueError):
+            return None
+        if state.get("key") != self.__key:
+            return None
+        return state
+
+    def __write(self, state):
+        # Written aside and renamed, a crash never leaves half a checkpoint
+        tmp_path = str(self.__path) + ".tmp"
+        with open(tmp_path, "w") as file:
+            json.dump(state, file)
+        os.replace(tmp_path, self.__path)
+
+
+class TwitterBackend(ABC):
+
+    @abstractmethod
+    def post_update(self, text, media=None, in_reply_to_status_id=None):
+        # Returns the ID of the posted status
+        pass
+
+    @abstractmethod
+    def upload_media(self, media, media_category):
+        # Returns the ID of the uploaded media
+        pass
+
+    def close(self):
+        pass
+
+
+class PythonTwitterBackend(TwitterBackend):
+
+    def __init__(self, consumer_key, consumer_secret, access_token_key, access_token_secret,
+                 base_url=None, upload_url=None, sleep_on_rate_limit=True, timeout=None):
+        import twitter
+        self.__api = twitter.Api(consumer_key, consumer_secret, access_token_key, access_token_secret,
+                                 base_url=base_url, upload_url=upload_url, timeout=timeout,
+                                 sleep_on_rate_limit=sleep_on_rate_limit, tweet_mode="extended")
+
+    def post_update(self, text, media=None, in_reply_to_status_id=None):
+        status = self.__api.PostUpdate(text, media=media, in_reply_to_status_id=in_reply_to_status_id,
+                                       auto_populate_reply_metadata=False)
+        return status.id
+
+    def upload_media(self, media, media_category):
+        return self.__api.UploadMediaChunked(media, media_category=media_category)
+
+    def close(self):
+        # A new Api, and HTTP session, is created for every thread
+        self.__api._session.close()
+
+
+def _is_retryable(error):
+    if isinstance(error, IOError):
+        return True
+    # A TwitterError can only have been raised once python-twitter is loaded
+    twitter_error = sys.modules.get("twitter.error")
+    return twitter_error is not None and isinstance(error, twitter_error.TwitterError) and \
+        not _is_permanent(error)
+
+
+def _is_permanent(error):
+    # Twitter rejects the request for good, e.g. a duplicate status or a
+    # media ID that expired: trying again cannot help
+    twitter_error = sys.modules.get("twitter.error")
+    if twitter_error is None or not isinstance(error, twitter_error.TwitterError):
+        return False
+    messages = error.message if isinstance(error.message, list) else [error.message]
+    return any(isinstance(message, dict) and message.get("code") in PERMANENT_ERROR_CODES
+               for message in messages)
+
+
 class ThreadTwitter:
 
     HEADER_MAX_LENGTH = 50
     FOOTER_MAX_LENGTH = 50
     LINE_MAX_LENGTH = CHARACTER_LIMIT - HEADER_MAX_LENGTH - FOOTER_MAX_LENGTH - 4
+    MEDIA_CATEGORIES = {
+        MediaType.PHOTO: "tweet_image",
+        MediaType.GIF: "tweet_gif",
+        MediaType.VIDEO: "tweet_video"
+    }
+    SERVICE_TWEET_TEXT = "Service tweet"
 
-    def __init__(self, consumer_key, consumer_secret, access_token_key, access_token_secret):
+    def __init__(self, consumer_key=None, consumer_secret=None, access_token_key=None, access_token_secret=None,
+                 backend: TwitterBackend = None, upload_workers=4, upload_retries=3, retry_delay=1.0,
+                 post_retries=0):
+        self.__upload_workers = upload_workers
+        self.__upload_retries = upload_retries
+        self.__retry_delay = retry_delay
+        self.__post_retries = post_retries
         self.__header = None
+        self.__header_length = 0
         self.__repeat_header = False
         self.__footer = None
+        self.__footer_length = 0
         self.__repeat_footer = False
         self.__lines = []
         self.__media = []
-        self.__api = twitter.Api(
-            consumer_key, consumer_secret, access_token_key, access_token_secret, sleep_on_rate_limit=True, tweet_mode="extended")
+        if backend is None:
+            backend = PythonTwitterBackend(
+                consumer_key, consumer_secret, access_token_key, access_token_secret)
+        self.__backend = backend
 
     def set_header(self, header: str, repeat=True):
         if header is None:
             self.__header = None
             return
-        if len(header) > ThreadTwitter.HEADER_MAX_LENGTH:
+        if weighted_length(header) > ThreadTwitter.HEADER_MAX_LENGTH:
             raise ValueError(
-                "len(header) must be < ThreadTwitter.HEADER_MAX_LENGTH")
+                "weighted_length(header) must be < ThreadTwitter.HEADER_MAX_LENGTH")
         self.__header = header + "\n\n"
+        self.__header_length = weighted_length(self.__header)
         self.__repeat_header = repeat
 
     def set_footer(self, footer: str, repeat=True):
@@ -40,70 +301,187 @@ class ThreadTwitter:
             self.__footer = None
             self.__repeat_footer = False
             return
-        if len(footer) > ThreadTwitter.HEADER_MAX_LENGTH:
+        if weighted_length(footer) > ThreadTwitter.FOOTER_MAX_LENGTH:
             raise ValueError(
-                "len(footer) must be < ThreadTwitter.FOOTER_MAX_LENGTH")
+                "weighted_length(footer) must be < ThreadTwitter.FOOTER_MAX_LENGTH")
         self.__footer = "\n" + footer
+        self.__footer_length = weighted_length(self.__footer)
         self.__repeat_footer = repeat
 
     def add_line(self, line: str, force_new_tweet=False):
-        if len(line) > ThreadTwitter.LINE_MAX_LENGTH:
+        length = weighted_length(line)
+        if length > ThreadTwitter.LINE_MAX_LENGTH:
             raise ValueError(
-                "len(line) must be < ThreadTwitter.LINE_MAX_LENGTH")
+                "weighted_length(line) must be < ThreadTwitter.LINE_MAX_LENGTH")
         if len(self.__lines) == 0:
             force_new_tweet = False
-        tup = (line + "\n", force_new_tweet)
-        self.__lines.append(tup)
+        self.__lines.append((line, force_new_tweet, length))
 
     def add_media(self, media, media_type: MediaType):
         self.__media.append((media, media_type))
 
-    def tweet(self):
-        tweet_texts = []
-        current_tweet = None
-        if not self.__repeat_footer and self.__footer is not None:
-            self.__lines.append((self.__footer, False))
-
-        for i in range(len(self.__lines)):
-            line, force_new = self.__lines[i]
-            if current_tweet is None:
-                current_tweet = self.__prep_new_tweet_text(len(tweet_texts))
-            if force_new or not self.__can_add_line_in_tweet(current_tweet, line):
-                tweet_texts.append(
-                    self.__append_footer_if_needed(current_tweet).strip())
-                current_tweet = self.__prep_new_tweet_text(len(tweet_texts))
-            current_tweet = current_tweet + line
-            if i == len(self.__lines) - 1:
-                tweet_texts.append(
-                    self.__append_footer_if_needed(current_tweet).strip())
+    def upload_media(self, media, media_type=MediaType.PHOTO):
+        return self.__with_retries("upload", self.__upload_retries, self.__backend.upload_media,
+                                   media, ThreadTwitter.MEDIA_CATEGORIES[media_type])
 
+    def plan(self):
+        lines = self.__lines
         if not self.__repeat_footer and self.__footer is not None:
-            self.__lines.pop()
+            lines = lines + [(self.__footer, False, self.__footer_length)]
 
         tweets = []
+        for text, length in self.__pack(lines):
+            tweets.append(PlannedTweet(text, None, length))
 
         media_index = 0
-        for i in range(len(tweet_texts)):
-            medias = []
+        for i in range(len(tweets)):
             if media_index < len(self.__media):
                 medias = self.__get_next_medias(media_index)
                 media_index = media_index + len(medias)
-            if len(medias) == 0:
-                medias = None
-            tweets.append((tweet_texts[i], medias))
+                if len(medias) > 0:
+                    tweets[i].media = medias
 
         while media_index < len(self.__media):
             medias = self.__get_next_medias(media_index)
             media_index = media_index + len(medias)
-            if len(medias) == 0:
-                medias = None
-            tweets.append(("Service tweet", medias))
+            tweets.append(PlannedTweet(ThreadTwitter.SERVICE_TWEET_TEXT,
+                                       medias if len(medias) > 0 else None,
+                                       weighted_length(ThreadTwitter.SERVICE_TWEET_TEXT)))
+        return tweets
+
+    def tweet(self, on_posted=None, checkpoint: ThreadCheckpoint = None):
+        self.__upload_pending_media()
+        tweets = self.plan()
+        status_ids = []
+        if checkpoint is not None:
+            # Replaces an expired checkpoint of the same thread: the tweets
+            # it already posted are kept and the thread goes on after them,
+            # with the media just uploaded
+            state = checkpoint.load()
+            if state is not None and ThreadTwitter.__is_posted_prefix(tweets, *state):
+                status_ids = state[1]
+            checkpoint.clear()
+            checkpoint.save(tweets, status_ids)
+        self.__post(tweets, status_ids, on_posted, checkpoint)
+
+    def resume(self, checkpoint: ThreadCheckpoint, on_posted=None):
+        # Posts what is left of a checkpointed thread, the media it refers to
+        # are already uploaded. Returns False if there is nothing to resume.
+        state = checkpoint.load()
+        if state is None:
+            return False
+        tweets, status_ids = state
+        self.__post(tweets, status_ids, on_posted, checkpoint)
+        return True
+
+    def close(self):
+        self.__lines.clear()
+        self.__media.clear()
+        self.__backend.close()
+
+    def __post(self, tweets, status_ids, on_posted, checkpoint):
+        for i in range(len(status_ids), len(tweets)):
+            status_id_reply = status_ids[-1] if len(status_ids) > 0 else None
+            # A post is retried only when asked to: a status that reached
+            # Twitter despite the error would be duplicated
+            try:
+                status_id = self.__with_retries("post", self.__post_retries, self.__backend.post_update,
+                                                tweets[i].text, media=tweets[i].media,
+                                                in_reply_to_status_id=status_id_reply)
+            except Exception as e:
+                if checkpoint is not None and _is_permanent(e):
+                    checkpoint.record_failure()
+                raise
+            status_ids.append(status_id)
+            metrics.inc("tweets_posted")
+            if checkpoint is not None:
+                checkpoint.save(tweets, status_ids)
+            if on_posted is not None:
+                on_posted(i, status_id)
+        if checkpoint is not None:
+            checkpoint.clear()
+
+    @staticmethod
+    def __is_posted_prefix(tweets, posted_tweets, status_ids):
+        posted = len(status_ids)
+        return posted <= len(tweets) and \
+            [tweet.text for tweet in tweets[:posted]] == [tweet.text for tweet in posted_tweets[:posted]]
+
+    def __pack(self, lines):
+        # Lines are kept in order and a tweet only grows while the next line
+        # fits: since the room left for lines only depends on the position of
+        # the tweet in the thread, filling each tweet up is what minimizes
+        # their number. Every line costs its weighted length plus a newline.
+        packed = []
+        current = []
+        current_length = 0
+        for line, force_new, length in lines:
+            if len(current) > 0 and (force_new or self.__tweet_length(
+                    len(packed), current_length + length + 1) > CHARACTER_LIMIT):
+                packed.append(self.__build_tweet(len(packed), current, current_length))
+                current = []
+                current_length = 0
+            current.append(line)
+            current_length = current_length + length + 1
+        if len(current) > 0:
+            packed.append(self.__build_tweet(len(packed), current, current_length))
+        return packed
 
-        status_id_reply = None
-        for tweet_txt, tweet_media in tweets:
-            status = self.__api.PostUpdate(
-                tweet_txt, media=tweet_media, in_reply_to_status_id=status_id_reply, auto_populate_reply_metadata=False)
-            status_id_reply = status.id
+    def __build_tweet(self, tweet_num, lines, lines_length):
+        text = "".join([self.__prefix(tweet_num), "\n".join(lines), "\n", self.__suffix()])
+        return text.strip(), self.__tweet_length(tweet_num, lines_length)
+
+    def __tweet_length(self, tweet_num, lines_length):
+        length = lines_length
+        if self.__prefix(tweet_num) != "":
+            length = length + self.__header_length
+        if self.__suffix() != "":
+            length = length + self.__footer_length
+        else:
+            # The newline after the last line is stripped
+            length = length - 1
+        return length
+
+    def __prefix(self, tweet_num):
+        if (tweet_num == 0 or self.__repeat_header) and (self.__header is not None):
+            return self.__header
+        return ""
+
+    def __suffix(self):
+        if self.__repeat_footer and self.__footer is not None:
+            return self.__footer
+        return ""
+
+    def __upload_pending_media(self):
+        # Media not yet uploaded are uploaded all together before posting, so
+        # that the thread is posted using media IDs only
+        pending = [i for i in range(len(self.__media))
+                   if not isinstance(self.__media[i][0], int)]
+        if len(pending) == 0:
+            return
+        with ThreadPoolExecutor(max_workers=min(self.__upload_workers, len(pending))) as executor:
+            futures = {}
+            for i in pending:
+                futures[i] = executor.submit(self.upload_media, *self.__media[i])
+            for i in pending:
+                self.__media[i] = (futures[i].result(), self.__media[i][1])
+
+    def __with_retries(self, operation, retries, func, *args, **kwargs):
+        # The timing of an operation includes its retries
+        attempt = 0
+        with metrics.span("twitter_request", operation=operation):
+            while True:
+                try:
+                    return func(*args, **kwargs)
+                except Exception as e:
+                    if not _is_retryable(e):
+                        raise
+                    if attempt >= retries:
+                        metrics.inc("twitter_failures", operation=operation)
+                        raise
+                    metrics.inc("twitter_retries", operation=operation)
+                    time.sleep(self.__retry_delay * (2 ** attempt))
+                    attempt = attempt + 1
 
     def __get_next_medias(self, index):
         medias = []
@@ -117,20 +495,3 @@ class ThreadTwitter:
                 else:
                     break
         return medias
-
-    def __prep_new_tweet_text(self, tweet_num):
-        if (tweet_num == 0 or self.__repeat_header) and (self.__header is not None):
-            return self.__header
-        else:
-            return ""
-
-    def __can_add_line_in_tweet(self, current_tweet, new_line):
-        footer_size = len(
-            self.__footer) if self.__repeat_footer and self.__footer is not None else 0
-        return len(current_tweet) + len(new_line) + footer_size <= CHARACTER_LIMIT
-
-    def __append_footer_if_needed(self, current_tweet):
-        if self.__repeat_footer and self.__footer is not None:
-            return current_tweet + self.__footer
-        else:
-            return current_tweet
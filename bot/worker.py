@@ -0,0 +1,56 @@
+import importlib
+import logging
+import multiprocessing
+import sys
+
+from bot import metrics
+
+log = logging.getLogger(__name__)
+
+
+class WorkerError(Exception):
+    pass
+
+
+def _run(conn, module, function, args):
+    # The function is looked up by name: the ones of a module run with
+    # python -m live in __main__, which a spawned process cannot unpickle
+    exit_code = 0
+    try:
+        getattr(importlib.import_module(module), function)(*args)
+    except Exception as e:
+        log.exception("Worker {0} failed: {1}".format(function, e))
+        exit_code = 1
+    finally:
+        # Also sent on failure, what was done before the error counts too
+        conn.send(metrics.registry.snapshot())
+        conn.close()
+    sys.exit(exit_code)
+
+
+def run(module, function, args=(), timeout=None, start_method="spawn"):
+    # Runs module.function(*args) in a new process and waits for it to exit,
+    # the metrics it recorded are merged into the registry of this process.
+    # Everything the function allocated goes back to the OS with the process
+    # and a crash of it only raises WorkerError here. The process is not a
+    # daemon, so it can start processes of its own (e.g. to render images).
+    context = multiprocessing.get_context(start_method)
+    receiver, sender = context.Pipe(duplex=False)
+    process = context.Process(target=_run, args=(sender, module, function, args),
+                              name="worker-" + function)
+    process.start()
+    sender.close()
+    try:
+        if not receiver.poll(timeout):
+            process.terminate()
+            raise WorkerError("{0} did not finish in {1}s".format(function, timeout))
+        try:
+            metrics.registry.merge(receiver.recv())
+        except EOFError:
+            # Died before reporting
+            pass
+    finally:
+        receiver.close()
+        process.join()
+    if process.exitcode != 0:
+        raise WorkerError("{0} exited with code {1}".format(function, process.exitcode))
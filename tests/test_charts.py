@@ -0,0 +1,358 @@
+import datetime
+import json
+import os
+import tempfile
+import threading
+import time
+import unittest
+from pathlib import Path
+from unittest.mock import Mock
+from unittest.mock import patch
+
+import plotly.graph_objects as go
+
+from bot import metrics
+from bot.charts import ChartBuilder
+from bot.charts import ChartManager
+from bot.charts import ChartSpec
+from bot.charts import ImageRenderer
+from bot.charts import RenderCache
+from bot.charts import TraceSpec
+from bot.fetch import FetchResult
+from bot.pipeline import StageTimer
+
+
+class FakeBackend:
+
+    def __init__(self, fail_renders=0):
+        self.running = False
+        self.starts = 0
+        self.renders = 0
+        self.fail_renders = fail_renders
+
+    def start(self):
+        self.running = True
+        self.starts = self.starts + 1
+
+    def stop(self):
+        self.running = False
+
+    def is_running(self):
+        return self.running
+
+    def render(self, figure, fpath, scale):
+        if self.fail_renders > 0:
+            self.fail_renders = self.fail_renders - 1
+            raise RuntimeError("renderer crashed")
+        self.renders = self.renders + 1
+        if isinstance(figure, go.Figure):
+            figure = figure.to_dict()
+        with open(fpath, "w") as file:
+            json.dump({"title": figure["layout"]["title"]["text"], "scale": scale,
+                       "pid": os.getpid()}, file)
+
+
+# Held by the test process while render workers start, see
+# test_workers_do_not_inherit_held_locks
+HELD_LOCK = threading.Lock()
+
+
+class LockingBackend(FakeBackend):
+
+    def start(self):
+        # A forked worker would get the lock in the state the parent has it
+        if not HELD_LOCK.acquire(timeout=5):
+            raise RuntimeError("inherited a held lock")
+        HELD_LOCK.release()
+        super().start()
+
+
+def create_charts(count):
+    chart_mgr = ChartManager()
+    for i in range(count):
+        chart_mgr.add(go.Figure(data=[go.Scatter(x=[1, 2], y=[i, i])],
+                                layout=dict(title="Chart " + str(i))))
+    return chart_mgr
+
+
+class ChartBuilderTest(unittest.TestCase):
+
+    SERIES = {"x": [1, 2, 3], "a": [4, 5, 6], "b": [7, 8, 9]}
+
+    def test_build_single_plot_chart(self):
+        spec = ChartSpec("Title", [
+            TraceSpec(TraceSpec.SCATTER, "A", "x", "a", "#000000"),
+            TraceSpec(TraceSpec.BAR, "B", "x", "b", "#FFFFFF")
+        ], layout=dict(bargap=0), xaxes=dict(nticks=10))
+        figure = ChartBuilder("Footer").build(spec, ChartBuilderTest.SERIES)
+        self.assertEqual(figure.layout.title.text, "Title")
+        self.assertEqual(figure.layout.bargap, 0)
+        self.assertEqual(figure.layout.xaxis.nticks, 10)
+        self.assertEqual(figure.layout.annotations[0].text, "Footer")
+        self.assertEqual(figure.data[0].type, "scatter")
+        self.assertEqual(figure.data[0].line.color, "#000000")
+        self.assertEqual(figure.data[1].type, "bar")
+        self.assertEqual(list(figure.data[1].y), [7, 8, 9])
+
+    def test_build_chart_with_subplots(self):
+        spec = ChartSpec("Title", [
+            TraceSpec(TraceSpec.BAR, "A", "x", "a", "#000000", subplot=1),
+            TraceSpec(TraceSpec.BAR, "B", "x", "b", "#FFFFFF", subplot=2)
+        ], subplots=2)
+        figure = ChartBuilder("Footer").build(spec, ChartBuilderTest.SERIES)
+        self.assertEqual(figure.data[1].xaxis, "x2")
+        self.assertEqual(figure.data[1].yaxis, "y2")
+        self.assertEqual(figure.layout.xaxis2.anchor, "y2")
+        self.assertLess(figure.layout.xaxis.domain[1], figure.layout.xaxis2.domain[0])
+        self.assertEqual(figure.layout.xaxis2.domain[1], 1.0)
+
+    def test_build_with_title(self):
+        spec = ChartSpec("Default", [TraceSpec(TraceSpec.SCATTER, "A", "x", "a", "#000000")])
+        figure = ChartBuilder("Footer").build(spec, ChartBuilderTest.SERIES, title="Custom")
+        self.assertEqual(figure.layout.title.text, "Custom")
+
+    def test_build_chart_with_unknown_trace_type(self):
+        spec = ChartSpec("Title", [TraceSpec("pie", "A", "x", "a", "#000000")])
+        with self.assertRaises(ValueError):
+            ChartBuilder("Footer").build(spec, ChartBuilderTest.SERIES)
+
+
+class ChartManagerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = Path(self.tmp_dir.name)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def assert_images_in_order(self, paths, count):
+        self.assertEqual(len(paths), count)
+        for i in range(count):
+            self.assertEqual(paths[i], str(self.path / ("chart_" + str(i) + ".png")))
+            with open(paths[i], "r") as file:
+                self.assertEqual(json.load(file)["title"], "Chart " + str(i))
+
+    def test_sequential_rendering(self):
+        renderer = ImageRenderer(FakeBackend(), scale=3.0)
+        paths = create_charts(3).generate_images(self.path, renderer)
+        self.assert_images_in_order(paths, 3)
+        with open(paths[0], "r") as file:
+            self.assertEqual(json.load(file)["scale"], 3.0)
+
+    def test_parallel_rendering_keeps_order(self):
+        renderer = ImageRenderer(FakeBackend(), workers=3)
+        paths = create_charts(6).generate_images(self.path, renderer)
+        renderer.shutdown()
+        self.assert_images_in_order(paths, 6)
+
+    def test_workers_do_not_inherit_held_locks(self):
+        renderer = ImageRenderer(LockingBackend(), workers=2)
+        with HELD_LOCK:
+            renderer.warm_up()
+        paths = create_charts(2).generate_images(self.path, renderer)
+        renderer.shutdown()
+        self.assert_images_in_order(paths, 2)
+
+    def test_no_charts(self):
+        renderer = ImageRenderer(FakeBackend(), workers=4)
+        self.assertEqual(ChartManager().generate_images(self.path, renderer), [])
+
+
+class ImageRendererTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = Path(self.tmp_dir.name)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_backend_is_reused_across_cycles(self):
+        backend = FakeBackend()
+        renderer = ImageRenderer(backend)
+        renderer.warm_up()
+        self.assertTrue(renderer.is_healthy())
+        for _ in range(3):
+            create_charts(2).generate_images(self.path, renderer)
+        self.assertEqual(backend.starts, 1)
+        self.assertEqual(renderer.renders, 6)
+        renderer.shutdown()
+        self.assertFalse(renderer.is_healthy())
+
+    def test_restart_after_max_renders(self):
+        backend = FakeBackend()
+        renderer = ImageRenderer(backend, max_renders=2)
+        create_charts(5).generate_images(self.path, renderer)
+        self.assertEqual(renderer.restarts, 2)
+        self.assertEqual(backend.starts, 3)
+
+    def test_restart_when_not_healthy(self):
+        backend = FakeBackend()
+        renderer = ImageRenderer(backend)
+        renderer.warm_up()
+        backend.running = False
+        create_charts(1).generate_images(self.path, renderer)
+        self.assertEqual(renderer.restarts, 1)
+
+    def test_restart_after_crash(self):
+        backend = FakeBackend(fail_renders=1)
+        renderer = ImageRenderer(backend)
+        paths = create_charts(2).generate_images(self.path, renderer)
+        self.assertEqual(renderer.restarts, 1)
+        self.assertTrue(all(Path(p).exists() for p in paths))
+
+    def test_parallel_workers_stay_warm(self):
+        renderer = ImageRenderer(FakeBackend(), workers=2)
+        renderer.warm_up()
+        self.assertTrue(renderer.is_healthy())
+        pids = set()
+        for _ in range(2):
+            for fpath in create_charts(4).generate_images(self.path, renderer):
+                with open(fpath, "r") as file:
+                    pids.add(json.load(file)["pid"])
+        renderer.shutdown()
+        self.assertLessEqual(len(pids), 2)
+        self.assertEqual(renderer.restarts, 0)
+
+
+class RenderCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = Path(self.tmp_dir.name)
+        self.cache_path = self.path / "cache"
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_unchanged_figures_are_not_rendered_again(self):
+        backend = FakeBackend()
+        cache = RenderCache(self.cache_path)
+        renderer = ImageRenderer(backend, cache=cache)
+        create_charts(3).generate_images(self.path, renderer)
+        for fpath in self.path.glob("chart_*.png"):
+            fpath.unlink()
+        paths = create_charts(3).generate_images(self.path, renderer)
+        self.assertEqual(backend.renders, 3)
+        self.assertEqual(cache.stats(), {"hits": 3, "misses": 3})
+        for i in range(3):
+            with open(paths[i], "r") as file:
+                self.assertEqual(json.load(file)["title"], "Chart " + str(i))
+
+    def test_all_hits_do_not_start_the_renderer(self):
+        cache = RenderCache(self.cache_path)
+        create_charts(2).generate_images(
+            self.path, ImageRenderer(FakeBackend(), cache=cache))
+        backend = FakeBackend()
+        create_charts(2).generate_images(
+            self.path, ImageRenderer(backend, cache=cache))
+        self.assertEqual(backend.starts, 0)
+
+    def test_key_depends_on_figure_and_scale(self):
+        cache = RenderCache(self.cache_path)
+        charts = create_charts(2).charts
+        self.assertEqual(cache.key(charts[0], 2.0),
+                         cache.key(create_charts(1).charts[0], 2.0))
+        self.assertNotEqual(cache.key(charts[0], 2.0), cache.key(charts[1], 2.0))
+        self.assertNotEqual(cache.key(charts[0], 2.0), cache.key(charts[0], 1.0))
+
+    def test_eviction_by_size(self):
+        cache = RenderCache(self.cache_path, max_bytes=1)
+        create_charts(3).generate_images(
+            self.path, ImageRenderer(FakeBackend(), cache=cache))
+        self.assertEqual(len(list(self.cache_path.glob("*.png"))), 0)
+
+    def test_eviction_by_age(self):
+        cache = RenderCache(self.cache_path, max_age=60)
+        create_charts(2).generate_images(
+            self.path, ImageRenderer(FakeBackend(), cache=cache))
+        entries = sorted(self.cache_path.glob("*.png"))
+        old = time.time() - 120
+        os.utime(entries[0], (old, old))
+        cache.evict()
+        self.assertEqual(sorted(self.cache_path.glob("*.png")), entries[1:])
+
+
+def regional_payload(regions, days):
+    entries = []
+    for day in range(days):
+        for code, name in regions:
+            entries.append({
+                "data": "2020-03-{0:02d}T18:00:00".format(day + 1),
+                "codice_regione": code,
+                "denominazione_regione": name,
+                "ricoverati_con_sintomi": 10 + day,
+                "terapia_intensiva": 2 + day,
+                "totale_ospedalizzati": 12 + 2 * day,
+                "isolamento_domiciliare": 5 + day,
+                "totale_positivi": 17 + 3 * day,
+                "variazione_totale_positivi": 3,
+                "nuovi_positivi": 3 + day,
+                "dimessi_guariti": day,
+                "deceduti": day,
+                "totale_casi": 17 + 5 * day,
+                "tamponi": 100 * (day + 1)
+            })
+    return json.dumps(entries).encode("utf-8")
+
+
+class RegionalChartsTest(unittest.TestCase):
+
+    def test_charts_for_every_region(self):
+        import bot.__main__ as bot_main
+
+        regions = [(3, "Lombardia"), (2, "Valle d'Aosta"), (21, "P.A. Bolzano")]
+        fetcher = Mock()
+        fetcher.fetch.return_value = FetchResult(200, regional_payload(regions, 10), True)
+        renderer = ImageRenderer(FakeBackend(), workers=2)
+        with tempfile.TemporaryDirectory() as tmp_dir, \
+                patch.object(bot_main.config, "REGIONAL_CHARTS_PATH", Path(tmp_dir)), \
+                patch.object(bot_main.config, "REGIONAL_LATEST_EXECUTION_DATE_FILE_PATH",
+                             Path(tmp_dir) / ".last_regional"), \
+                patch.object(bot_main, "regional_data_fetcher", fetcher), \
+                patch.object(bot_main, "regional_data_processor", None), \
+                patch.object(bot_main, "image_renderer", renderer):
+            bot_main.generate_regional_charts(StageTimer())
+            renderer.shutdown()
+            directories = sorted(path.name for path in Path(tmp_dir).iterdir() if path.is_dir())
+            self.assertEqual(["lombardia", "p_a_bolzano", "valle_d_aosta"], directories)
+            for name in ["Lombardia", "Valle d'Aosta", "P.A. Bolzano"]:
+                path = Path(tmp_dir) / bot_main.area_directory(name)
+                images = sorted(path.glob("chart_*.png"))
+                self.assertEqual(len(bot_main.CHART_SPECS), len(images))
+                with open(images[0], "r") as file:
+                    self.assertIn(name, json.load(file)["title"])
+            self.assertEqual(3 * len(bot_main.CHART_SPECS), renderer.renders)
+
+    def test_failed_charts_are_retried_after_not_modified(self):
+        import bot.__main__ as bot_main
+
+        fetcher = Mock()
+        fetcher.fetch.side_effect = [FetchResult(200, regional_payload([(3, "Lombardia")], 10), True),
+                                     FetchResult(304, None, False)]
+        render = Mock(side_effect=[IOError("render failed"), None])
+        render.__name__ = "render_regional_charts"
+        national_date = datetime.datetime(2020, 3, 10, 18)
+        metrics.registry.reset()
+        with tempfile.TemporaryDirectory() as tmp_dir, \
+                patch.object(bot_main.config, "REGIONAL_CHARTS", True), \
+                patch.object(bot_main.config, "REGIONAL_LATEST_EXECUTION_DATE_FILE_PATH",
+                             Path(tmp_dir) / ".last_regional"), \
+                patch.object(bot_main, "SUPERVISOR_MODE", False), \
+                patch.object(bot_main, "render_regional_charts", render), \
+                patch.object(bot_main, "regional_data_fetcher", fetcher), \
+                patch.object(bot_main, "regional_data_processor", None), \
+                patch.object(bot_main.log, "disabled", True):
+            for _ in range(3):
+                bot_main.update_regional_charts(StageTimer(), national_date)
+            self.assertEqual("2020-03-10T18:00:00", (Path(tmp_dir) / ".last_regional").read_text())
+        # Rendered again although the data was not modified, then no longer
+        # fetched once the charts caught up with the national data
+        self.assertEqual(2, render.call_count)
+        self.assertEqual(2, fetcher.fetch.call_count)
+        self.assertEqual(1, metrics.registry.get("regional_chart_errors"))
+
+
+if __name__ == "__main__":
+    unittest.main()
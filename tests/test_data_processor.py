@@ -1,4 +1,8 @@
+import io
+import json
+import sys
 import unittest
+from datetime import datetime
 
 from bot.processing import DataProcessor
 from bot.processing import InvalidDataFormatException
@@ -187,6 +191,40 @@ class DataProcessorTest(unittest.TestCase):
         self.assertEqual(dp.get("total_tests", start=2, end=2), [])
         self.assertEqual(dp.get("total_tests", start=1, end=5), [8623, 9587])
 
+    def test_get_view_of_integer_property(self):
+        dp = DataProcessor.initialize([{
+            "data": "2020-02-24T18:00:00",
+            "ricoverati_con_sintomi": 101,
+            "terapia_intensiva": 26,
+            "totale_ospedalizzati": 127,
+            "isolamento_domiciliare": 94,
+            "totale_positivi": 221,
+            "variazione_totale_positivi": 0,
+            "nuovi_positivi": 221,
+            "dimessi_guariti": 1,
+            "deceduti": 7,
+            "totale_casi": 229,
+            "tamponi": 4324
+        },
+            {
+            "data": "2020-02-25T18:00:00",
+            "ricoverati_con_sintomi": 114,
+            "terapia_intensiva": 35,
+            "totale_ospedalizzati": 150,
+            "isolamento_domiciliare": 162,
+            "totale_positivi": 311,
+            "variazione_totale_positivi": 90,
+            "nuovi_positivi": 93,
+            "dimessi_guariti": 1,
+            "deceduti": 10,
+            "totale_casi": 322,
+            "tamponi": 8623
+        }], config.DATE_FORMAT)
+        view = dp.get_view("total_tests", start=1)
+        self.assertIsInstance(view, memoryview)
+        self.assertEqual(view.tolist(), [8623])
+        self.assertEqual(len(dp.get_view("date")), 2)
+
     def test_create_data_processor_with_wrong_date_type_format(self):
         with self.assertRaises(InvalidDataFormatException):
             DataProcessor.initialize([{
@@ -204,6 +242,139 @@ class DataProcessorTest(unittest.TestCase):
                 "tamponi": 15695,
             }], config.DATE_FORMAT)
 
+    def test_stream_matches_in_memory_initialization(self):
+        entries = [{
+            "data": "2020-02-24T18:00:00",
+            "stato": "ITÀ",
+            "ricoverati_con_sintomi": 101,
+            "terapia_intensiva": 26,
+            "totale_ospedalizzati": 127,
+            "isolamento_domiciliare": 94,
+            "totale_positivi": 221,
+            "variazione_totale_positivi": 0,
+            "nuovi_positivi": 221,
+            "dimessi_guariti": 1,
+            "deceduti": 7,
+            "totale_casi": 229,
+            "tamponi": 4324
+        },
+            {
+            "data": "2020-02-25T18:00:00",
+            "stato": "ITÀ",
+            "ricoverati_con_sintomi": 114,
+            "terapia_intensiva": 35,
+            "totale_ospedalizzati": 150,
+            "isolamento_domiciliare": 162,
+            "totale_positivi": 311,
+            "variazione_totale_positivi": 90,
+            "nuovi_positivi": 93,
+            "dimessi_guariti": 1,
+            "deceduti": 10,
+            "totale_casi": 322,
+            "tamponi": 8623
+        }]
+        payload = json.dumps(entries, indent=2, ensure_ascii=False)
+        expected = DataProcessor.initialize(payload, config.DATE_FORMAT)
+        for chunk_size in [1, 7, 4096]:
+            stream = io.BytesIO(payload.encode("utf-8"))
+            dp = DataProcessor.initialize_stream(
+                stream, config.DATE_FORMAT, chunk_size=chunk_size)
+            self.assertEqual(dp.size(), 2)
+            for key in DataProcessor.LOOKUP_TABLE:
+                if DataProcessor.LOOKUP_TABLE[key] in DataProcessor.REGIONAL_FIELDS:
+                    continue
+                self.assertEqual(dp.get(key), expected.get(key))
+
+    def test_stream_with_empty_list(self):
+        dp = DataProcessor.initialize_stream(
+            io.StringIO(" [ ] "), config.DATE_FORMAT)
+        self.assertEqual(dp.size(), 0)
+
+    def test_stream_with_invalid_data(self):
+        with self.assertRaises(InvalidDataFormatException):
+            DataProcessor.initialize_stream(io.BytesIO(b""), config.DATE_FORMAT)
+        with self.assertRaises(InvalidDataFormatException):
+            DataProcessor.initialize_stream(
+                io.BytesIO(b'{"data": 1}'), config.DATE_FORMAT)
+        with self.assertRaises(InvalidDataFormatException):
+            DataProcessor.initialize_stream(
+                io.BytesIO(b'[{"data": "2020-02-24T18:00:00"'), config.DATE_FORMAT)
+        with self.assertRaises(InvalidDataFormatException):
+            DataProcessor.initialize_stream(
+                io.BytesIO(b'[{"data": "2020-02-24T18:00:00"}]'), config.DATE_FORMAT)
+
+    def test_stream_with_trailing_data(self):
+        # Rejected like json.loads does, whichever chunk the data is read in
+        for chunk_size in [1, 3, 64]:
+            for payload in [b"[] x", b"[]\n[]", b'[] {"data": 1}']:
+                with self.assertRaises(InvalidDataFormatException):
+                    DataProcessor.initialize_stream(
+                        io.BytesIO(payload), config.DATE_FORMAT, chunk_size=chunk_size)
+            dp = DataProcessor.initialize_stream(
+                io.BytesIO(b"[] \r\n\t "), config.DATE_FORMAT, chunk_size=chunk_size)
+            self.assertEqual(dp.size(), 0)
+
+    def test_merge_appends_only_newer_entries(self):
+        def entry(date, tests):
+            return {
+                "data": date,
+                "ricoverati_con_sintomi": 101,
+                "terapia_intensiva": 26,
+                "totale_ospedalizzati": 127,
+                "isolamento_domiciliare": 94,
+                "totale_positivi": 221,
+                "variazione_totale_positivi": 0,
+                "nuovi_positivi": 221,
+                "dimessi_guariti": 1,
+                "deceduti": 7,
+                "totale_casi": 229,
+                "tamponi": tests
+            }
+        dp = DataProcessor.initialize(
+            [entry("2020-02-24T18:00:00", 1)], config.DATE_FORMAT)
+        # The already known entry is invalid on purpose: it must not be
+        # validated again.
+        known = entry("2020-02-24T18:00:00", "invalid")
+        new = [entry("2020-02-25T18:00:00", 2),
+               entry("2020-02-26T18:00:00", 3)]
+        self.assertEqual(dp.merge(json.dumps(
+            [known] + new), config.DATE_FORMAT), 2)
+        self.assertEqual(dp.get("total_tests"), [1, 2, 3])
+        version = dp.version()
+        self.assertEqual(dp.merge([known] + new, config.DATE_FORMAT), 0)
+        self.assertEqual(dp.version(), version)
+        self.assertEqual(dp.size(), 3)
+        self.assertEqual(dp.last_date().day, 26)
+
+    def test_merge_into_empty_data_processor(self):
+        dp = DataProcessor.initialize([], config.DATE_FORMAT)
+        self.assertIsNone(dp.last_date())
+        with self.assertRaises(InvalidDataFormatException):
+            dp.merge([{"data": "2020-02-24T18:00:00"}], config.DATE_FORMAT)
+        self.assertEqual(dp.size(), 0)
+
+    def test_copy_is_independent(self):
+        dp = DataProcessor.initialize([{
+            "data": "2020-02-26T18:00:00",
+            "ricoverati_con_sintomi": 345,
+            "terapia_intensiva": 64,
+            "totale_ospedalizzati": 409,
+            "isolamento_domiciliare": 412,
+            "totale_positivi": 821,
+            "variazione_totale_positivi": 233,
+            "nuovi_positivi": 238,
+            "dimessi_guariti": 46,
+            "deceduti": 21,
+            "totale_casi": 888,
+            "tamponi": 15695,
+        }], config.DATE_FORMAT)
+        localized = dp.copy()
+        self.assertNotEqual(localized.version(), dp.version())
+        localized.localize_dates("UTC", "Europe/Rome")
+        self.assertIsNone(dp.get("date")[0].tzinfo)
+        self.assertIsNotNone(localized.get("date")[0].tzinfo)
+        self.assertEqual(localized.get("total_tests"), [15695])
+
     def test_data_localization(self):
         dp = DataProcessor.initialize([{
             "data": "2020-02-26T18:00:00",
@@ -223,6 +394,152 @@ class DataProcessorTest(unittest.TestCase):
         dp.localize_dates("UTC", "Europe/Rome")
         self.assertIsNotNone(dp.get("date")[0].tzinfo)
 
+    @staticmethod
+    def dst_change_entries():
+        return [{
+            "data": date,
+            "ricoverati_con_sintomi": 345,
+            "terapia_intensiva": 64,
+            "totale_ospedalizzati": 409,
+            "isolamento_domiciliare": 412,
+            "totale_positivi": 821,
+            "variazione_totale_positivi": 233,
+            "nuovi_positivi": 238,
+            "dimessi_guariti": 46,
+            "deceduti": 21,
+            "totale_casi": 888,
+            "tamponi": 15695,
+        } for date in ["2020-03-28T18:00:00", "2020-03-29T00:30:00", "2020-03-29T01:30:00",
+                       "2020-03-30T18:00:00"]]
+
+    def test_data_localization_backends(self):
+        dp = DataProcessor.initialize(self.dst_change_entries(), config.DATE_FORMAT)
+        dp.localize_dates("UTC", "Europe/Rome")
+        self.assertEqual([d.strftime("%H:%M %Z") for d in dp.get("date")],
+                         ["19:00 CET", "01:30 CET", "03:30 CEST", "20:00 CEST"])
+        with self.assertRaises(ValueError):
+            dp.localize_dates("UTC", "Europe/Rome", backend="dateutil")
+
+    @unittest.skipUnless(sys.version_info >= (3, 9), "zoneinfo needs Python 3.9 or later")
+    def test_zoneinfo_localization(self):
+        dp = DataProcessor.initialize(self.dst_change_entries(), config.DATE_FORMAT)
+        zoneinfo_dp = dp.copy()
+        dp.localize_dates("UTC", "Europe/Rome")
+        zoneinfo_dp.localize_dates("UTC", "Europe/Rome", backend="zoneinfo")
+        self.assertEqual(dp.get("date"), zoneinfo_dp.get("date"))
+
+
+def regional_entry(date, code, name, cases):
+    return {
+        "data": date,
+        "stato": "ITA",
+        "codice_regione": code,
+        "denominazione_regione": name,
+        "lat": 45.0,
+        "long": 9.0,
+        "ricoverati_con_sintomi": 10,
+        "terapia_intensiva": 2,
+        "totale_ospedalizzati": 12,
+        "isolamento_domiciliare": 5,
+        "totale_positivi": 17,
+        "variazione_totale_positivi": 1,
+        "nuovi_positivi": 3,
+        "dimessi_guariti": 1,
+        "deceduti": 0,
+        "totale_casi": cases,
+        "tamponi": 100,
+        "note": None
+    }
+
+
+REGIONAL_DATA = [
+    regional_entry("2020-02-24T18:00:00", 3, "Lombardia", 172),
+    regional_entry("2020-02-24T18:00:00", 5, "Veneto", 43),
+    regional_entry("2020-02-25T18:00:00", 3, "Lombardia", 240),
+    regional_entry("2020-02-25T18:00:00", 5, "Veneto", 71)
+]
+
+
+class RegionalDataProcessorTest(unittest.TestCase):
+
+    def test_initialize_regional(self):
+        dp = DataProcessor.initialize(json.dumps(REGIONAL_DATA), config.DATE_FORMAT, regional=True)
+        self.assertTrue(dp.is_regional())
+        self.assertEqual(dp.size(), 4)
+        self.assertEqual(dp.get("region_name"), ["Lombardia", "Veneto", "Lombardia", "Veneto"])
+        self.assertEqual(dp.get("region_code"), [3, 5, 3, 5])
+
+    def test_national_data_is_not_regional(self):
+        national = dict(REGIONAL_DATA[0])
+        del national["codice_regione"]
+        del national["denominazione_regione"]
+        with self.assertRaises(InvalidDataFormatException):
+            DataProcessor.initialize([national], config.DATE_FORMAT, regional=True)
+        dp = DataProcessor.initialize([national], config.DATE_FORMAT)
+        self.assertFalse(dp.is_regional())
+        with self.assertRaises(KeyError):
+            dp.get("region_name")
+
+    def test_group_by_region(self):
+        dp = DataProcessor.initialize(REGIONAL_DATA, config.DATE_FORMAT, regional=True)
+        regions = dp.group_by("region_name")
+        self.assertEqual(list(regions), ["Lombardia", "Veneto"])
+        self.assertEqual(regions["Lombardia"].get("total_cases"), [172, 240])
+        self.assertEqual(regions["Veneto"].get("total_cases"), [43, 71])
+        self.assertEqual(regions["Veneto"].last_date().day, 25)
+        self.assertNotEqual(regions["Lombardia"].version(), regions["Veneto"].version())
+
+    def test_merge_regional(self):
+        dp = DataProcessor.initialize(REGIONAL_DATA[:2], config.DATE_FORMAT, regional=True)
+        self.assertEqual(dp.merge(REGIONAL_DATA, config.DATE_FORMAT), 2)
+        self.assertEqual(dp.get("total_cases"), [172, 43, 240, 71])
+        self.assertTrue(dp.copy().is_regional())
+        self.assertEqual(dp.get_group("Veneto", "total_cases"), [43, 71])
+
+
+class GroupIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dp = DataProcessor.initialize(REGIONAL_DATA, config.DATE_FORMAT, regional=True)
+
+    def test_groups(self):
+        self.assertEqual(self.dp.groups(), ["Lombardia", "Veneto"])
+        self.assertEqual(self.dp.get_group("Lombardia", "total_cases"), [172, 240])
+        self.assertEqual(self.dp.get_group("Lombardia", "total_cases", 1), [240])
+        self.assertEqual(self.dp.get_group("Veneto", "date")[1].day, 25)
+        with self.assertRaises(KeyError):
+            self.dp.get_group("Molise", "total_cases")
+
+    def test_lookup(self):
+        date = datetime(2020, 2, 25, 18)
+        self.assertEqual(self.dp.lookup("Veneto", date, "total_cases"), 71)
+        self.assertEqual(self.dp.lookup("Lombardia", date, "region_code"), 3)
+        with self.assertRaises(KeyError):
+            self.dp.lookup("Veneto", datetime(2020, 2, 26, 18), "total_cases")
+
+    def test_aggregate(self):
+        national = self.dp.aggregate()
+        self.assertFalse(national.is_regional())
+        self.assertEqual(national.size(), 2)
+        self.assertEqual(national.get("total_cases"), [215, 311])
+        self.assertEqual(national.get("total_tests"), [200, 200])
+        self.assertEqual(national.last_date(), datetime(2020, 2, 25, 18))
+
+    def test_index_follows_merge_copy_and_localization(self):
+        dp = DataProcessor.initialize(REGIONAL_DATA[:2], config.DATE_FORMAT, regional=True)
+        copy = dp.copy()
+        dp.merge(REGIONAL_DATA, config.DATE_FORMAT)
+        self.assertEqual(dp.get_group("Lombardia", "total_cases"), [172, 240])
+        self.assertEqual(copy.get_group("Lombardia", "total_cases"), [172])
+        dp.localize_dates("UTC", "Europe/Rome")
+        date = dp.get_group("Veneto", "date")[1]
+        self.assertIsNotNone(date.tzinfo)
+        self.assertEqual(dp.lookup("Veneto", date, "total_cases"), 71)
+
+    def test_national_data_is_not_grouped(self):
+        with self.assertRaises(ValueError):
+            self.dp.aggregate().groups()
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,89 @@
+import os
+import tempfile
+import unittest
+from pathlib import Path
+
+from twitter.error import TwitterError
+
+from bot.fake_twitter import FakeTwitterServer
+from bot.twitter import MediaType
+from bot.twitter import PythonTwitterBackend
+from bot.twitter import ThreadTwitter
+
+PNG_HEADER = b"\x89PNG\r\n\x1a\n"
+
+
+def create_backend(server):
+    return PythonTwitterBackend("consumer", "consumer_secret", "token", "token_secret",
+                                base_url=server.base_url, upload_url=server.base_url,
+                                sleep_on_rate_limit=False)
+
+
+class FakeTwitterServerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = FakeTwitterServer(seed=0).start()
+        self.tmp_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.server.stop()
+        self.tmp_dir.cleanup()
+
+    def create_image(self, name, size=4096):
+        path = Path(self.tmp_dir.name) / name
+        with open(path, "wb") as file:
+            file.write(PNG_HEADER + os.urandom(size))
+        return str(path)
+
+    def test_thread_is_posted(self):
+        tt = ThreadTwitter(backend=create_backend(self.server))
+        tt.add_line("Line1")
+        tt.add_line("Line2", force_new_tweet=True)
+        tt.add_media(self.create_image("chart_0.png"), MediaType.PHOTO)
+        tt.add_media(self.create_image("chart_1.png"), MediaType.PHOTO)
+        tt.tweet()
+
+        statuses = self.server.statuses
+        self.assertEqual(2, len(statuses))
+        self.assertEqual("Line1", statuses[0]["full_text"])
+        self.assertIsNone(statuses[0]["in_reply_to_status_id"])
+        self.assertEqual(sorted(statuses[0]["media_ids"]), sorted(self.server.media))
+        self.assertEqual("Line2", statuses[1]["full_text"])
+        self.assertEqual(statuses[0]["id"], statuses[1]["in_reply_to_status_id"])
+        stats = self.server.stats()
+        self.assertEqual(2, stats["media"])
+        self.assertGreater(stats["bytes_uploaded"], 2 * 4096)
+
+    def test_rate_limited_post_is_retried(self):
+        # INIT, APPEND and FINALIZE of the upload go through, the post is refused
+        self.server.rate_limit_every = 4
+        tt = ThreadTwitter(backend=create_backend(self.server), retry_delay=0,
+                           post_retries=1)
+        tt.add_line("Line1")
+        tt.add_media(self.create_image("chart_0.png"), MediaType.PHOTO)
+        tt.tweet()
+        self.assertEqual(1, self.server.stats()["rate_limited"])
+        self.assertEqual(1, len(self.server.statuses))
+        self.assertEqual(1, len(self.server.statuses[0]["media_ids"]))
+
+    def test_failures_are_reported(self):
+        self.server.failure_rate = 1.0
+        backend = create_backend(self.server)
+        with self.assertRaises(TwitterError):
+            backend.post_update("Line1")
+        self.assertEqual(0, len(self.server.statuses))
+        self.assertEqual(1, self.server.stats()["failures"])
+
+    def test_every_nth_request_fails(self):
+        self.server.fail_every = 2
+        backend = create_backend(self.server)
+        backend.post_update("Line1")
+        with self.assertRaises(TwitterError):
+            backend.post_update("Line2")
+        backend.post_update("Line3")
+        self.assertEqual(2, len(self.server.statuses))
+        self.assertEqual(1, self.server.stats()["failures"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,164 @@
+import tempfile
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from unittest.mock import Mock
+from unittest.mock import patch
+
+from bot.fetch import ConditionalFetcher
+from bot.fetch import FetchResult
+from bot.processing import DataProcessor
+
+PAYLOAD = b"""[{
+    "data": "2020-02-24T18:00:00",
+    "ricoverati_con_sintomi": 101,
+    "terapia_intensiva": 26,
+    "totale_ospedalizzati": 127,
+    "isolamento_domiciliare": 94,
+    "totale_positivi": 221,
+    "variazione_totale_positivi": 0,
+    "nuovi_positivi": 221,
+    "dimessi_guariti": 1,
+    "deceduti": 7,
+    "totale_casi": 229,
+    "tamponi": 4324
+}]"""
+ETAG = '"v1"'
+
+
+class DataRequestHandler(BaseHTTPRequestHandler):
+
+    requests_count = 0
+
+    def do_GET(self):
+        DataRequestHandler.requests_count = DataRequestHandler.requests_count + 1
+        if self.headers.get("If-None-Match") == ETAG:
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("ETag", ETAG)
+        self.send_header("Content-Length", str(len(PAYLOAD)))
+        self.end_headers()
+        self.wfile.write(PAYLOAD)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ConditionalFetcherTest(unittest.TestCase):
+
+    def setUp(self):
+        DataRequestHandler.requests_count = 0
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), DataRequestHandler)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+        self.url = "http://127.0.0.1:{0}/data.json".format(
+            self.server.server_address[1])
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.cache_path = Path(self.tmp_dir.name)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+        self.tmp_dir.cleanup()
+
+    def test_unchanged_data_is_not_downloaded_again(self):
+        fetcher = ConditionalFetcher(self.url, self.cache_path)
+        first = fetcher.fetch()
+        second = fetcher.fetch()
+        fetcher.close()
+
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(first.content, PAYLOAD)
+        self.assertTrue(first.modified)
+        self.assertEqual(second.status_code, 304)
+        self.assertIsNone(second.content)
+        self.assertFalse(second.modified)
+        self.assertEqual(fetcher.stats()["not_modified"], 1)
+        self.assertEqual(fetcher.stats()["bytes_saved"], len(PAYLOAD))
+
+    def test_validators_survive_restarts(self):
+        fetcher = ConditionalFetcher(self.url, self.cache_path)
+        fetcher.fetch()
+        fetcher.close()
+
+        fetcher = ConditionalFetcher(self.url, self.cache_path)
+        result = fetcher.fetch(require_content=True)
+        fetcher.close()
+        self.assertEqual(result.status_code, 304)
+        self.assertEqual(result.content, PAYLOAD)
+        self.assertEqual(DataRequestHandler.requests_count, 2)
+
+    def test_missing_body_triggers_full_download(self):
+        fetcher = ConditionalFetcher(self.url, self.cache_path)
+        fetcher.fetch()
+        for path in self.cache_path.glob("*.body"):
+            path.unlink()
+        result = fetcher.fetch(require_content=True)
+        fetcher.close()
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual(result.content, PAYLOAD)
+
+    def test_unchanged_polls_do_no_parsing(self):
+        import bot.__main__ as bot_main
+
+        last_exec_path = self.cache_path / "last_exec"
+        last_exec_path.write_text("2020-02-24T18:00:00")
+        with patch.object(bot_main.config, "NATIONAL_DATA_JSON_URL", self.url), \
+                patch.object(bot_main.config, "FETCH_CACHE_PATH", self.cache_path), \
+                patch.object(bot_main.config, "LATEST_EXECUTION_DATE_FILE_PATH", last_exec_path), \
+                patch.object(bot_main.config, "REGIONAL_CHARTS", False), \
+                patch.object(bot_main, "data_fetcher", None), \
+                patch.object(bot_main, "data_processor", None), \
+                patch.object(DataProcessor, "initialize", wraps=DataProcessor.initialize) as initialize, \
+                patch.object(DataProcessor, "merge", wraps=DataProcessor.merge) as merge:
+            for _ in range(3):
+                bot_main.check_for_new_data()
+            self.assertEqual(initialize.call_count, 1)
+            self.assertEqual(merge.call_count, 0)
+            self.assertEqual(bot_main.data_fetcher.stats()["not_modified"], 2)
+            bot_main.data_fetcher.close()
+
+    def test_failed_publish_is_retried_after_not_modified(self):
+        import bot.__main__ as bot_main
+
+        last_exec_path = self.cache_path / "last_exec"
+        # The first attempt fails once the validators are saved
+        publish = Mock(side_effect=[IOError("upload failed"), None])
+        with patch.object(bot_main.config, "NATIONAL_DATA_JSON_URL", self.url), \
+                patch.object(bot_main.config, "FETCH_CACHE_PATH", self.cache_path), \
+                patch.object(bot_main.config, "LATEST_EXECUTION_DATE_FILE_PATH", last_exec_path), \
+                patch.object(bot_main.config, "REGIONAL_CHARTS", False), \
+                patch.object(bot_main.config, "METRICS", False), \
+                patch.object(bot_main, "SUPERVISOR_MODE", False), \
+                patch.object(bot_main, "publish_update", publish), \
+                patch.object(bot_main, "data_fetcher", None), \
+                patch.object(bot_main, "data_processor", None), \
+                patch.object(bot_main.log, "disabled", True):
+            self.assertFalse(bot_main.poll_for_new_data())
+            self.assertFalse(last_exec_path.exists())
+            self.assertTrue(bot_main.poll_for_new_data())
+            self.assertFalse(bot_main.poll_for_new_data())
+            bot_main.data_fetcher.close()
+        self.assertEqual(publish.call_count, 2)
+        self.assertEqual(DataRequestHandler.requests_count, 3)
+        self.assertEqual(last_exec_path.read_text(), "2020-02-24T18:00:00")
+
+    def test_fetch_errors_publish_nothing(self):
+        import bot.__main__ as bot_main
+        from requests.exceptions import ConnectionError
+
+        fetcher = Mock()
+        fetcher.fetch.side_effect = [ConnectionError("unreachable"), FetchResult(200, b"{", True)]
+        with patch.object(bot_main, "data_fetcher", fetcher), \
+                patch.object(bot_main, "data_processor", None), \
+                patch.object(bot_main.log, "disabled", True):
+            self.assertIs(False, bot_main.check_for_new_data())
+            self.assertIs(False, bot_main.check_for_new_data())
+
+
+if __name__ == "__main__":
+    unittest.main()
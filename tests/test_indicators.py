@@ -1,9 +1,44 @@
+import json
+import tempfile
 import unittest
 import math
+import random
+from pathlib import Path
 
 from bot.indicators import MovingAverageIndicator
 from bot.indicators import DeltaIndicator
 from bot.indicators import DeltaPercentageIndicator
+from bot.indicators import IndicatorCache
+from bot.indicators import StreamingIndicator
+from bot.indicators import StreamingMovingAverageIndicator
+from bot.indicators import StreamingDeltaIndicator
+from bot.indicators import StreamingDeltaPercentageIndicator
+from bot.indicators import StreamingIndicatorStore
+from bot.processing import DataProcessor
+from tests.test_memory import national_payload
+
+
+class MockDataProcessor:
+
+    def __init__(self, columns):
+        self.columns = columns
+        self.current_version = 0
+        self.get_calls = 0
+
+    def get(self, key):
+        self.get_calls = self.get_calls + 1
+        return self.columns[key]
+
+    def version(self):
+        return self.current_version
+
+
+def per_index_values(indicator):
+    return [indicator.calculate(i) for i in range(len(indicator._data))]
+
+
+def random_data(size):
+    return [random.randint(1, 100000) for _ in range(size)]
 
 
 class MovingAverageIndicatorTest(unittest.TestCase):
@@ -41,6 +76,22 @@ class MovingAverageIndicatorTest(unittest.TestCase):
         with self.assertRaises(IndexError):
             mai.calculate(3)
 
+    def test_moving_average_get_all_matches_calculate(self):
+        data = random_data(200)
+        for period in [1, 2, 5, 7, 199, 200, 201]:
+            mai = MovingAverageIndicator(data, period)
+            batch = mai.get_all()
+            expected = per_index_values(mai)
+            self.assertEqual(len(batch), len(expected))
+            for value, expected_value in zip(batch, expected):
+                if math.isnan(expected_value):
+                    self.assertTrue(math.isnan(value))
+                else:
+                    self.assertAlmostEqual(value, expected_value)
+
+    def test_moving_average_get_all_on_empty_data(self):
+        self.assertEqual(MovingAverageIndicator([], 3).get_all(), [])
+
     def test_moving_average_with_none_list(self):
         with self.assertRaises(ValueError):
             mai = MovingAverageIndicator(None, 2)
@@ -63,6 +114,12 @@ class DeltaIndicatorTest(unittest.TestCase):
         di = DeltaIndicator([1, 2, 3])
         self.assertEqual(di.get_all(), [1, 1, 1])
 
+    def test_delta_get_all_matches_calculate(self):
+        data = random_data(200)
+        di = DeltaIndicator(data)
+        self.assertEqual(di.get_all(), per_index_values(di))
+        self.assertEqual(DeltaIndicator([]).get_all(), [])
+
     def test_delta_calculate_last(self):
         di = DeltaIndicator([10, 20, 30])
         self.assertEqual(di.get_last(), 10)
@@ -93,6 +150,188 @@ class DeltaPercentageIndicatorTest(unittest.TestCase):
         self.assertAlmostEqual(dpi.calculate(1), 33.33, delta=0.01)
         self.assertAlmostEqual(dpi.calculate(2), -75, delta=0.01)
 
+    def test_delta_percentage_get_all_matches_calculate(self):
+        data = random_data(200)
+        dpi = DeltaPercentageIndicator(data)
+        self.assertEqual(dpi.get_all(), per_index_values(dpi))
+        self.assertEqual(DeltaPercentageIndicator([]).get_all(), [])
+
+    def test_delta_percentage_get_all_with_zero_previous_value(self):
+        with self.assertRaises(ZeroDivisionError):
+            DeltaPercentageIndicator([0, 1]).get_all()
+
+
+class StreamingIndicatorTest(unittest.TestCase):
+
+    def assert_matches_batch(self, streaming, batch_values, data):
+        for i in range(len(data)):
+            streaming.push(data[i])
+            if math.isnan(batch_values[i]):
+                self.assertTrue(math.isnan(streaming.value()))
+            else:
+                self.assertAlmostEqual(streaming.value(), batch_values[i])
+
+    def test_streaming_moving_average_matches_batch(self):
+        data = random_data(100)
+        for period in [1, 5, 100]:
+            self.assert_matches_batch(StreamingMovingAverageIndicator(period),
+                                      MovingAverageIndicator(data, period).get_all(), data)
+
+    def test_streaming_delta_matches_batch(self):
+        data = random_data(100)
+        self.assert_matches_batch(StreamingDeltaIndicator(),
+                                  DeltaIndicator(data).get_all(), data)
+
+    def test_streaming_delta_percentage_matches_batch(self):
+        data = random_data(100)
+        self.assert_matches_batch(StreamingDeltaPercentageIndicator(),
+                                  DeltaPercentageIndicator(data).get_all(), data)
+
+    def test_streaming_value_without_data(self):
+        with self.assertRaises(IndexError):
+            StreamingMovingAverageIndicator(3).value()
+        with self.assertRaises(IndexError):
+            StreamingDeltaIndicator().value()
+        with self.assertRaises(IndexError):
+            StreamingDeltaPercentageIndicator().value()
+
+    def test_streaming_moving_average_with_invalid_periods(self):
+        with self.assertRaises(ValueError):
+            StreamingMovingAverageIndicator(0)
+
+    def test_streaming_state_restore(self):
+        data = random_data(20)
+        indicators = [StreamingMovingAverageIndicator(5), StreamingDeltaIndicator(),
+                      StreamingDeltaPercentageIndicator()]
+        for indicator in indicators:
+            indicator.push_all(data[:10])
+            restored = StreamingIndicator.restore(
+                json.loads(json.dumps(indicator.get_state())))
+            self.assertIs(type(restored), type(indicator))
+            indicator.push_all(data[10:])
+            restored.push_all(data[10:])
+            self.assertAlmostEqual(restored.value(), indicator.value())
+
+    def test_streaming_restore_unknown_type(self):
+        with self.assertRaises(ValueError):
+            StreamingIndicator.restore({"type": "Unknown"})
+
+
+class IndicatorCacheTest(unittest.TestCase):
+
+    def test_series_are_computed_once(self):
+        dp = MockDataProcessor({"a": [1, 2, 4, 8]})
+        cache = IndicatorCache()
+        first = cache.get_all(dp, "a", DeltaIndicator)
+        second = cache.get_all(dp, "a", DeltaIndicator)
+        self.assertEqual(first, [1, 1, 2, 4])
+        self.assertIs(first, second)
+        self.assertEqual(cache.get_last(dp, "a", DeltaIndicator), 4)
+        self.assertEqual(dp.get_calls, 1)
+        self.assertEqual(cache.stats()["hits"], 2)
+        self.assertEqual(cache.stats()["misses"], 2)
+
+    def test_parameters_are_part_of_the_key(self):
+        dp = MockDataProcessor({"a": [1, 2, 3, 4]})
+        cache = IndicatorCache()
+        self.assertAlmostEqual(cache.get_all(
+            dp, "a", MovingAverageIndicator, 2)[-1], 3.5)
+        self.assertAlmostEqual(cache.get_all(
+            dp, "a", MovingAverageIndicator, 4)[-1], 2.5)
+
+    def test_derived_series(self):
+        dp = MockDataProcessor({"a": [1, 2, 4, 8]})
+        cache = IndicatorCache()
+        values = cache.get_all(
+            dp, ("a", DeltaIndicator), MovingAverageIndicator, 2)
+        self.assertAlmostEqual(values[-1], 3.0)
+        self.assertEqual(cache.get_all(dp, "a", DeltaIndicator), [1, 1, 2, 4])
+        self.assertEqual(cache.stats()["hits"], 1)
+
+    def test_invalidation_on_data_change(self):
+        dp = MockDataProcessor({"a": [1, 2]})
+        cache = IndicatorCache()
+        self.assertEqual(cache.get_last(dp, "a", DeltaIndicator), 1)
+        dp.columns["a"] = [1, 2, 5]
+        dp.current_version = 1
+        self.assertEqual(cache.get_last(dp, "a", DeltaIndicator), 3)
+        self.assertEqual(cache.stats()["hits"], 0)
+
+
+class StreamingIndicatorStoreTest(unittest.TestCase):
+
+    DATE_FORMAT = "%Y-%m-%dT%H:%M:%S"
+    KEYS = ["total_cases", "new_infected", "total_tests"]
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = Path(self.tmp_dir.name) / "indicator_state"
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def assert_matches_batch(self, store, dp):
+        for key in StreamingIndicatorStoreTest.KEYS:
+            self.assertEqual(DeltaIndicator(dp.get(key)).get_last(),
+                             store.get_last(dp, key, StreamingDeltaIndicator))
+            self.assertAlmostEqual(DeltaPercentageIndicator(dp.get(key)).get_last(),
+                                   store.get_last(dp, key, StreamingDeltaPercentageIndicator))
+
+    def test_only_new_rows_are_pushed_across_restarts(self):
+        for days in range(20, 25):
+            dp = DataProcessor.initialize(national_payload(days), StreamingIndicatorStoreTest.DATE_FORMAT)
+            # A new store for every day, as in a new worker process
+            store = StreamingIndicatorStore(self.path)
+            self.assert_matches_batch(store, dp)
+            store.save()
+            # Two indicators per key, the whole history on the first day
+            rows = days if days == 20 else 1
+            self.assertEqual(2 * len(StreamingIndicatorStoreTest.KEYS) * rows, store.pushed)
+
+    def test_revised_data_is_pushed_again(self):
+        store = StreamingIndicatorStore(self.path)
+        self.assert_matches_batch(store, DataProcessor.initialize(
+            national_payload(20), StreamingIndicatorStoreTest.DATE_FORMAT))
+        revised = json.loads(national_payload(21))
+        revised[19]["totale_casi"] = revised[19]["totale_casi"] + 100
+        dp = DataProcessor.initialize(json.dumps(revised).encode("utf-8"),
+                                      StreamingIndicatorStoreTest.DATE_FORMAT)
+        store.pushed = 0
+        self.assert_matches_batch(store, dp)
+        self.assertGreater(store.pushed, 2 * 21)
+        # Fewer rows than were pushed
+        self.assert_matches_batch(store, DataProcessor.initialize(
+            national_payload(10), StreamingIndicatorStoreTest.DATE_FORMAT))
+
+    def test_cache_uses_the_store(self):
+        dp = DataProcessor.initialize(national_payload(20), StreamingIndicatorStoreTest.DATE_FORMAT)
+        StreamingIndicatorStore(self.path).get_last(dp, "total_cases", StreamingDeltaIndicator)
+        dp = DataProcessor.initialize(national_payload(21), StreamingIndicatorStoreTest.DATE_FORMAT)
+        store = StreamingIndicatorStore(self.path)
+        cache = IndicatorCache()
+        for _ in range(2):
+            self.assertEqual(DeltaIndicator(dp.get("total_cases")).get_last(),
+                             cache.get_last(dp, "total_cases", DeltaIndicator, store=store))
+        # The state was not saved, the whole column is pushed once
+        self.assertEqual(21, store.pushed)
+        self.assertEqual(1, cache.stats()["hits"])
+
+    def test_cache_prefers_shared_series(self):
+        dp = DataProcessor.initialize(national_payload(20), StreamingIndicatorStoreTest.DATE_FORMAT)
+        store = StreamingIndicatorStore(self.path)
+        cache = IndicatorCache()
+        # Computed for a chart first
+        deltas = cache.get_all(dp, "total_tests", DeltaIndicator)
+        self.assertEqual(deltas[-1], cache.get_last(dp, "total_tests", DeltaIndicator, store=store))
+        self.assertEqual(0, store.pushed)
+
+    def test_state_without_data(self):
+        self.path.write_text("not json")
+        store = StreamingIndicatorStore(self.path)
+        with self.assertRaises(IndexError):
+            store.get_last(DataProcessor.initialize(b"[]", StreamingIndicatorStoreTest.DATE_FORMAT),
+                           "total_cases", StreamingDeltaIndicator)
+
 
 if __name__ == "__main__":
     unittest.main()
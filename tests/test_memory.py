@@ -0,0 +1,132 @@
+import datetime
+import json
+import logging
+import tempfile
+import tracemalloc
+import unittest
+from pathlib import Path
+from unittest.mock import Mock
+from unittest.mock import create_autospec
+from unittest.mock import patch
+
+from bot import memory
+from bot import metrics
+from bot.charts import ImageRenderer
+from bot.fetch import FetchResult
+from bot.memory import MemoryProfiler
+from bot.twitter import ThreadTwitter
+from bot.twitter import TwitterBackend
+from tests.test_charts import FakeBackend
+
+CYCLES = 300
+WARM_UP_CYCLES = 30
+# Most polls find nothing new, as in a real day
+PUBLISH_EVERY = 10
+MAX_RSS_GROWTH = 3 * 2 ** 20
+
+
+def national_payload(days):
+    entries = []
+    for i in range(days):
+        entries.append({
+            "data": (datetime.datetime(2020, 3, 1, 18) + datetime.timedelta(days=i)).strftime(
+                "%Y-%m-%dT%H:%M:%S"),
+            "stato": "ITA",
+            "ricoverati_con_sintomi": 10 + i,
+            "terapia_intensiva": 5 + i,
+            "totale_ospedalizzati": 15 + 2 * i,
+            "isolamento_domiciliare": 20 + i,
+            "totale_positivi": 35 + 3 * i,
+            "variazione_totale_positivi": 3,
+            "nuovi_positivi": 4 + i,
+            "dimessi_guariti": i,
+            "deceduti": i // 2,
+            "totale_casi": 35 + 5 * i,
+            "tamponi": 100 + 10 * i,
+            "note": None
+        })
+    return json.dumps(entries).encode("utf-8")
+
+
+def create_thread_twitter():
+    backend = create_autospec(TwitterBackend, instance=True)
+    backend.post_update.return_value = 1
+    backend.upload_media.return_value = 2
+    return ThreadTwitter(backend=backend)
+
+
+class MemoryProfilerTest(unittest.TestCase):
+
+    def test_growth_sites_are_reported(self):
+        profiler = MemoryProfiler(top=5)
+        profiler.start()
+        try:
+            profiler.snapshot()
+            retained = [bytearray(1024) for _ in range(100)]
+            report = profiler.snapshot()
+        finally:
+            profiler.stop()
+        self.assertEqual(2, report["cycle"])
+        self.assertGreater(report["traced"], 100 * 1024)
+        self.assertTrue(any(__file__ in site and size_diff >= 100 * 1024
+                            for site, size_diff, _ in report["top_growth"]))
+        self.assertIn("Memory after cycle 2", MemoryProfiler.format_report(report))
+        self.assertFalse(tracemalloc.is_tracing())
+        del retained
+
+    def test_rss_only(self):
+        profiler = MemoryProfiler(trace=False)
+        profiler.start()
+        report = profiler.snapshot()
+        self.assertFalse(tracemalloc.is_tracing())
+        self.assertIsNone(report["traced"])
+        self.assertGreater(report["rss"], 0)
+
+
+class BoundedFootprintTest(unittest.TestCase):
+
+    def test_rss_is_flat_across_cycles(self):
+        # Every PUBLISH_EVERY cycles the same data is parsed, rendered and
+        # tweeted again, the other polls are answered with 304
+        import bot.__main__ as bot_main
+
+        metrics.registry.reset()
+        payload = national_payload(60)
+        fetcher = Mock()
+        fetcher.stats.return_value = {"requests": 0, "not_modified": 0, "bytes_saved": 0,
+                                      "time_saved": 0.0}
+        renderer = ImageRenderer(FakeBackend())
+        with tempfile.TemporaryDirectory() as tmp_dir, \
+                patch.object(bot_main.config, "TEMP_FILES_PATH", Path(tmp_dir)), \
+                patch.object(bot_main.config, "LATEST_EXECUTION_DATE_FILE_PATH",
+                             Path(tmp_dir) / ".last_exec"), \
+                patch.object(bot_main.config, "THREAD_CHECKPOINT_PATH",
+                             Path(tmp_dir) / ".thread_checkpoint"), \
+                patch.object(bot_main.config, "INDICATOR_STATE_PATH",
+                             Path(tmp_dir) / ".indicator_state"), \
+                patch.object(bot_main.config, "REGIONAL_CHARTS", False), \
+                patch.object(bot_main.config, "METRICS", False), \
+                patch.object(bot_main, "data_fetcher", fetcher), \
+                patch.object(bot_main, "data_processor", None), \
+                patch.object(bot_main, "image_renderer", renderer), \
+                patch.object(bot_main, "create_thread_twitter", create_thread_twitter), \
+                patch.object(bot_main.log, "disabled", True), \
+                patch.object(logging.getLogger("bot"), "disabled", True):
+            rss = None
+            for cycle in range(CYCLES):
+                if cycle == WARM_UP_CYCLES:
+                    rss = memory.rss()
+                publish = cycle % PUBLISH_EVERY == 0
+                if publish:
+                    fetcher.fetch.return_value = FetchResult(200, payload, True)
+                    (Path(tmp_dir) / ".last_exec").unlink(missing_ok=True)
+                else:
+                    fetcher.fetch.return_value = FetchResult(304, None, False)
+                self.assertEqual(publish, bool(bot_main.poll_for_new_data()))
+            growth = memory.rss() - rss
+            self.assertIsNone(metrics.registry.get("poll_errors"))
+        self.assertLess(growth, MAX_RSS_GROWTH)
+
+
+if __name__ == "__main__":
+    unittest.main()
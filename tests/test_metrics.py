@@ -0,0 +1,149 @@
+import json
+import tempfile
+import unittest
+from pathlib import Path
+
+from bot import metrics
+from bot.indicators import DeltaIndicator, IndicatorCache
+from bot.metrics import Metrics
+from bot.pipeline import StageTimer
+from bot.processing import DataProcessor
+
+DATA = json.dumps([
+    {"data": "2020-03-01T18:00:00", "stato": "ITA", "ricoverati_con_sintomi": 1, "terapia_intensiva": 1,
+     "totale_ospedalizzati": 2, "isolamento_domiciliare": 3, "totale_positivi": 5,
+     "variazione_totale_positivi": 5, "nuovi_positivi": 5, "dimessi_guariti": 0, "deceduti": 0,
+     "totale_casi": 5, "tamponi": 10, "note": None},
+    {"data": "2020-03-02T18:00:00", "stato": "ITA", "ricoverati_con_sintomi": 2, "terapia_intensiva": 1,
+     "totale_ospedalizzati": 3, "isolamento_domiciliare": 4, "totale_positivi": 7,
+     "variazione_totale_positivi": 2, "nuovi_positivi": 3, "dimessi_guariti": 1, "deceduti": 0,
+     "totale_casi": 8, "tamponi": 20, "note": None}
+]).encode("utf-8")
+
+
+class MetricsTest(unittest.TestCase):
+
+    def test_counters_are_kept_per_label(self):
+        m = Metrics()
+        m.inc("tweets_posted")
+        m.inc("tweets_posted", 2)
+        m.inc("fetch_responses", status=200)
+        m.inc("fetch_responses", status=304)
+        m.inc("fetch_responses", status=304)
+        self.assertEqual(3, m.get("tweets_posted"))
+        self.assertEqual(1, m.get("fetch_responses", status=200))
+        self.assertEqual(2, m.get("fetch_responses", status="304"))
+
+    def test_timings(self):
+        m = Metrics()
+        m.observe("stage", 2.0, stage="fetch")
+        m.observe("stage", 1.0, stage="fetch")
+        with m.span("stage", stage="render"):
+            pass
+        fetch = m.get("stage", stage="fetch")
+        self.assertEqual({"count": 2, "sum": 3.0, "max": 2.0, "last": 1.0}, fetch)
+        self.assertEqual(1, m.get("stage", stage="render")["count"])
+
+    def test_span_is_recorded_on_error(self):
+        m = Metrics()
+        with self.assertRaises(ValueError):
+            with m.span("poll"):
+                raise ValueError
+        self.assertEqual(1, m.get("poll")["count"])
+
+    def test_merge(self):
+        worker = Metrics()
+        worker.inc("tweets_posted", 3)
+        worker.inc("fetch_responses", status=200)
+        worker.set_gauge("rss_bytes", 20)
+        worker.observe("stage", 2.0, stage="render")
+        worker.observe("stage", 1.0, stage="post")
+        m = Metrics()
+        m.inc("tweets_posted")
+        m.set_gauge("rss_bytes", 10)
+        m.observe("stage", 4.0, stage="render")
+        m.merge(worker.snapshot())
+        self.assertEqual(4, m.get("tweets_posted"))
+        self.assertEqual(1, m.get("fetch_responses", status=200))
+        self.assertEqual(20, m.get("rss_bytes"))
+        self.assertEqual({"count": 2, "sum": 6.0, "max": 4.0, "last": 2.0}, m.get("stage", stage="render"))
+        self.assertEqual({"count": 1, "sum": 1.0, "max": 1.0, "last": 1.0}, m.get("stage", stage="post"))
+
+    def test_type_mismatch(self):
+        m = Metrics()
+        m.inc("polls")
+        with self.assertRaises(ValueError):
+            m.set_gauge("polls", 1)
+
+    def test_prometheus_format(self):
+        m = Metrics(prefix="bot")
+        m.inc("polls")
+        m.set_gauge("dataset_rows", 250)
+        m.observe("stage", 0.5, stage="post")
+        m.inc("errors", reason='bad "data"\n')
+        text = m.to_prometheus()
+        self.assertIn("# TYPE bot_polls_total counter\nbot_polls_total 1\n", text)
+        self.assertIn("# TYPE bot_dataset_rows gauge\nbot_dataset_rows 250\n", text)
+        self.assertIn("# TYPE bot_stage_seconds summary\n", text)
+        self.assertIn('bot_stage_seconds_count{stage="post"} 1\n', text)
+        self.assertIn('bot_stage_seconds_sum{stage="post"} 0.5\n', text)
+        self.assertIn('bot_stage_seconds_last{stage="post"} 0.5\n', text)
+        self.assertIn('bot_errors_total{reason="bad \\"data\\"\\n"} 1\n', text)
+
+    def test_write(self):
+        m = Metrics()
+        m.inc("polls")
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = Path(tmp_dir) / "metrics.json"
+            m.write(path, metrics.JSON)
+            with open(path, "r") as file:
+                content = json.load(file)
+            self.assertEqual([{"labels": {}, "value": 1}], content["metrics"]["polls"]["samples"])
+            self.assertFalse(Path(str(path) + ".tmp").exists())
+            with self.assertRaises(ValueError):
+                m.write(path, "xml")
+
+    def test_stage_timer_feeds_metrics(self):
+        m = Metrics()
+        timer = StageTimer(m)
+        timer.timed("parse", lambda: None)
+        timer.timed("parse", lambda: None)
+        timer.mark("first_tweet")
+        self.assertEqual(2, m.get("stage", stage="parse")["count"])
+        self.assertIsNotNone(m.get("mark_seconds", mark="first_tweet"))
+
+    def test_stage_timer_elapsed(self):
+        # A worker continues the timer of the poll that started it
+        m = Metrics()
+        timer = StageTimer(m, elapsed=10.0)
+        timer.timed("post", lambda: None)
+        timer.mark("first_tweet")
+        self.assertGreaterEqual(m.get("mark_seconds", mark="first_tweet"), 10.0)
+        self.assertGreaterEqual(timer.stages()["post"]["start"], 10.0)
+        self.assertGreaterEqual(timer.elapsed(), 10.0)
+
+
+class InstrumentationTest(unittest.TestCase):
+
+    def setUp(self):
+        metrics.registry.reset()
+
+    def tearDown(self):
+        metrics.registry.reset()
+
+    def test_processing_and_indicators(self):
+        dp = DataProcessor.initialize(DATA, "%Y-%m-%dT%H:%M:%S")
+        dp.localize_dates("UTC", "Europe/Rome")
+        cache = IndicatorCache()
+        cache.get_all(dp, "total_cases", DeltaIndicator)
+        cache.get_all(dp, "total_cases", DeltaIndicator)
+        self.assertEqual(1, metrics.registry.get("data_initialize")["count"])
+        self.assertEqual(2, metrics.registry.get("rows_parsed"))
+        self.assertEqual(1, metrics.registry.get("localize_dates")["count"])
+        self.assertEqual(1, metrics.registry.get("indicator_compute", indicator="DeltaIndicator")["count"])
+        self.assertEqual(1, metrics.registry.get("indicator_cache_hits"))
+        self.assertEqual(2, metrics.registry.get("indicator_cache_misses"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,86 @@
+import threading
+import time
+import unittest
+
+from bot.pipeline import StageTimer
+from bot.pipeline import run_overlapped
+
+
+class StageTimerTest(unittest.TestCase):
+
+    def test_repeated_stages_are_merged(self):
+        timer = StageTimer()
+        for _ in range(3):
+            timer.timed("upload", time.sleep, 0.01)
+        stage = timer.stages()["upload"]
+        self.assertEqual(stage["count"], 3)
+        self.assertGreaterEqual(stage["busy"], 0.03)
+        self.assertGreaterEqual(stage["end"] - stage["start"], stage["busy"])
+
+    def test_stage_is_recorded_on_error(self):
+        timer = StageTimer()
+        with self.assertRaises(ValueError):
+            with timer.stage("parse"):
+                raise ValueError
+        self.assertIn("parse", timer.stages())
+
+    def test_only_first_mark_is_kept(self):
+        timer = StageTimer()
+        timer.mark("first_tweet")
+        first = timer.marks()["first_tweet"]
+        time.sleep(0.01)
+        timer.mark("first_tweet")
+        self.assertEqual(timer.marks()["first_tweet"], first)
+        self.assertIn("first_tweet", timer.report())
+
+
+class RunOverlappedTest(unittest.TestCase):
+
+    def test_uploads_start_while_rendering(self):
+        events = []
+        lock = threading.Lock()
+        render_done = threading.Event()
+
+        def log_event(event):
+            with lock:
+                events.append(event)
+
+        def render(on_rendered):
+            for i in [2, 0, 1]:
+                time.sleep(0.02)
+                on_rendered(i, "chart_" + str(i))
+            time.sleep(0.05)
+            log_event("render_done")
+            render_done.set()
+
+        def upload(path):
+            log_event("upload " + path)
+            return "id_" + path
+
+        def compose():
+            self.assertFalse(render_done.is_set())
+            return "text"
+
+        posted = []
+        timer = StageTimer()
+        run_overlapped(render, upload, compose,
+                       lambda text, media: posted.append((text, media)), timer)
+
+        self.assertEqual(posted, [("text", ["id_chart_0", "id_chart_1", "id_chart_2"])])
+        self.assertEqual(events[-1], "render_done")
+        self.assertEqual(len(events), 4)
+        stages = timer.stages()
+        self.assertLess(stages["upload"]["start"], stages["render"]["end"])
+        self.assertLessEqual(stages["render"]["end"], stages["post"]["start"])
+
+    def test_render_errors_are_raised(self):
+        def render(on_rendered):
+            raise RuntimeError("renderer crashed")
+
+        with self.assertRaises(RuntimeError):
+            run_overlapped(render, lambda path: path, lambda: "text",
+                           lambda text, media: None, StageTimer())
+
+
+if __name__ == "__main__":
+    unittest.main()
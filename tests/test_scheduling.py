@@ -0,0 +1,136 @@
+import datetime
+import json
+import tempfile
+import unittest
+from pathlib import Path
+
+import pytz
+
+from bot.scheduling import AdaptiveScheduler
+from bot.scheduling import PublishWindow
+
+ROME = pytz.timezone("Europe/Rome")
+
+
+class FakeClock:
+
+    def __init__(self, now):
+        self.current = now
+
+    def __call__(self):
+        return self.current
+
+    def sleep(self, seconds):
+        self.current = self.current + datetime.timedelta(seconds=seconds)
+
+
+def rome(year, month, day, hour, minute=0):
+    return ROME.localize(datetime.datetime(year, month, day, hour, minute))
+
+
+class PublishWindowTest(unittest.TestCase):
+
+    def test_default_window(self):
+        window = PublishWindow.learn([], ROME, PublishWindow(datetime.time(17), datetime.time(18)),
+                                     datetime.timedelta(minutes=15))
+        self.assertEqual(datetime.time(16, 45), window.start)
+        self.assertEqual(datetime.time(18, 15), window.end)
+
+    def test_learned_window(self):
+        timestamps = [rome(2020, 4, day, 18, 5 + day).timestamp() for day in range(1, 11)]
+        # A single very late day does not stretch the window
+        timestamps.append(rome(2020, 4, 11, 22, 30).timestamp())
+        window = PublishWindow.learn(timestamps, ROME, PublishWindow(datetime.time(17), datetime.time(18)),
+                                     datetime.timedelta(minutes=15))
+        self.assertEqual(datetime.time(17, 52), window.start)
+        self.assertEqual(datetime.time(18, 30), window.end)
+
+
+class AdaptiveSchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.history_path = Path(self.tmp_dir.name) / "history"
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def create_scheduler(self, clock):
+        return AdaptiveScheduler(self.history_path, clock=clock, sleep=clock.sleep)
+
+    def simulate(self, scheduler, clock, publish_at, days):
+        polls = []
+        warm_ups = []
+
+        def poll():
+            polls.append(clock.current)
+            return clock.current >= publish_at(clock.current.astimezone(ROME).date())
+
+        end = clock.current + datetime.timedelta(days=days)
+        while clock.current < end:
+            scheduler.run(poll, warm_up=lambda: warm_ups.append(clock.current),
+                          cycles=scheduler.polls + 1)
+        return polls, warm_ups
+
+    def test_polls_drop_by_an_order_of_magnitude(self):
+        clock = FakeClock(rome(2020, 4, 1, 0).astimezone(pytz.utc))
+        scheduler = self.create_scheduler(clock)
+        polls, warm_ups = self.simulate(scheduler, clock,
+                                        lambda day: rome(day.year, day.month, day.day, 17, 20), 7)
+        # A poll every 2 minutes all day would be 720 per day
+        self.assertLess(len(polls) / 7, 72)
+        self.assertGreaterEqual(len(warm_ups), 6)
+
+    def test_update_is_seen_within_the_window_interval(self):
+        clock = FakeClock(rome(2020, 4, 1, 9).astimezone(pytz.utc))
+        scheduler = self.create_scheduler(clock)
+        publish = rome(2020, 4, 1, 17, 20)
+        polls, warm_ups = self.simulate(scheduler, clock, lambda day: publish, 1)
+        seen = [poll for poll in polls if poll >= publish][0]
+        self.assertLessEqual((seen - publish).total_seconds(), 60)
+        # Nothing else is polled on the day the update is seen
+        self.assertEqual(seen, max(poll for poll in polls if poll.astimezone(ROME).date() == publish.date()))
+
+    def test_backoff_outside_the_window(self):
+        clock = FakeClock(rome(2020, 4, 1, 9).astimezone(pytz.utc))
+        scheduler = self.create_scheduler(clock)
+        now = clock.current
+        delays = []
+        for _ in range(8):
+            deadline = scheduler.next_poll(now)
+            delays.append((deadline - now).total_seconds())
+            now = deadline
+            scheduler.polled(False, now)
+        self.assertEqual([60, 120, 240, 480, 960, 1800, 1800, 1800], delays)
+
+    def test_never_sleeps_past_the_window(self):
+        clock = FakeClock(rome(2020, 4, 1, 16, 30).astimezone(pytz.utc))
+        scheduler = self.create_scheduler(clock)
+        for _ in range(10):
+            scheduler.polled(False, clock.current)
+        self.assertEqual(rome(2020, 4, 1, 16, 45), scheduler.next_poll(clock.current))
+
+    def test_history_is_persisted(self):
+        clock = FakeClock(rome(2020, 4, 1, 17, 30).astimezone(pytz.utc))
+        scheduler = self.create_scheduler(clock)
+        scheduler.polled(True)
+        restarted = self.create_scheduler(clock)
+        # Already updated today, next poll at tomorrow's window
+        self.assertEqual(rome(2020, 4, 2, 16, 45), restarted.next_poll(clock.current))
+
+    def test_leftover_update_does_not_end_the_day(self):
+        # Yesterday's update, published when the bot starts in the morning
+        clock = FakeClock(rome(2020, 4, 2, 10).astimezone(pytz.utc))
+        scheduler = self.create_scheduler(clock)
+        scheduler.polled(datetime.datetime(2020, 4, 1, 17), clock.current)
+        self.assertEqual(clock.current + datetime.timedelta(seconds=60), scheduler.next_poll(clock.current))
+        self.assertEqual(datetime.time(16, 45), scheduler.window().start)
+        # Today's update, seen in the window, does
+        clock.current = rome(2020, 4, 2, 17, 30).astimezone(pytz.utc)
+        scheduler.polled(datetime.datetime(2020, 4, 2, 17), clock.current)
+        self.assertEqual(rome(2020, 4, 3, 16, 45), scheduler.next_poll(clock.current))
+        self.assertEqual(1, len(json.loads(self.history_path.read_text())))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,46 @@
+import subprocess
+import sys
+import unittest
+from pathlib import Path
+
+PROJECT_PATH = Path(__file__).resolve().parent.parent
+HEAVY_MODULES = ["plotly", "twitter", "requests"]
+
+
+def loaded_modules(script):
+    # This interpreter already imported all of them, a fresh one is needed
+    script = script + "\nimport sys\nprint(' '.join(name for name in {0!r} if name in sys.modules))".format(
+        HEAVY_MODULES)
+    process = subprocess.run([sys.executable, "-c", script], cwd=str(PROJECT_PATH),
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                             universal_newlines=True)
+    if process.returncode != 0:
+        raise AssertionError(process.stderr)
+    return process.stdout.split()
+
+
+class StartupTest(unittest.TestCase):
+
+    def test_poller_import_is_light(self):
+        self.assertEqual([], loaded_modules("import bot.__main__"))
+
+    def test_idle_poll_does_not_load_charts_and_twitter(self):
+        script = "\n".join([
+            "import logging",
+            "import bot.__main__ as bot_main",
+            "from unittest.mock import Mock",
+            "from bot.fetch import FetchResult",
+            "logging.getLogger('bot').disabled = True",
+            "bot_main.log.disabled = True",
+            "bot_main.config.METRICS = False",
+            "bot_main.data_fetcher = Mock()",
+            "bot_main.data_fetcher.fetch.return_value = FetchResult(304, None, False)",
+            "bot_main.data_fetcher.stats.return_value = {'bytes_saved': 0, 'time_saved': 0.0}",
+            "assert bot_main.poll_for_new_data() is False"
+        ])
+        # requests is needed to poll
+        self.assertEqual(["requests"], loaded_modules(script))
+
+
+if __name__ == "__main__":
+    unittest.main()
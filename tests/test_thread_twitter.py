@@ -1,11 +1,19 @@
+import json
 import unittest
 import random
 import string
+import tempfile
+from pathlib import Path
 from unittest.mock import Mock
 from unittest.mock import create_autospec
+from bot import metrics
+from bot.twitter import ThreadCheckpoint
 from bot.twitter import ThreadTwitter
 from bot.twitter import MediaType
+from bot.twitter import TwitterBackend
+from bot.twitter import weighted_length
 from twitter.api import CHARACTER_LIMIT
+from twitter.error import TwitterError
 
 
 class MockStatus:
@@ -22,16 +30,30 @@ class MockStatus:
         return mocked_status
 
 
+class MockMedia:
+
+    ids = {}
+
+    @staticmethod
+    def upload(media, media_category=None):
+        return MockMedia.ids.setdefault(media, 1000 + len(MockMedia.ids))
+
+    @staticmethod
+    def id(media):
+        return MockMedia.ids[media]
+
+
 def side_effect(*args, **kwargs):
-    return MockStatus.new()
+    return MockStatus.new().id
 
 
-def create_mock():
-    tt = ThreadTwitter(None, None, None, None)
-    mock = create_autospec(
-        tt._ThreadTwitter__api.PostUpdate, side_effect=side_effect)
-    tt._ThreadTwitter__api.PostUpdate = mock
-    return tt, mock
+def create_mock(upload_side_effect=MockMedia.upload, post_retries=0):
+    backend = create_autospec(TwitterBackend, instance=True)
+    backend.post_update.side_effect = side_effect
+    backend.upload_media.side_effect = upload_side_effect
+    tt = ThreadTwitter(backend=backend, retry_delay=0,
+                       post_retries=post_retries)
+    return tt, backend.post_update
 
 
 def random_string(string_length):
@@ -43,6 +65,7 @@ class ThreadTwitterTest(unittest.TestCase):
 
     def setUp(self):
         MockStatus.current_id = 0
+        MockMedia.ids = {}
 
     def test_set_header_too_long(self):
         tt, mock = create_mock()
@@ -202,7 +225,7 @@ class ThreadTwitterTest(unittest.TestCase):
         calls = mock.call_args_list
         self.assertEqual(1, len(calls))
         self.assertTrue("Service tweet" in calls[0].args[0])
-        self.assertTrue(media_file_ref in calls[0].kwargs["media"])
+        self.assertTrue(MockMedia.id(media_file_ref) in calls[0].kwargs["media"])
 
     def test_tweet_with_more_media_than_text_tweets(self):
         tt, mock = create_mock()
@@ -220,9 +243,9 @@ class ThreadTwitterTest(unittest.TestCase):
         self.assertTrue(txt in calls[0].args[0])
         self.assertTrue("Service tweet" in calls[1].args[0])
         self.assertEqual(1, len(calls[0].kwargs["media"]))
-        self.assertTrue(media1 in calls[0].kwargs["media"])
+        self.assertTrue(MockMedia.id(media1) in calls[0].kwargs["media"])
         self.assertEqual(1, len(calls[1].kwargs["media"]))
-        self.assertTrue(media2 in calls[1].kwargs["media"])
+        self.assertTrue(MockMedia.id(media2) in calls[1].kwargs["media"])
 
     def test_subsequent_photo_aggregation(self):
         tt, mock = create_mock()
@@ -245,13 +268,332 @@ class ThreadTwitterTest(unittest.TestCase):
         calls = mock.call_args_list
         self.assertEqual(4, len(calls))
         self.assertEqual(3, len(calls[0].kwargs["media"]))
-        self.assertTrue(media1 in calls[0].kwargs["media"])
-        self.assertTrue(media2 in calls[0].kwargs["media"])
-        self.assertTrue(media3 in calls[0].kwargs["media"])
+        self.assertTrue(MockMedia.id(media1) in calls[0].kwargs["media"])
+        self.assertTrue(MockMedia.id(media2) in calls[0].kwargs["media"])
+        self.assertTrue(MockMedia.id(media3) in calls[0].kwargs["media"])
         self.assertEqual(1, len(calls[1].kwargs["media"]))
-        self.assertTrue(media4 in calls[1].kwargs["media"])
+        self.assertTrue(MockMedia.id(media4) in calls[1].kwargs["media"])
         self.assertEqual(1, len(calls[2].kwargs["media"]))
-        self.assertTrue(media5 in calls[2].kwargs["media"])
+        self.assertTrue(MockMedia.id(media5) in calls[2].kwargs["media"])
+
+    def test_upload_media(self):
+        tt, mock = create_mock()
+        self.assertEqual(tt.upload_media("file1.jpg"), MockMedia.id("file1.jpg"))
+        upload_mock = tt._ThreadTwitter__backend.upload_media
+        self.assertEqual(upload_mock.call_args.args[0], "file1.jpg")
+        self.assertEqual(
+            upload_mock.call_args.args[1], "tweet_image")
+
+    def test_media_are_uploaded_before_posting(self):
+        tt, mock = create_mock()
+        tt.add_line("Line1")
+        tt.add_media("file1.jpg", MediaType.PHOTO)
+        tt.add_media("file2.jpg", MediaType.PHOTO)
+        tt.add_media(42, MediaType.PHOTO)
+        tt.tweet()
+
+        upload_mock = tt._ThreadTwitter__backend.upload_media
+        self.assertEqual(2, upload_mock.call_count)
+        calls = mock.call_args_list
+        self.assertEqual(1, len(calls))
+        self.assertEqual(calls[0].kwargs["media"],
+                         [MockMedia.id("file1.jpg"), MockMedia.id("file2.jpg"), 42])
+
+    def test_media_upload_retries(self):
+        failures = []
+
+        def flaky_upload(media, media_category=None):
+            if len(failures) < 2:
+                failures.append(media)
+                raise TwitterError("upload failed")
+            return MockMedia.upload(media)
+
+        tt, mock = create_mock(upload_side_effect=flaky_upload)
+        tt.add_media("file1.jpg", MediaType.PHOTO)
+        tt.tweet()
+        self.assertEqual(mock.call_args.kwargs["media"], [MockMedia.id("file1.jpg")])
+
+    def test_direct_upload_retries(self):
+        # Uploads of the overlapped pipeline do not go through tweet()
+        metrics.registry.reset()
+        failures = []
+
+        def flaky_upload(media, media_category=None):
+            if len(failures) < 2:
+                failures.append(media)
+                raise TwitterError("upload failed")
+            return MockMedia.upload(media)
+
+        tt, mock = create_mock(upload_side_effect=flaky_upload)
+        media_id = tt.upload_media("file1.jpg")
+        self.assertEqual(MockMedia.id("file1.jpg"), media_id)
+        self.assertEqual(3, tt._ThreadTwitter__backend.upload_media.call_count)
+        self.assertEqual(2, metrics.registry.get("twitter_retries", operation="upload"))
+        self.assertEqual(1, metrics.registry.get("twitter_request", operation="upload")["count"])
+        metrics.registry.reset()
+
+    def test_media_upload_gives_up(self):
+        def failing_upload(media, media_category=None):
+            raise TwitterError("upload failed")
+
+        tt, mock = create_mock(upload_side_effect=failing_upload)
+        tt.add_media("file1.jpg", MediaType.PHOTO)
+        with self.assertRaises(TwitterError):
+            tt.tweet()
+        self.assertEqual(4, tt._ThreadTwitter__backend.upload_media.call_count)
+        self.assertEqual(0, mock.call_count)
+
+    def test_posted_callback(self):
+        tt, mock = create_mock()
+        posted = []
+        tt.add_line("Line1")
+        tt.add_line("Line2", force_new_tweet=True)
+        tt.tweet(on_posted=lambda i, status_id: posted.append((i, status_id)))
+        self.assertEqual(posted, [(0, 0), (1, 1)])
+
+    def test_post_retries(self):
+        failures = []
+
+        def flaky_post(*args, **kwargs):
+            if len(failures) < 1:
+                failures.append(args[0])
+                raise TwitterError("post failed")
+            return side_effect()
+
+        tt, mock = create_mock(post_retries=1)
+        mock.side_effect = flaky_post
+        tt.add_line("Line1")
+        tt.add_line("Line2", force_new_tweet=True)
+        tt.tweet()
+        calls = mock.call_args_list
+        self.assertEqual(3, len(calls))
+        self.assertEqual(calls[1].args[0], calls[0].args[0])
+        self.assertEqual(calls[2].kwargs["in_reply_to_status_id"], 0)
+
+    def test_post_not_retried_by_default(self):
+        tt, mock = create_mock()
+        mock.side_effect = TwitterError("post failed")
+        tt.add_line("Line1")
+        with self.assertRaises(TwitterError):
+            tt.tweet()
+        self.assertEqual(1, mock.call_count)
+
+    def test_request_metrics(self):
+        metrics.registry.reset()
+
+        def failing_upload(media, media_category=None):
+            raise TwitterError("upload failed")
+
+        tt, mock = create_mock()
+        tt.add_line("Line1")
+        tt.add_line("Line2", force_new_tweet=True)
+        tt.tweet()
+        tt, mock = create_mock(upload_side_effect=failing_upload)
+        tt.add_media("file1.jpg", MediaType.PHOTO)
+        with self.assertRaises(TwitterError):
+            tt.tweet()
+        self.assertEqual(2, metrics.registry.get("tweets_posted"))
+        self.assertEqual(2, metrics.registry.get("twitter_request", operation="post")["count"])
+        self.assertEqual(3, metrics.registry.get("twitter_retries", operation="upload"))
+        self.assertEqual(1, metrics.registry.get("twitter_failures", operation="upload"))
+        metrics.registry.reset()
+
+
+class WeightedLengthTest(unittest.TestCase):
+
+    def test_plain_text(self):
+        self.assertEqual(weighted_length("Totale casi: 229"), 16)
+        self.assertEqual(weighted_length("àèìòù"), 5)
+
+    def test_heavy_characters(self):
+        self.assertEqual(weighted_length("中文"), 4)
+
+    def test_emoji(self):
+        self.assertEqual(weighted_length("📈"), 2)
+        self.assertEqual(weighted_length("🦠🇮🇹"), 4)
+        self.assertEqual(weighted_length("0️⃣"), 2)
+        self.assertEqual(weighted_length("👍🏽"), 2)
+        self.assertEqual(weighted_length("👨\u200d👩\u200d👧"), 2)
+
+    def test_urls(self):
+        self.assertEqual(weighted_length("http://tiny.cc/covid-bot"), 23)
+        self.assertEqual(weighted_length(
+            "Generato da: https://github.com/berna1995/CovidDailyUpdateBot"), 36)
+
+
+class ThreadPlanTest(unittest.TestCase):
+
+    def setUp(self):
+        MockStatus.current_id = 0
+        MockMedia.ids = {}
+
+    def test_line_weighted_too_long(self):
+        tt, mock = create_mock()
+        with self.assertRaises(ValueError):
+            tt.add_line("🦠" * 100)
+
+    def test_plan_uses_weighted_length(self):
+        tt, mock = create_mock()
+        # 69 + 1 for the newline, four lines fill a tweet
+        line = "📈" * 10 + "x" * 49
+        for _ in range(8):
+            tt.add_line(line)
+        plan = tt.plan()
+        self.assertEqual(2, len(plan))
+        for planned in plan:
+            self.assertEqual(planned.length, weighted_length(planned.text))
+            self.assertLessEqual(planned.length, CHARACTER_LIMIT)
+        self.assertEqual(0, mock.call_count)
+
+    def test_plan_fills_tweets(self):
+        tt, mock = create_mock()
+        tt.set_header("🦠🇮🇹 Aggiornamento Giornaliero #COVID2019", repeat=False)
+        tt.set_footer("Generato da: http://tiny.cc/covid-bot", repeat=False)
+        for i in range(30):
+            tt.add_line("📈 Line {0}: {1} ({2:+d})".format(i, i * 1000, i))
+        plan = tt.plan()
+        total = sum(planned.length for planned in plan)
+        self.assertEqual(len(plan), -(-total // CHARACTER_LIMIT))
+        for planned in plan:
+            self.assertEqual(planned.length, weighted_length(planned.text))
+            self.assertLessEqual(planned.length, CHARACTER_LIMIT)
+
+    def test_plan_force_new_tweet(self):
+        tt, mock = create_mock()
+        tt.add_line("Line1")
+        tt.add_line("Line2", force_new_tweet=True)
+        tt.add_line("Line3")
+        plan = tt.plan()
+        self.assertEqual(["Line1", "Line2\nLine3"], [planned.text for planned in plan])
+
+    def test_plan_media(self):
+        tt, mock = create_mock()
+        tt.add_line("Line1")
+        tt.add_media("file1.jpg", MediaType.PHOTO)
+        plan = tt.plan()
+        self.assertEqual(["file1.jpg"], plan[0].media)
+        self.assertEqual(0, tt._ThreadTwitter__backend.upload_media.call_count)
+
+
+class ThreadCheckpointTest(unittest.TestCase):
+
+    def setUp(self):
+        MockStatus.current_id = 0
+        MockMedia.ids = {}
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = Path(self.tmp_dir.name) / "checkpoint"
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def create_failing_thread(self):
+        tt, mock = create_mock()
+        tt.add_line("Line1")
+        tt.add_line("Line2", force_new_tweet=True)
+        tt.add_line("Line3", force_new_tweet=True)
+        tt.add_media("file1.jpg", MediaType.PHOTO)
+
+        def fail_second(*args, **kwargs):
+            if mock.call_count == 2:
+                raise TwitterError("post failed")
+            return side_effect()
+
+        mock.side_effect = fail_second
+        return tt, mock
+
+    def test_checkpoint_is_removed_on_success(self):
+        tt, mock = create_mock()
+        checkpoint = ThreadCheckpoint(self.path, "2020-03-01")
+        tt.add_line("Line1")
+        tt.tweet(checkpoint=checkpoint)
+        self.assertFalse(self.path.exists())
+        self.assertIsNone(checkpoint.load())
+
+    def test_checkpoint_of_failed_thread(self):
+        tt, mock = self.create_failing_thread()
+        checkpoint = ThreadCheckpoint(self.path, "2020-03-01")
+        with self.assertRaises(TwitterError):
+            tt.tweet(checkpoint=checkpoint)
+        tweets, status_ids = checkpoint.load()
+        self.assertEqual(["Line1", "Line2", "Line3"], [tweet.text for tweet in tweets])
+        self.assertEqual([MockMedia.id("file1.jpg")], tweets[0].media)
+        self.assertEqual([0], status_ids)
+        self.assertIsNone(ThreadCheckpoint(self.path, "2020-03-02").load())
+
+    def test_resume(self):
+        tt, mock = self.create_failing_thread()
+        checkpoint = ThreadCheckpoint(self.path, "2020-03-01")
+        with self.assertRaises(TwitterError):
+            tt.tweet(checkpoint=checkpoint)
+
+        resumed, resumed_mock = create_mock()
+        posted = []
+        self.assertTrue(resumed.resume(checkpoint, on_posted=lambda i, status_id: posted.append(i)))
+        calls = resumed_mock.call_args_list
+        self.assertEqual(2, len(calls))
+        self.assertEqual("Line2", calls[0].args[0])
+        self.assertEqual(calls[0].kwargs["in_reply_to_status_id"], 0)
+        self.assertEqual("Line3", calls[1].args[0])
+        self.assertEqual(calls[1].kwargs["in_reply_to_status_id"], 1)
+        self.assertEqual([1, 2], posted)
+        self.assertEqual(0, resumed._ThreadTwitter__backend.upload_media.call_count)
+        self.assertFalse(resumed.resume(checkpoint))
+
+    def test_checkpoint_expires_with_age(self):
+        tt, mock = self.create_failing_thread()
+        checkpoint = ThreadCheckpoint(self.path, "2020-03-01", max_age=23 * 60 * 60)
+        with self.assertRaises(TwitterError):
+            tt.tweet(checkpoint=checkpoint)
+        self.assertFalse(checkpoint.expired())
+        state = json.loads(self.path.read_text())
+        state["created"] = state["created"] - 24 * 60 * 60
+        self.path.write_text(json.dumps(state))
+        self.assertTrue(checkpoint.expired())
+
+        # Planned again, the media uploaded again and the thread continued
+        # after the tweet already posted
+        replanned, replanned_mock = create_mock()
+        replanned.add_line("Line1")
+        replanned.add_line("Line2", force_new_tweet=True)
+        replanned.add_line("Line3", force_new_tweet=True)
+        replanned.add_media("file1.jpg", MediaType.PHOTO)
+        replanned.tweet(checkpoint=checkpoint)
+        calls = replanned_mock.call_args_list
+        self.assertEqual(["Line2", "Line3"], [call.args[0] for call in calls])
+        self.assertEqual(0, calls[0].kwargs["in_reply_to_status_id"])
+        self.assertEqual(1, replanned._ThreadTwitter__backend.upload_media.call_count)
+        self.assertFalse(self.path.exists())
+
+    def test_checkpoint_expires_with_permanent_failures(self):
+        tt, mock = self.create_failing_thread()
+        checkpoint = ThreadCheckpoint(self.path, "2020-03-01", max_failures=2)
+        # Not counted, another attempt may succeed
+        with self.assertRaises(TwitterError):
+            tt.tweet(checkpoint=checkpoint)
+        self.assertFalse(checkpoint.expired())
+
+        duplicate = TwitterError([{"code": 187, "message": "Status is a duplicate."}])
+        for _ in range(2):
+            self.assertFalse(checkpoint.expired())
+            resumed, resumed_mock = create_mock(post_retries=3)
+            resumed_mock.side_effect = duplicate
+            with self.assertRaises(TwitterError):
+                resumed.resume(checkpoint)
+            # Never retried
+            self.assertEqual(1, resumed_mock.call_count)
+        self.assertTrue(checkpoint.expired())
+        self.assertEqual([0], checkpoint.load()[1])
+
+    def test_new_plan_starts_a_new_checkpoint(self):
+        tt, mock = self.create_failing_thread()
+        checkpoint = ThreadCheckpoint(self.path, "2020-03-01")
+        with self.assertRaises(TwitterError):
+            tt.tweet(checkpoint=checkpoint)
+        # Different tweets, nothing of the previous thread is kept
+        replanned, replanned_mock = create_mock()
+        replanned.add_line("Other")
+        replanned.tweet(checkpoint=checkpoint)
+        self.assertIsNone(replanned_mock.call_args_list[0].kwargs["in_reply_to_status_id"])
 
 
 if __name__ == "__main__":
@@ -0,0 +1,90 @@
+import datetime
+import random
+import sys
+import unittest
+
+import pytz
+
+from bot import timezones
+from bot.timezones import DateLocalizer
+
+PAIRS = [("UTC", "Europe/Rome"), ("Europe/Rome", "UTC"), ("Europe/Rome", "America/New_York"),
+         ("Asia/Kolkata", "Australia/Lord_Howe")]
+
+
+def hourly(start, end, step=datetime.timedelta(minutes=30)):
+    values = []
+    current = start
+    while current < end:
+        values.append(current)
+        current = current + step
+    return values
+
+
+def around_transitions():
+    # Every 10 minutes on the days Europe/Rome and America/New_York change
+    # their clocks, ambiguous and skipped wall times included
+    values = []
+    for day in [datetime.datetime(2020, 3, 8), datetime.datetime(2020, 3, 29),
+                datetime.datetime(2020, 10, 25), datetime.datetime(2020, 11, 1)]:
+        values.extend(hourly(day - datetime.timedelta(days=3), day + datetime.timedelta(days=3),
+                             datetime.timedelta(minutes=10)))
+    return values
+
+
+def reference(tz_src, tz_dst, values):
+    src = pytz.timezone(tz_src)
+    dst = pytz.timezone(tz_dst)
+    return [src.localize(value).astimezone(dst) for value in values]
+
+
+class DateLocalizerTest(unittest.TestCase):
+
+    def assert_same(self, expected, actual, same_tzinfo=True):
+        self.assertEqual(len(expected), len(actual))
+        for e, a in zip(expected, actual):
+            # Times in a repeated hour never compare equal across tzinfo types
+            self.assertEqual(e.astimezone(pytz.utc), a.astimezone(pytz.utc))
+            self.assertEqual(e.replace(tzinfo=None), a.replace(tzinfo=None))
+            self.assertEqual(e.utcoffset(), a.utcoffset())
+            self.assertEqual(e.tzname(), a.tzname())
+            if same_tzinfo:
+                self.assertIs(e.tzinfo, a.tzinfo)
+
+    def test_daily_values_match_pytz(self):
+        values = hourly(datetime.datetime(2019, 12, 1, 17), datetime.datetime(2022, 1, 1),
+                        datetime.timedelta(days=1))
+        for tz_src, tz_dst in PAIRS:
+            self.assert_same(reference(tz_src, tz_dst, values),
+                             DateLocalizer(tz_src, tz_dst).localize_all(values))
+
+    def test_transitions_match_pytz(self):
+        values = around_transitions()
+        for tz_src, tz_dst in PAIRS:
+            self.assert_same(reference(tz_src, tz_dst, values),
+                             DateLocalizer(tz_src, tz_dst).localize_all(values))
+
+    def test_unsorted_values_match_pytz(self):
+        values = around_transitions() + hourly(datetime.datetime(1970, 1, 1), datetime.datetime(2040, 1, 1),
+                                               datetime.timedelta(days=13, hours=5))
+        random.Random(0).shuffle(values)
+        for tz_src, tz_dst in PAIRS:
+            self.assert_same(reference(tz_src, tz_dst, values),
+                             DateLocalizer(tz_src, tz_dst).localize_all(values))
+
+    @unittest.skipUnless(sys.version_info >= (3, 9), "zoneinfo needs Python 3.9 or later")
+    def test_zoneinfo_backend_matches_pytz(self):
+        values = around_transitions() + hourly(datetime.datetime(2019, 12, 1, 17), datetime.datetime(2022, 1, 1),
+                                               datetime.timedelta(days=1))
+        for tz_src, tz_dst in PAIRS:
+            localizer = DateLocalizer(tz_src, tz_dst, backend=timezones.ZONEINFO)
+            self.assert_same(reference(tz_src, tz_dst, values), localizer.localize_all(values),
+                             same_tzinfo=False)
+
+    def test_unknown_backend(self):
+        with self.assertRaises(ValueError):
+            DateLocalizer("UTC", "Europe/Rome", backend="dateutil")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,128 @@
+import logging
+import os
+import tempfile
+import time
+import unittest
+from pathlib import Path
+from unittest.mock import Mock
+from unittest.mock import patch
+
+from bot import metrics
+from bot import worker
+from bot.fetch import FetchResult
+from bot.worker import WorkerError
+from tests.test_memory import national_payload
+
+# Exit code of worker_task, set by the parent
+EXIT_CODE_ENV = "TEST_WORKER_EXIT_CODE"
+
+
+# Run by the worker processes
+
+def count(value):
+    metrics.inc("worker_calls", value)
+
+
+def fail():
+    metrics.inc("worker_calls")
+    raise ValueError("failed")
+
+
+def crash():
+    os._exit(3)
+
+
+def sleep(seconds):
+    time.sleep(seconds)
+
+
+def worker_task(name, elapsed, dp, checkpoint):
+    # Stands in for the one of bot.__main__
+    if os.getenv(EXIT_CODE_ENV) is not None:
+        os._exit(int(os.getenv(EXIT_CODE_ENV)))
+    metrics.inc("worker_rows", dp.size(), task=name)
+    metrics.set_gauge("worker_elapsed", elapsed)
+
+
+class WorkerTest(unittest.TestCase):
+
+    def setUp(self):
+        metrics.registry.reset()
+
+    def test_metrics_are_merged(self):
+        worker.run(__name__, "count", (3,))
+        worker.run(__name__, "count", (2,))
+        self.assertEqual(5, metrics.registry.get("worker_calls"))
+
+    def test_failure(self):
+        with patch.object(logging.getLogger("bot"), "disabled", True):
+            with self.assertRaises(WorkerError):
+                worker.run(__name__, "fail")
+        self.assertEqual(1, metrics.registry.get("worker_calls"))
+
+    def test_crash(self):
+        with self.assertRaisesRegex(WorkerError, "code 3"):
+            worker.run(__name__, "crash")
+
+    def test_timeout(self):
+        start = time.perf_counter()
+        with self.assertRaisesRegex(WorkerError, "did not finish"):
+            worker.run(__name__, "sleep", (30,), timeout=1)
+        self.assertLess(time.perf_counter() - start, 15)
+
+
+class SupervisorTest(unittest.TestCase):
+
+    def poll(self, tmp_dir, polls):
+        # polls is a list of the worker exit codes, None for a successful
+        # worker. The data is sent once, then it is not modified.
+        import bot.__main__ as bot_main
+
+        fetcher = Mock()
+        fetcher.fetch.side_effect = [FetchResult(200, national_payload(60), True)] + \
+            [FetchResult(304, None, False)] * (len(polls) - 1)
+        fetcher.stats.return_value = {"bytes_saved": 0, "time_saved": 0.0}
+        results = []
+        with patch.object(bot_main.config, "LATEST_EXECUTION_DATE_FILE_PATH", Path(tmp_dir) / ".last_exec"), \
+                patch.object(bot_main.config, "THREAD_CHECKPOINT_PATH", Path(tmp_dir) / ".thread_checkpoint"), \
+                patch.object(bot_main.config, "REGIONAL_CHARTS", False), \
+                patch.object(bot_main.config, "METRICS", False), \
+                patch.object(bot_main, "SUPERVISOR_MODE", True), \
+                patch.object(bot_main, "WORKER_MODULE", __name__), \
+                patch.object(bot_main, "data_fetcher", fetcher), \
+                patch.object(bot_main, "data_processor", None), \
+                patch.object(bot_main.log, "disabled", True):
+            for exit_code in polls:
+                with patch.dict(os.environ):
+                    if exit_code is not None:
+                        os.environ[EXIT_CODE_ENV] = str(exit_code)
+                    results.append(bot_main.poll_for_new_data())
+        return results
+
+    def setUp(self):
+        metrics.registry.reset()
+
+    def test_data_is_handed_over(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            self.assertTrue(self.poll(tmp_dir, [None])[0])
+            self.assertEqual("2020-04-29T18:00:00", (Path(tmp_dir) / ".last_exec").read_text())
+        self.assertEqual(60, metrics.registry.get("worker_rows", task="publish_update"))
+        self.assertEqual(1, metrics.registry.get("stage", stage="publish_update_worker")["count"])
+        # The time spent polling before the hand-over, fetch and parsing
+        fetch = metrics.registry.get("stage", stage="fetch")["sum"]
+        self.assertGreaterEqual(metrics.registry.get("worker_elapsed"), fetch)
+
+    def test_failed_worker_is_retried(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            results = self.poll(tmp_dir, [1, 3, None, None])
+            self.assertEqual("2020-04-29T18:00:00", (Path(tmp_dir) / ".last_exec").read_text())
+        # Retried on the polls after the failures although the data is not
+        # modified, then published only once
+        self.assertEqual([False, False, True, False], [bool(result) for result in results])
+        self.assertEqual(2, metrics.registry.get("poll_errors"))
+        self.assertEqual(3, metrics.registry.get("stage", stage="publish_update_worker")["count"])
+        self.assertEqual(60, metrics.registry.get("worker_rows", task="publish_update"))
+
+
+if __name__ == "__main__":
+    unittest.main()